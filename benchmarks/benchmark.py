@@ -0,0 +1,336 @@
+"""
+Reproducible, headless benchmarks for the projection pipeline.
+
+Run from the repository root:
+    python -m benchmarks.benchmark
+    python -m benchmarks.benchmark --resolutions 720p --surfaces 4 6 --json out.json
+    python -m benchmarks.benchmark --resolutions 720p --projectors 1 2 4
+    python -m benchmarks.benchmark --resolutions 480p --clients 1 4
+
+Every benchmark reports frames per second, latency percentiles and the peak
+memory allocated while it ran. Latency and memory are measured in separate
+passes, so that tracemalloc doesn't skew the timings.
+"""
+import json
+import os
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from threading import Thread
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+import numpy as np
+
+from demo import Demo
+from hardware.projector import HeadlessProjector
+from hardware.projector_group import ProjectorGroup
+from hardware.replay import ReplayCamera
+from hardware.surface import Surface
+from inference_service import (DETECTOR, SEGMENTER, InferenceClient,
+                               InferenceServer, RemoteDetector,
+                               RemoteSegmenter)
+
+# {name: (camera (width, height), projector (width, height))}
+RESOLUTIONS = {
+    "480p": ((640, 480), (1280, 720)),
+    "720p": ((1280, 720), (1920, 1080)),
+    "1080p": ((1920, 1080), (1920, 1080)),
+}
+PERCENTILES = (50, 90, 99)
+
+
+class StubSegmenter:
+    """ Pretends to be a DeeplabImageSegmenter. Marks a fixed patch in the
+    middle of the frame as a person, optionally after sleeping to simulate
+    inference time. """
+
+    def __init__(self, latency=0, release_gil=False):
+        """
+        :param release_gil: If True, sleep rather than spin, like a real
+        model that releases the GIL while it runs
+        """
+        self.latency = latency
+        self.release_gil = release_gil
+
+    def predict(self, frame):
+        start = perf_counter()
+        colored = np.zeros_like(frame)
+        h, w = frame.shape[:2]
+        colored[h // 3:h // 2, w // 3:w // 2] = 255
+        if self.release_gil:
+            sleep(max(self.latency - (perf_counter() - start), 0))
+        while perf_counter() - start < self.latency: pass
+        return SimpleNamespace(colored=colored)
+
+
+class StubDetector:
+    """ Pretends to be a batched ObjectDetector. Every call sleeps for
+    latency seconds, plus a quarter of that per frame, like a model with a
+    fixed overhead per call. """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def predict(self, frames):
+        # Unbatched servers pass a single frame
+        if isinstance(frames, np.ndarray):
+            return self.predict([frames])[0]
+        sleep(self.latency * (1 + len(frames) / 4))
+        return [[] for _ in frames]
+
+
+class FrameDetector(RemoteDetector):
+    """ A RemoteDetector that takes one frame at a time, like the segmenter """
+
+    def predict(self, frame):
+        return super().predict([frame])[0]
+
+
+def make_surfaces(count, cam_size, prj_size, seed=0):
+    """ Tile count slightly skewed quadrilaterals over the camera and
+    projector, so every surface has a non-trivial homography """
+    rng = np.random.RandomState(seed)
+    cols = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / cols))
+
+    def quad(size, row, col):
+        w, h = size[0] / cols, size[1] / rows
+        corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        corners += [col * w, row * h]
+        corners += rng.uniform(-0.05, 0.05, (4, 2)) * [w, h]
+        return np.clip(corners, 0, [size[0] - 1, size[1] - 1]).astype(int)
+
+    cells = [(i // cols, i % cols) for i in range(count)]
+    return [Surface(quad(cam_size, r, c), quad(prj_size, r, c))
+            for r, c in cells]
+
+
+def make_frames(count, cam_size, seed=0):
+    """ Noise frames with a moving bright square, so motion gating fires """
+    rng = np.random.RandomState(seed)
+    w, h = cam_size
+    base = rng.randint(0, 255, (h, w, 3)).astype(np.uint8)
+    frames = []
+    for i in range(count):
+        frame = base.copy()
+        x = int((i / count) * (w - w // 8))
+        frame[h // 3:h // 3 + h // 8, x:x + w // 8] = 255
+        frames.append(frame)
+    return frames
+
+
+def summarize(latencies, peak_bytes):
+    latencies = np.array(latencies)
+    summary = {"fps": float(1 / latencies.mean()),
+               "peak_mb": peak_bytes / 2 ** 20}
+    for p in PERCENTILES:
+        summary["p{}_ms".format(p)] = float(np.percentile(latencies, p) * 1000)
+    return summary
+
+
+def peak_memory(func, *args):
+    """ :return: The peak bytes allocated while running func(*args) """
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def measure(func, frames):
+    """ Call func on each frame, and return the summary of its latency """
+    func(frames[0])  # Warm up any caches
+
+    latencies = []
+    for frame in frames:
+        start = perf_counter()
+        func(frame)
+        latencies.append(perf_counter() - start)
+
+    def run_all():
+        for frame in frames:
+            func(frame)
+
+    return summarize(latencies, peak_memory(run_all))
+
+
+def bench_components(cam_size, prj_size, surface_count, frames):
+    surfaces = make_surfaces(surface_count, cam_size, prj_size)
+    prj = HeadlessProjector(*prj_size, surfaces=surfaces)
+    prj_reuse = HeadlessProjector(*prj_size, surfaces=surfaces,
+                                  reuse_buffers=True)
+    surface = surfaces[0]
+
+    return {
+        "get_warped_frame": measure(prj.get_warped_frame, frames),
+        "get_warped_frame (reuse_buffers)":
+            measure(prj_reuse.get_warped_frame, frames),
+        "Surface.warp_to_camera":
+            measure(lambda f: surface.warp_to_camera(f, prj_size), frames),
+        "Surface.mask_frame": measure(surface.mask_frame, frames),
+    }
+
+
+def bench_projectors(cam_size, prj_size, surface_count, frames, counts):
+    """ Warp for groups of projectors of each size, all with the same
+    surfaces, to see how well the parallel warps scale """
+    surfaces = make_surfaces(surface_count, cam_size, prj_size)
+    results = {}
+    for count in counts:
+        group = ProjectorGroup([HeadlessProjector(*prj_size, surfaces=surfaces)
+                                for _ in range(count)])
+        name = "ProjectorGroup warp ({} projectors)".format(count)
+        results[name] = measure(group.get_warped_frame, frames)
+        group.close()
+    return results
+
+
+def run_demo_loop(demo, frame_count):
+    """ Run frame_count frames through the Demo, timing each stage """
+    stages = {"capture": [], "segmentation": [], "render": [], "total": []}
+    last_seq = demo.cam.latest_seq
+    for _ in range(frame_count):
+        start = perf_counter()
+        last_seq, _, frame = demo.cam.read_next(last_seq)
+        captured = perf_counter()
+        canvas = demo.run_person_segmentation(frame)
+        segmented = perf_counter()
+        demo.prj.render_to_camera(canvas, wait=False)
+        rendered = perf_counter()
+
+        stages["capture"].append(captured - start)
+        stages["segmentation"].append(segmented - captured)
+        stages["render"].append(rendered - segmented)
+        stages["total"].append(rendered - start)
+    return stages
+
+
+def bench_demo(cam_size, prj_size, surface_count, frames, latency, cam_fps):
+    """ Run the full Demo loop on replayed frames, with a stub segmenter """
+    surfaces = make_surfaces(surface_count, cam_size, prj_size)
+    cam = ReplayCamera(frames, fps=cam_fps, loop=True)
+    prj = HeadlessProjector(*prj_size, surfaces=surfaces)
+    demo = Demo(camera=cam,
+                projector=prj,
+                segmentation_brain=StubSegmenter(latency),
+                detector_brain=None,
+                device=None)
+
+    stages = run_demo_loop(demo, len(frames))
+    peak = peak_memory(run_demo_loop, demo, len(frames))
+    cam.close()
+
+    return {"Demo loop " + name: summarize(latencies, peak)
+            for name, latencies in stages.items()}
+
+
+def run_clients(socket_path, remote, frames, clients):
+    """ Send every frame from each of several clients at once
+    :return: Every request's latency, and the total seconds taken """
+    latencies = []
+
+    def run_client():
+        client = InferenceClient(socket_path)
+        model = remote(client)
+        for frame in frames:
+            start = perf_counter()
+            model.predict(frame)
+            latencies.append(perf_counter() - start)
+        client.close()
+
+    threads = [Thread(target=run_client) for _ in range(clients)]
+    start = perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return latencies, perf_counter() - start
+
+
+def bench_inference(frames, latency, counts):
+    """ Serve stub models to several clients at once, with and without
+    batching. Here fps is the total across every client. """
+    socket_path = os.path.join(tempfile.mkdtemp(), "inference.sock")
+    runs = [("segmenter", SEGMENTER, StubSegmenter(latency, True), (),
+             RemoteSegmenter),
+            ("detector", DETECTOR, StubDetector(latency), (), FrameDetector),
+            ("detector, batched", DETECTOR, StubDetector(latency),
+             [DETECTOR], FrameDetector)]
+
+    results = {}
+    for count in counts:
+        for name, model_name, model, batched, remote in runs:
+            server = InferenceServer(socket_path, {model_name: model},
+                                     batched=batched)
+            Thread(target=server.serve_forever, daemon=True).start()
+            latencies, elapsed = run_clients(socket_path, remote, frames,
+                                             count)
+            server.close()
+
+            summary = summarize(latencies, 0)
+            summary["fps"] = len(latencies) / elapsed
+            results["Inference {} ({} clients)".format(name, count)] = summary
+    return results
+
+
+def print_results(results):
+    columns = ["fps"] + ["p{}_ms".format(p) for p in PERCENTILES] + ["peak_mb"]
+    print("{:<48}".format("benchmark") +
+          "".join("{:>10}".format(c) for c in columns))
+    for name, summary in results.items():
+        print("{:<48}".format(name) +
+              "".join("{:>10.2f}".format(summary[c]) for c in columns))
+
+
+def main(args):
+    results = {}
+    for res_name in args.resolutions:
+        cam_size, prj_size = RESOLUTIONS[res_name]
+        frames = make_frames(args.frames, cam_size)
+        for surface_count in args.surfaces:
+            prefix = "{} x{} ".format(res_name, surface_count)
+            runs = bench_components(cam_size, prj_size, surface_count, frames)
+            runs.update(bench_projectors(cam_size, prj_size, surface_count,
+                                         frames, args.projectors))
+            runs.update(bench_demo(cam_size, prj_size, surface_count, frames,
+                                   args.segment_latency, args.camera_fps))
+            results.update({prefix + name: summary
+                            for name, summary in runs.items()})
+        if args.clients:
+            runs = bench_inference(frames, args.inference_latency,
+                                   args.clients)
+            results.update({res_name + " " + name: summary
+                            for name, summary in runs.items()})
+
+    print_results(results)
+    if args.json:
+        json.dump(results, open(args.json, "w"), indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the projection pipeline without a camera, "
+                    "projector or model.")
+    parser.add_argument("-r", "--resolutions", nargs="+",
+                        default=list(RESOLUTIONS), choices=list(RESOLUTIONS),
+                        help="Which camera/projector resolutions to run")
+    parser.add_argument("-s", "--surfaces", nargs="+", type=int,
+                        default=[1, 4, 6],
+                        help="How many surfaces to calibrate the projector with")
+    parser.add_argument("-p", "--projectors", nargs="+", type=int,
+                        default=[1, 2],
+                        help="How many projectors to warp for in parallel")
+    parser.add_argument("-f", "--frames", type=int, default=100,
+                        help="How many frames to time each benchmark over")
+    parser.add_argument("-l", "--segment-latency", type=float, default=0,
+                        help="Seconds the stub segmenter spends per frame")
+    parser.add_argument("-c", "--camera-fps", type=float, default=120,
+                        help="The rate the replayed camera serves frames at")
+    parser.add_argument("--clients", nargs="+", type=int, default=[],
+                        help="Optionally, benchmark the inference service "
+                             "with this many demos sharing it at once")
+    parser.add_argument("--inference-latency", type=float, default=0.02,
+                        help="Seconds the served stub models take per call")
+    parser.add_argument("-j", "--json", type=str, default=None,
+                        help="Optionally, a path to save the results to")
+    args = parser.parse_args()
+    main(args)
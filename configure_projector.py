@@ -3,6 +3,7 @@ import os
 
 from hardware.projector import Projector
 from hardware.camera import Camera
+from hardware.structured_light import StructuredLightCalibrator
 from hardware.surface import Surface, SurfaceFactory
 
 intro_text = """
@@ -28,23 +29,33 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--projector-id", type=int, required=True,
                         help="The monitor ID representing the projector. "
                              "Try numbers 0-# monitors, if you don't know.")
+    parser.add_argument("--auto", action="store_true",
+                        help="Find the surfaces automatically by projecting "
+                             "structured light patterns, instead of clicking "
+                             "on their corners.")
     args = parser.parse_args()
 
     p = Projector(args.projector_id)
     c = Camera(1)
 
-    factory = SurfaceFactory(c, p)
-    print(intro_text)
-    input()
-    while True:
-        new_surface = factory.create_surface()
-        p.surfaces.append(new_surface)
-
-        ans = ""
-        while "y" not in ans.lower() and "n" not in ans.lower():
-            ans = input("Would you like to create another surface? (y/n)")
-        if "n" in ans.lower():
-            break
+    if args.auto:
+        print("Projecting calibration patterns. Keep the scene still...")
+        p.surfaces = StructuredLightCalibrator(c, p).calibrate()
+        print("Found", len(p.surfaces), "surfaces.")
+    else:
+        factory = SurfaceFactory(c, p)
+        print(intro_text)
+        input()
+        while True:
+            new_surface = factory.create_surface()
+            p.surfaces.append(new_surface)
+            p.invalidate_surfaces()
+
+            ans = ""
+            while "y" not in ans.lower() and "n" not in ans.lower():
+                ans = input("Would you like to create another surface? (y/n)")
+            if "n" in ans.lower():
+                break
 
     p.save_configuration(args.save_to)
     print("Configuration saved!")
@@ -1,23 +1,65 @@
+import json
 from argparse import ArgumentParser
+from functools import partial
+from time import time
 
 import cv2
 import numpy as np
 
-from easyinference.models import DeeplabImageSegmenter, ObjectDetector
-
 from hanover_resources.communication import Device
+from inference_service import InferenceClient, RemoteDetector, RemoteSegmenter
 from hardware.camera import Camera
+from hardware.presenter import Presenter
 from hardware.projector import Projector
+from hardware.projector_group import ProjectorGroup
+from hardware.shared_camera import SharedMemoryCamera
 from utils import draw_utils
+from utils.async_detector import AsyncDetector
+from utils.latency import FrameTrace, LatencyProbe
+from utils.metrics import MetricsExporter, metrics
+from utils.motion_utils import MaskPropagator, MotionDetector
+from utils.pipeline import Pipeline, Stage
+from utils.shared_frames import ProcessSegmenter
+from utils.vision_utils import get_polygon_rois
 
 
 class Demo:
-    CHECK_FOR_HUMANS = 1  # Check for humans every X frames
-    HUMAN_PIXEL_THRESH = 5000  # Number of human pixels to count as an 'alarm'
-    MOTION_THRESH = 1000
+    CHECK_FOR_HUMANS = 1  # Run segmentation every X frames, propagate between
+    HUMAN_PIXEL_THRESH = 1700  # Projector pixels of human to count as 'alarm'
+    MOTION_THRESH = 1000  # Number of moving pixels on a surface to count
+    FRAME_TIMEOUT = 0.05  # Seconds to wait for a frame before polling the GUI
+    ROI_PADDING = 16  # Pixels of context around surfaces for cropped inference
+    DETECTION_RATE = 2  # Times per second to run the object detector
+
+    # Ways of cropping frames to the surfaces before segmenting them
+    CROP_NONE = None  # Segment the whole frame
+    CROP_UNION = "union"  # One crop around all of the surfaces
+    CROP_SURFACES = "surfaces"  # One crop per surface, merged if overlapping
 
     def __init__(self, camera, projector, segmentation_brain, detector_brain,
-                 device):
+                 device, crop_mode=CROP_NONE, keyframe_interval=None,
+                 keyframe_period=None, detection_rate=DETECTION_RATE,
+                 present_fps=None):
+        """
+        :param crop_mode: Only pixels on a surface can be projected onto, so
+        segmentation can be limited to crops around them. One of
+        Demo.CROP_NONE, Demo.CROP_UNION or Demo.CROP_SURFACES.
+        :param keyframe_interval: Run segmentation on every Nth frame, and
+        carry the last segmentation forward with optical flow in between.
+        Defaults to CHECK_FOR_HUMANS.
+        :param keyframe_period: Optionally, also run segmentation whenever
+        this many seconds have passed since the last keyframe
+        :param detection_rate: Times per second to run the detector in the
+        background. If None, it runs synchronously on every frame.
+        :param present_fps: If set, frames are presented to the projector at
+        this steady rate, newest frame first, instead of as soon as they're
+        ready
+        """
+        if crop_mode not in (self.CROP_NONE, self.CROP_UNION,
+                             self.CROP_SURFACES):
+            raise ValueError("Unknown crop mode: " + str(crop_mode))
+        self.crop_mode = crop_mode
+        self._rois = {}  # {frame shape: [(x1, y1, x2, y2), ...]}
 
         self.cam = camera
         self.prj = projector
@@ -25,56 +67,303 @@ class Demo:
         self.detector = detector_brain
         self.device = device
 
+        self.presenter = None
+        if present_fps is not None:
+            self.presenter = Presenter(
+                lambda frame: self.prj.render(frame, wait=False),
+                fps=present_fps)
+
+        self.detection_worker = None
+        if detector_brain is not None and detection_rate is not None:
+            self.detection_worker = AsyncDetector(detector_brain,
+                                                  rate=detection_rate)
+
         # State tracking
         self.is_person = False  # Is a person currently present
-        self._last_frame = self.cam.read()[1]
+        self.frames_inferred = 0
+        self.frames_skipped = 0  # Frames where inference was skipped
+        self.frames_propagated = 0  # Frames carried from the last keyframe
+
+        # Keyframe scheduling, for propagating masks between inferences
+        self.keyframe_interval = keyframe_interval or self.CHECK_FOR_HUMANS
+        self.keyframe_period = keyframe_period
+        self.propagator = MaskPropagator()
+        self._frames_since_keyframe = 0
+        self._last_keyframe_time = 0
+
+        # Only motion on a projectable surface is worth running inference for
+        self.motion_detector = MotionDetector(
+            [s.cam_points for s in self.prj.surfaces] or None)
+        self.motion_detector.update(self.cam.read()[1])
+
+    @staticmethod
+    def frames_held(pipelined=False, async_detection=True):
+        """How many camera frames a Demo can hold onto at once. A
+        SharedMemoryCamera needs more slots than this to keep capturing."""
+        held = 2  # The frame being labelled, and the next one being read
+        if pipelined:
+            held += 1  # The frame waiting for the segmentation stage
+        if async_detection:
+            held += 1  # The frame waiting for the detector
+        return held
+
+    def check_camera_slots(self, pipelined=False):
+        """Make sure a shared memory camera won't stall because this Demo is
+        holding onto every one of its frames"""
+        ring = getattr(self.cam, "ring", None)
+        held = self.frames_held(pipelined, self.detection_worker is not None)
+        if ring is not None and ring.slots <= held:
+            raise ValueError("The camera has {} slots, but the Demo can hold "
+                             "{} frames at once".format(ring.slots, held))
 
     def run(self):
+        self.check_camera_slots()
         self.cam.show()
-        last_tstamp = 0
-
-        while cv2.waitKey(10) != ord('q'):
-            # Get a frame and update state variables
-            tstamp, frame = self.cam.read()
-            if tstamp == last_tstamp:
-                print("Skipping")
+        last_seq = 0
+
+        while cv2.waitKey(1) != ord('q'):
+            # Wait for a frame that hasn't been processed yet
+            new_frame = self.cam.read_next(last_seq, self.frame_timeout())
+            if new_frame is None:
+                if not self.cam.running: break
+                if self.presenter: self.presenter.present_if_due()
                 continue
-            last_tstamp = tstamp
-
-            canvas = self.run_person_segmentation(frame)
-
-            cv2.imshow("Labels", canvas)
+            if last_seq and new_frame[0] > last_seq + 1:
+                metrics.increment("demo.frames_dropped",
+                                  new_frame[0] - last_seq - 1)
+            last_seq, tstamp, frame = new_frame
+            trace = FrameTrace(last_seq, tstamp).mark("queue")
+
+            canvas = self.process_frame(frame, trace, tstamp)
+            self.show_labels(canvas)
+
+        self.close()
+
+    def process_frame(self, frame, trace=None, tstamp=None):
+        """Segment a single camera frame and project the result onto it
+        :param trace: Optionally, a FrameTrace to mark each stage on
+        :param tstamp: When the camera captured the frame """
+        canvas = self.label_frame(frame, tstamp)
+        if trace: trace.mark("label")
+        if self.presenter:
+            warped = self.prj.get_warped_frame(canvas)
+            # The presenter may still hold this frame during the next warp
+            if self.prj.reuse_buffers and self.prj.buffers < 2:
+                warped = copy_warped(warped)
+            self.present(warped)
+        else:
             self.prj.render_to_camera(canvas, wait=False)
+        if trace: trace.mark("project").record()
+        metrics.tick("demo.frames")
+        return canvas
 
+    def present(self, warped):
+        """Show a warped frame on the projector, paced by the presenter if
+        there is one"""
+        if self.presenter:
+            self.presenter.submit(warped)
+            self.presenter.present_if_due()
+        else:
+            self.prj.render(warped, wait=False)
+
+    def frame_timeout(self):
+        """How long to wait for a new frame, without missing a presentation
+        deadline"""
+        if self.presenter is None:
+            return self.FRAME_TIMEOUT
+        return min(self.FRAME_TIMEOUT, self.presenter.time_until_due())
+
+    def label_frame(self, frame, tstamp=None):
+        """Build the canvas of segmentations and detections for a frame
+        :param tstamp: When the camera captured the frame """
+        canvas = self.run_person_segmentation(frame)
+        if canvas is None:
+            canvas = np.zeros_like(frame)
+        return self.draw_predictions(frame, canvas, tstamp)
+
+    def close(self):
+        if self.detection_worker is not None:
+            self.detection_worker.close()
+        if self.device is not None:
+            self.device.close()
+        self.prj.close()
         self.cam.close()
 
+    def show_labels(self, canvas):
+        """Show the label canvas, with the metrics overlay if enabled"""
+        if metrics.enabled:
+            canvas = metrics.draw_overlay(canvas.copy())
+        cv2.imshow("Labels", canvas)
+
+    def run_pipelined(self):
+        """Same as run(), but capture, segmentation and warping each run on
+        their own thread, so inference on one frame overlaps warping and
+        displaying the frame before it. Only the GUI stays on this thread."""
+        self.check_camera_slots(pipelined=True)
+        self.cam.show()
+        last_seq = [0]
+
+        # Each frame travels through the stages along with its FrameTrace
+        def capture():
+            new_frame = self.cam.read_next(last_seq[0], self.FRAME_TIMEOUT)
+            if new_frame is None: return None
+            last_seq[0], tstamp, frame = new_frame
+            return frame, FrameTrace(last_seq[0], tstamp).mark("queue")
+
+        def label(item):
+            frame, trace = item
+            trace.mark("capture_wait")
+            canvas = self.label_frame(frame, trace.tstamp)
+            return canvas, trace.mark("label")
+
+        def warp(item):
+            canvas, trace = item
+            trace.mark("label_wait")
+            warped = self.prj.get_warped_frame(canvas)
+            # Persistent buffers get overwritten while the GUI is drawing
+            if self.prj.reuse_buffers:
+                warped = copy_warped(warped)
+            return canvas, warped, trace.mark("warp")
+
+        pipeline = Pipeline([Stage("capture", capture),
+                             Stage("segmentation", label),
+                             Stage("warp", warp)])
+        pipeline.start()
+
+        while cv2.waitKey(1) != ord('q') and self.cam.running:
+            result = pipeline.get(timeout=self.frame_timeout())
+            if result is None:
+                if not pipeline.running: break
+                if self.presenter: self.presenter.present_if_due()
+                continue
+            canvas, warped, trace = result
+            trace.mark("warp_wait")
+
+            self.show_labels(canvas)
+            self.present(warped)
+            trace.mark("render").record()
+            metrics.tick("demo.frames")
+            for stage, dropped in pipeline.dropped.items():
+                metrics.set_gauge("pipeline.dropped." + stage, dropped)
+
+        pipeline.stop()
+        self.close()
+
     def run_person_segmentation(self, frame):
         # Draw segmentations
         if self.segmenter is None: return
-        if not self.is_person and not self.motion_detected(frame):
-            print("Skipping segmentation inference, no motion!")
+        # Keep the background model learning even while someone is there,
+        # so lighting changes don't show up as motion once they leave
+        moving = self.motion_detected(frame)
+        if not self.is_person and not moving:
+            self._count_frame(skipped=True)
+            self.propagator.reset()
             return np.zeros_like(frame)
 
-        segmentation = self.segmenter.predict(frame)
-        canvas = segmentation.colored
-
-        # Send a signal if there are humans in the frame
-        warped = self.prj.get_warped_frame(canvas)
-        human_pixels = (warped == [255, 255, 255]).sum()
-        print("Human pixels", human_pixels)
+        canvas = None
+        if not self.keyframe_due():
+            with metrics.timer("demo.propagate"):
+                canvas = self.propagator.propagate(frame)
+
+        if canvas is None:
+            with metrics.timer("segmenter.predict"):
+                canvas = self.segment(frame)
+            self.propagator.set_keyframe(frame, canvas)
+            self._frames_since_keyframe = 0
+            self._last_keyframe_time = time()
+        else:
+            self._frames_since_keyframe += 1
+        self._count_frame(propagated=self._frames_since_keyframe > 0)
+
+        # Send a signal if there are humans on any of the surfaces
+        person_mask = cv2.inRange(canvas, (255, 255, 255), (255, 255, 255))
+        human_pixels = self.prj.count_union_pixels(person_mask)
+        metrics.set_gauge("demo.human_pixels", human_pixels)
         self.is_person = human_pixels > self.HUMAN_PIXEL_THRESH
         self.alert_robot()
 
         return canvas
 
+    def keyframe_due(self):
+        """Whether the next frame should be segmented rather than propagated"""
+        if not self.propagator.has_keyframe:
+            return True
+        if self._frames_since_keyframe + 1 >= self.keyframe_interval:
+            return True
+        return (self.keyframe_period is not None and
+                time() - self._last_keyframe_time >= self.keyframe_period)
+
+    def segment(self, frame):
+        """Segment the frame, only running the model on the crops around the
+        surfaces if a crop mode is set. Returns the colored label canvas."""
+        if self.crop_mode is self.CROP_NONE or not self.prj.surfaces:
+            colored = self.segmenter.predict(frame).colored
+            # A ProcessSegmenter's result pins a slot of its ring until it's
+            # gone, and the canvas can be kept around for many frames
+            if not colored.flags.writeable:
+                colored = colored.copy()
+            return colored
+
+        canvas = np.zeros_like(frame)
+        for x1, y1, x2, y2 in self.get_rois(frame.shape):
+            crop = np.ascontiguousarray(frame[y1:y2, x1:x2])
+            colored = self.segmenter.predict(crop).colored
+            if colored.shape[:2] != crop.shape[:2]:
+                colored = cv2.resize(colored, (x2 - x1, y2 - y1),
+                                     interpolation=cv2.INTER_NEAREST)
+            canvas[y1:y2, x1:x2] = colored
+        return canvas
+
+    def get_rois(self, frame_shape):
+        """Get the crops to segment for frames of this shape"""
+        key = tuple(frame_shape[:2])
+        if key not in self._rois:
+            polygons = [s.cam_points for s in self.prj.surfaces]
+            self._rois[key] = get_polygon_rois(
+                polygons, frame_shape, padding=self.ROI_PADDING,
+                merge=self.crop_mode == self.CROP_UNION)
+        return self._rois[key]
+
+    def _count_frame(self, skipped=False, propagated=False):
+        """Count a frame as skipped (nothing moved), propagated from the last
+        keyframe, or inferred"""
+        if skipped:
+            self.frames_skipped += 1
+        elif propagated:
+            self.frames_propagated += 1
+        else:
+            self.frames_inferred += 1
+        total = (self.frames_skipped + self.frames_propagated +
+                 self.frames_inferred)
+        metrics.set_gauge("demo.inference_skip_ratio",
+                          self.frames_skipped / total)
+        metrics.set_gauge("demo.propagated_ratio",
+                          self.frames_propagated / total)
+
+    def motion_detected(self, frame):
+        """Return True if anything moved on a surface since recent frames"""
+        return self.motion_detector.update(frame) > self.MOTION_THRESH
+
     def alert_robot(self):
         if self.device:
             self.device.set_person_status(self.is_person)
 
-    def draw_predictions(self, detection_frame, canvas_frame):
+    def draw_predictions(self, detection_frame, canvas_frame, tstamp=None):
         if self.detector is None: return canvas_frame
 
-        det_preds = self.detector.predict([detection_frame])[0]
+        if self.detection_worker is not None:
+            # Never wait on the detector, just draw whatever it found last.
+            # Velocities are estimated from when frames were captured, not
+            # from when they got here.
+            self.detection_worker.submit(detection_frame, tstamp)
+            det_preds = self.detection_worker.latest()
+        else:
+            with metrics.timer("detector.predict"):
+                det_preds = self.detector.predict([detection_frame])[0]
+        if not len(det_preds): return canvas_frame
+
+        # The canvas may be kept as a segmentation keyframe, so draw on a copy
+        canvas_frame = canvas_frame.copy()
 
         # Draw the labels onto the empty frame
         for pred in det_preds:
@@ -82,25 +371,87 @@ class Demo:
         return canvas_frame
 
 
+def copy_warped(warped):
+    """Copy a warped frame, or each frame of a ProjectorGroup's list"""
+    if isinstance(warped, list):
+        return [frame.copy() for frame in warped]
+    return warped.copy()
 
-def main(args):
-    cam = Camera(1)
-    projector = Projector(1)
-    projector.load_configuration(args.calibration_path)
-
-    segmenter_brain = DeeplabImageSegmenter.from_path(args.segment_path,
-                                                      args.segment_map)
-
-    detector_brain = None  # ObjectDetector.from_path(args.detector_path, args.detector_labels)
 
-    device = Device(args.device_port)
+def main(args):
+    # Capture in its own process, so it doesn't compete for the GIL. The
+    # ring needs a slot to capture into besides every frame the Demo holds.
+    held = Demo.frames_held(args.pipelined, args.detection_rate is not None)
+    cam = SharedMemoryCamera(1, slots=held + 1) if args.processes \
+        else Camera(1)
+    if len(args.projectors) > 1:
+        # Every projector warps the same camera frames in parallel
+        projector = ProjectorGroup.from_screens(args.projectors,
+                                                args.calibration_path,
+                                                fullscreen=args.fullscreen)
+    else:
+        # The Demo copies warped frames wherever it keeps them around
+        projector = Projector(args.projectors[0], reuse_buffers=True,
+                              fullscreen=args.fullscreen)
+        projector.load_configuration(args.calibration_path[0])
+
+    if args.inference_socket:
+        # Share the models loaded by a running inference_service.py
+        client = InferenceClient(args.inference_socket)
+        segmenter_brain = RemoteSegmenter(client)
+        detector_brain = RemoteDetector(client)
+    else:
+        # Imported here so the Demo class can be used without the models
+        from easyinference.models import DeeplabImageSegmenter, ObjectDetector
+
+        if args.processes:
+            segmenter_brain = ProcessSegmenter(
+                partial(DeeplabImageSegmenter.from_path, args.segment_path,
+                        args.segment_map),
+                max_shape=cam.read()[1].shape)
+        else:
+            segmenter_brain = DeeplabImageSegmenter.from_path(
+                args.segment_path, args.segment_map)
+
+        detector_brain = ObjectDetector.from_path(args.detector_path,
+                                                  args.detector_labels)
+
+    device = Device(args.device_port, protocol=args.device_protocol)
+
+    exporter = None
+    if args.metrics_file:
+        metrics.enable()
+        exporter = MetricsExporter(metrics, args.metrics_file,
+                                   fmt=args.metrics_format,
+                                   interval=args.metrics_interval)
 
     demo = Demo(camera=cam,
                 projector=projector,
                 segmentation_brain=segmenter_brain,
                 detector_brain=detector_brain,
-                device=device)
-    demo.run()
+                device=device,
+                crop_mode=args.crop_mode,
+                keyframe_interval=args.keyframe_interval,
+                keyframe_period=args.keyframe_period,
+                detection_rate=args.detection_rate,
+                present_fps=args.present_fps)
+    if args.latency_probe:
+        # Time the full loop, including the work done on every frame
+        probe = LatencyProbe(cam, projector)
+        try:
+            report = probe.run(args.latency_probe, process=demo.label_frame)
+            print(json.dumps(report, indent=2))
+        finally:
+            demo.close()
+    elif args.pipelined:
+        demo.run_pipelined()
+    else:
+        demo.run()
+
+    if isinstance(segmenter_brain, ProcessSegmenter):
+        segmenter_brain.close()
+    if exporter:
+        exporter.close()
 
 
 if __name__ == "__main__":
@@ -117,12 +468,67 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--detector-labels", type=str, required=True,
                         help="The path to the labels.json for the Detection model")
 
-    parser.add_argument("-c", "--calibration-path", type=str, required=True,
+    parser.add_argument("-c", "--calibration-path", type=str, nargs="+", required=True,
                         help="The path to the calibration.json file for the projector mapping to work." \
-                             "If this argument is absent, the projector will re-calibrate.")
+                             "If this argument is absent, the projector will re-calibrate." \
+                             "With several projectors, give one file per projector.")
+    parser.add_argument("--projectors", type=int, nargs="+", default=[1],
+                        help="The monitor ID of every projector to drive.")
+
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Run capture, inference and warping on separate "
+                             "threads.")
+
+    parser.add_argument("--present-fps", type=float, default=None,
+                        help="Present frames to the projector at this steady "
+                             "rate, always showing the newest frame.")
+    parser.add_argument("--fullscreen", action="store_true",
+                        help="Make the projector window fullscreen instead "
+                             "of shifting it to hide the window borders.")
+
+    parser.add_argument("--processes", action="store_true",
+                        help="Capture frames and run segmentation in separate "
+                             "processes, sharing frames through shared memory.")
 
     parser.add_argument("-d", "--device_port", type=str, required=True,
                         help="The path to the calibration.json file for the projector mapping to work." \
                              "If this argument is absent, the projector will re-calibrate.")
+    parser.add_argument("--device-protocol", type=str,
+                        default=Device.PROTOCOL_ASCII,
+                        choices=[Device.PROTOCOL_ASCII, Device.PROTOCOL_V2],
+                        help="The wire protocol the device's firmware speaks.")
+    parser.add_argument("--inference-socket", type=str, default=None,
+                        help="If set, run the models on the inference_service.py "
+                             "listening on this socket instead of loading them.")
+    parser.add_argument("--crop-mode", type=str, default=Demo.CROP_NONE,
+                        choices=[Demo.CROP_UNION, Demo.CROP_SURFACES],
+                        help="Only segment crops around the calibrated "
+                             "surfaces, either one crop around all of them "
+                             "or one per surface.")
+    parser.add_argument("--keyframe-interval", type=int, default=None,
+                        help="Segment every Nth frame, and carry the mask "
+                             "forward with optical flow in between.")
+    parser.add_argument("--keyframe-period", type=float, default=None,
+                        help="Also segment whenever this many seconds have "
+                             "passed since the last segmented frame.")
+    parser.add_argument("--detection-rate", type=float,
+                        default=Demo.DETECTION_RATE,
+                        help="Times per second to run object detection in the "
+                             "background. The newest detections are overlaid "
+                             "on every frame.")
+    parser.add_argument("--latency-probe", type=int, default=None,
+                        help="Instead of running the demo, project a counter "
+                             "this many times and report how long it takes "
+                             "to come back through the camera.")
+    parser.add_argument("--metrics-file", type=str, default=None,
+                        help="If set, timing metrics are recorded, drawn on the "
+                             "Labels window, and periodically saved here.")
+    parser.add_argument("--metrics-format", type=str, default="json",
+                        choices=["json", "prometheus"],
+                        help="Save metrics as JSON or a Prometheus textfile.")
+    parser.add_argument("--metrics-interval", type=float, default=5,
+                        help="Seconds between metrics file updates.")
     args = parser.parse_args()
+    if len(args.calibration_path) != len(args.projectors):
+        parser.error("Give one --calibration-path per projector")
     main(args)
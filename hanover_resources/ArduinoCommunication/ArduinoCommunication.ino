@@ -3,11 +3,19 @@ String send1 = "";
 String sendInfo = "";
 char READ_UNTIL = ':';
 
+// Protocol v2 (see hanover_resources/protocol.py)
+// START | seq | cmd | length | payload | checksum (XOR of seq..payload)
+const byte FRAME_START = 0xA5;
+const byte CMD_SET_SIGNAL = 0x01;
+const byte CMD_ACK = 0x81;
+const byte MAX_PAYLOAD = 32;
+const byte SIGNAL_PERSON = 0;
+
 // Output variables
 int LED_PIN = 13;
 int personInView = 0;
 
-void setup() 
+void setup()
 {
   Serial.begin(9600);  // start serial port at 9600 bps
   Serial.setTimeout(10); //Super important. Makes Serial.parseInt() not wait a long time after an integer has ended.
@@ -15,14 +23,66 @@ void setup()
 }
 
 
+void setSignal(byte signalId, float value){
+  if(signalId == SIGNAL_PERSON){
+    personInView = value;
+  }
+}
+
+
+void readFrame(){
+  // Read a v2 frame, whose START byte is waiting in the buffer
+  byte header[4];
+  if(Serial.readBytes(header, 4) < 4) return;
+  byte seq = header[1];
+  byte cmd = header[2];
+  byte length = header[3];
+  if(length > MAX_PAYLOAD) return;
+
+  byte payload[MAX_PAYLOAD];
+  byte check;
+  if(Serial.readBytes(payload, length) < length) return;
+  if(Serial.readBytes(&check, 1) < 1) return;
+
+  byte sum = seq ^ cmd ^ length;
+  for(byte i = 0; i < length; i++){
+    sum ^= payload[i];
+  }
+  if(sum != check) return;
+
+  if(cmd == CMD_SET_SIGNAL && length == 5){
+    float value;
+    memcpy(&value, payload + 1, 4);
+    setSignal(payload[0], value);
+  }
+
+  // Acknowledge with the same sequence ID and payload
+  byte ackSum = seq ^ CMD_ACK ^ length;
+  for(byte i = 0; i < length; i++){
+    ackSum ^= payload[i];
+  }
+  Serial.write(FRAME_START);
+  Serial.write(seq);
+  Serial.write(CMD_ACK);
+  Serial.write(length);
+  Serial.write(payload, length);
+  Serial.write(ackSum);
+}
+
+
 void loop()
 {
   while(Serial.available() > 0){
+    if(Serial.peek() == FRAME_START){
+      readFrame();
+      continue;
+    }
+
     String var = Serial.readStringUntil(READ_UNTIL);
     float value = Serial.parseFloat();
 
     if(var.equals("person")){
-      personInView = value;
+      setSignal(SIGNAL_PERSON, value);
       Serial.println("[OK: " + String(value) + "]");
     }
   }
@@ -33,9 +93,4 @@ void loop()
   }else{
     digitalWrite(LED_PIN, LOW);
   }
-} 
-
-
-
-
-
+}
@@ -1,34 +1,251 @@
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import BoundedSemaphore, Lock, Thread
+from time import sleep, time
+
 import serial
 import serial.tools.list_ports
-from time import sleep
+
+from hanover_resources import protocol as wire
+from utils.metrics import metrics
 
 
 class Device:
     """
       This is a library for controlling uArms that have uFactories communication protocol of version 0.9.6
+
+      Commands are queued and sent by a background I/O thread, so callers
+      never wait on the serial link. Each queued command returns a Future
+      that resolves to the robots response.
+
+      Two wire protocols are supported. PROTOCOL_ASCII sends "person:1" and
+      waits for a "[OK: 1.00]" reply before sending the next command.
+      PROTOCOL_V2 sends framed binary commands with sequence IDs (see
+      hanover_resources.protocol), so several can be in flight at once.
+      Both take the same "name:value" commands.
     """
+    PROTOCOL_ASCII = "ascii"
+    PROTOCOL_V2 = "v2"
+    RESPONSE_TIMEOUT = 1  # Seconds before an unanswered command fails
 
-    def __init__(self, port):
+    def __init__(self, port, heartbeat=None, protocol=PROTOCOL_ASCII,
+                 max_in_flight=8, reset_delay=3):
         """
-        :param port: The COM port that the robot is plugged in to.
+        :param port: The COM port that the robot is plugged in to. Any pyserial
+        URL works too, such as "loop://" for testing.
+        :param heartbeat: If set, the person status is re-sent every this many
+        seconds even if it hasn't changed. Otherwise it's only sent on change.
+        :param protocol: Device.PROTOCOL_ASCII or Device.PROTOCOL_V2
+        :param max_in_flight: How many v2 commands can await a response
+        :param reset_delay: Seconds to wait for the Arduino to reset after the
+        port is opened
         """
+        if protocol not in (self.PROTOCOL_ASCII, self.PROTOCOL_V2):
+            raise ValueError("Unknown protocol: " + str(protocol))
+        self.protocol = protocol
+
         self._serial = None  # The serial connection to the robot
-        self._connect_to_robot(port)
+        self._connect_to_robot(port, reset_delay)
         print("Connected to robot.")
 
+        # State for the v2 protocol
+        self._seq = 0
+        self._parser = wire.FrameParser()
+        self._pending = {}  # {seq: (sent_time, future)}
+        self.bad_frames = 0  # Valid frames that weren't a usable response
+        self._pending_lock = Lock()
+        self._in_flight = BoundedSemaphore(max_in_flight)
+
+        self.heartbeat = heartbeat
+        self._commands = Queue()
+        self._status_lock = Lock()
+        self._person_status = None  # The last person status queued
+        self._status_future = None
+        self._status_sent_at = 0
+
+        self._running = True
+        self._io_thread = Thread(target=self._io_loop, daemon=True)
+        self._io_thread.start()
+        self._read_thread = None
+        if self.protocol == self.PROTOCOL_V2:
+            self._read_thread = Thread(target=self._read_loop, daemon=True)
+            self._read_thread.start()
+
     # Functions that are only used inside of this library
-    def _connect_to_robot(self, port):
-        self._serial = serial.Serial(port=port,
-                                     baudrate=9600,
-                                     parity=serial.PARITY_NONE,
-                                     stopbits=serial.STOPBITS_ONE,
-                                     bytesize=serial.EIGHTBITS,
-                                     timeout=.1)
-        sleep(3)
+    def _connect_to_robot(self, port, reset_delay):
+        self._serial = serial.serial_for_url(port,
+                                             baudrate=9600,
+                                             parity=serial.PARITY_NONE,
+                                             stopbits=serial.STOPBITS_ONE,
+                                             bytesize=serial.EIGHTBITS,
+                                             timeout=.1)
+        sleep(reset_delay)
 
     def set_person_status(self, person_there: bool):
-        cmd = "person:" + str(int(person_there))
-        self._send_and_receive(cmd)
+        """
+        Queue the person status to be sent to the robot, if it has changed.
+        :return: A Future for the response to the most recent status command
+        """
+        with self._status_lock:
+            if person_there != self._person_status:
+                self._person_status = person_there
+                self._status_future = self.send_command(
+                    self._person_status_cmnd(person_there))
+            return self._status_future
+
+    def send_command(self, cmnd, callback=None):
+        """
+        Queue a command to be sent by the I/O thread without waiting on it.
+        :param cmnd: a String command, to send to the robot
+        :param callback: Optionally, a function called with the Future once
+        the response has arrived
+        :return: A Future that resolves to the robots response
+        """
+        if not self._running:
+            raise IOError("Cannot send commands to a closed Device!")
+
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        self._commands.put((cmnd, future))
+        return future
+
+    def close(self):
+        """ Send every queued command, then close the serial connection """
+        self._running = False
+        self._commands.put(None)
+        self._io_thread.join()
+        if self._read_thread is not None:
+            self._read_thread.join()
+        self._serial.close()
+
+    @staticmethod
+    def _person_status_cmnd(person_there):
+        return "person:" + str(int(person_there))
+
+    def _io_loop(self):
+        """ Send queued commands one at a time, and re-send the person status
+        whenever the heartbeat runs out """
+        while True:
+            try:
+                item = self._commands.get(timeout=self._heartbeat_timeout())
+            except Empty:
+                with self._status_lock:
+                    item = (self._person_status_cmnd(self._person_status),
+                            Future())
+            if item is None:
+                break
+
+            cmnd, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if cmnd.startswith("person:"):
+                self._status_sent_at = time()
+
+            try:
+                with metrics.timer("device.send"):
+                    if self.protocol == self.PROTOCOL_V2:
+                        self._send_frame(cmnd, future)
+                    else:
+                        future.set_result(self._send_and_receive(cmnd))
+            except Exception as e:
+                metrics.increment("device.errors")
+                future.set_exception(e)
+
+    def _heartbeat_timeout(self):
+        """ How long the I/O thread can wait before a heartbeat is due """
+        if self.heartbeat is None or self._person_status is None:
+            return None
+        return max(0, self._status_sent_at + self.heartbeat - time())
+
+    def _send_frame(self, cmnd, future):
+        """
+        Send a command using the v2 protocol, without waiting for a response.
+        The future is resolved by the read thread once the response arrives.
+        :param cmnd: a String command such as "person:1"
+        """
+        payload = wire.parse_ascii_command(cmnd)
+
+        # Limit how many commands can be outstanding at once
+        self._in_flight.acquire()
+        with self._pending_lock:
+            seq = self._seq
+            self._seq = (self._seq + 1) % 256
+            self._pending[seq] = (time(), future)
+
+        try:
+            self._serial.write(wire.encode_frame(seq, wire.CMD_SET_SIGNAL,
+                                                 payload))
+        except serial.serialutil.SerialException:
+            print("Communication| ERROR while sending command ", cmnd,
+                  ". Disconnecting Serial!")
+            self._resolve(seq)
+            raise
+
+    def _read_loop(self):
+        """ Read v2 responses and resolve the futures waiting on them, until
+        the device is closed and nothing is left in flight """
+        while self._running or self._pending or self._io_thread.is_alive():
+            try:
+                data = self._serial.read(max(1, self._serial.in_waiting))
+            except serial.serialutil.SerialException as e:
+                print("Communication| ERROR ", e, "while reading responses. "
+                                                  "Disconnecting Serial!")
+                self._fail_pending(e)
+                raise
+
+            for seq, cmd, payload in self._parser.feed(data):
+                # Anything that isn't a well formed ack (such as our own
+                # command echoed back) is dropped, and its command left to
+                # time out, rather than ending the read thread
+                if cmd != wire.CMD_ACK:
+                    self._bad_frame("Unexpected command {:#04x}".format(cmd))
+                    continue
+                try:
+                    _, value = wire.decode_signal(payload)
+                except ValueError as e:
+                    self._bad_frame(e)
+                    continue
+
+                future = self._resolve(seq, observe=True)
+                if future is not None:
+                    future.set_result("OK:{:.2f}".format(value))
+
+            # Fail anything that has waited too long for a response
+            now = time()
+            with self._pending_lock:
+                expired = [seq for seq, (sent, _) in self._pending.items()
+                           if now - sent > self.RESPONSE_TIMEOUT]
+            for seq in expired:
+                future = self._resolve(seq)
+                if future is not None:
+                    metrics.increment("device.timeouts")
+                    future.set_exception(
+                        TimeoutError("No response to command " + str(seq)))
+
+    def _bad_frame(self, reason):
+        self.bad_frames += 1
+        metrics.increment("device.bad_frames")
+        print("Communication| Skipping bad response frame:", reason)
+
+    def _resolve(self, seq, observe=False):
+        """ Stop tracking an in-flight command and return its future
+        :param observe: If True, record the commands round trip time """
+        with self._pending_lock:
+            sent, future = self._pending.pop(seq, (None, None))
+        if future is not None:
+            self._in_flight.release()
+            if observe:
+                metrics.observe("device.round_trip", time() - sent)
+        return future
+
+    def _fail_pending(self, error):
+        with self._pending_lock:
+            seqs = list(self._pending)
+        for seq in seqs:
+            future = self._resolve(seq)
+            if future is not None:
+                future.set_exception(error)
 
     def _send_and_receive(self, cmnd):
         """
@@ -51,24 +268,21 @@ class Device:
             raise
 
         # Read the response from the robot (THERE MUST ALWAYS BE A RESPONSE!)
-        response = ""
-        while True:
+        # If it never comes, fail the command instead of blocking forever
+        deadline = time() + self.RESPONSE_TIMEOUT
+        response = b""
+        while b"]" not in response:
+            if time() > deadline:
+                metrics.increment("device.timeouts")
+                raise TimeoutError("No response to command " + cmnd)
             try:
-                response += str(self._serial.read(), 'ascii')
-                response = response.replace(' ', '')
-
+                response += self._serial.read_until(b"]")
             except serial.serialutil.SerialException as e:
                 print("Communication| ERROR ", e, "while sending command ",
                       cmnd, ". Disconnecting Serial!")
                 raise
 
-            if "[" in response and "]" in response:
-                response = str(response.replace("\n", ""))
-                response = str(response.replace("\r", ""))
-                break
-
         # Clean up the response
-        response = response.replace("[", "")
-        response = response.replace("]", "")
-
-        return response
+        response = str(response, 'ascii')
+        response = response[response.rfind("[") + 1:response.rfind("]")]
+        return response.replace(" ", "")
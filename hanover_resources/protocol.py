@@ -0,0 +1,112 @@
+"""
+Framed binary protocol (v2) for the robot serial link.
+
+Every frame, in both directions, looks like this:
+
+    START | seq | cmd | length | payload (length bytes) | checksum
+
+START is 0xA5, seq is a rolling sequence ID that the response echoes back so
+several commands can be in flight at once, and checksum is the XOR of every
+byte between START and the checksum itself.
+
+CMD_SET_SIGNAL carries a signal ID byte followed by a little endian float32
+value. The Arduino answers with CMD_ACK and the same payload.
+"""
+import struct
+
+START = 0xA5
+HEADER_SIZE = 4  # START, seq, cmd, length
+MAX_PAYLOAD = 32  # Longer lengths are treated as corruption
+
+CMD_SET_SIGNAL = 0x01
+CMD_ACK = 0x81
+
+# The names used by the ASCII protocol ("person:1"), mapped to signal IDs
+SIGNALS = {"person": 0}
+
+_SIGNAL_FORMAT = "<Bf"
+SIGNAL_SIZE = struct.calcsize(_SIGNAL_FORMAT)
+
+
+def checksum(data):
+    result = 0
+    for byte in data:
+        result ^= byte
+    return result
+
+
+def encode_frame(seq, cmd, payload=b""):
+    """ Build a single frame, ready to be written to the serial port """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("Payload is too large for a single frame!")
+    body = bytes([seq & 0xFF, cmd, len(payload)]) + bytes(payload)
+    return bytes([START]) + body + bytes([checksum(body)])
+
+
+def encode_signal(signal_id, value):
+    return struct.pack(_SIGNAL_FORMAT, signal_id, value)
+
+
+def decode_signal(payload):
+    """ :return: (signal_id, value) """
+    if len(payload) != SIGNAL_SIZE:
+        raise ValueError("Signal payloads must be {} bytes, got {}".format(
+            SIGNAL_SIZE, len(payload)))
+    return struct.unpack(_SIGNAL_FORMAT, payload)
+
+
+def parse_ascii_command(cmnd):
+    """ Turn an ASCII protocol command like "person:1" into the payload of a
+    CMD_SET_SIGNAL frame """
+    name, value = cmnd.split(":")
+    if name not in SIGNALS:
+        raise ValueError("Unknown signal: " + name)
+    return encode_signal(SIGNALS[name], float(value))
+
+
+class FrameParser:
+    """ Incrementally pulls frames out of a byte stream. Bytes can be fed in
+    chunks of any size, and corrupt frames are skipped by resynchronizing on
+    the next START byte. """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.corrupt_frames = 0
+
+    def feed(self, data):
+        """
+        :param data: Bytes read from the serial port
+        :return: A list of (seq, cmd, payload) for every complete frame
+        """
+        self._buffer += data
+        frames = []
+
+        while True:
+            start = self._buffer.find(START)
+            if start < 0:
+                self._buffer.clear()
+                break
+            del self._buffer[:start]
+
+            if len(self._buffer) < HEADER_SIZE:
+                break
+            length = self._buffer[3]
+            if length > MAX_PAYLOAD:
+                self.corrupt_frames += 1
+                del self._buffer[:1]
+                continue
+            frame_size = HEADER_SIZE + length + 1
+            if len(self._buffer) < frame_size:
+                break
+
+            body = bytes(self._buffer[1:frame_size - 1])
+            if checksum(body) != self._buffer[frame_size - 1]:
+                # Skip this START byte, and look for the next frame
+                self.corrupt_frames += 1
+                del self._buffer[:1]
+                continue
+
+            frames.append((body[0], body[1], body[3:]))
+            del self._buffer[:frame_size]
+
+        return frames
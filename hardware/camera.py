@@ -1,29 +1,54 @@
 from time import time
 
 import cv2
-from threading import Thread
+from threading import Condition, Thread
+
+from hardware.recorder import VideoRecorder
+from utils.metrics import metrics
 
 
 class Camera(Thread):
     """ A threaded camera class that constantly grabs frames and serves them
-    from the camera.read() function """
+    from the camera.read() function. Every frame is given a sequence number,
+    so consumers can block on camera.read_next() until a new frame lands. """
 
-    def __init__(self, cam_id, record_to=None):
+    def __init__(self, cam_id, record_to=None, record_queue=32,
+                 record_drop_policy=VideoRecorder.DROP_OLDEST):
+        """
+        :param cam_id: The cv2.VideoCapture ID or path to open. An already
+        opened capture (anything with read() and release()) works too.
+        :param record_to: If set, every frame is recorded to this video file
+        :param record_queue: How many frames can wait to be encoded
+        :param record_drop_policy: What the recorder does when its queue is
+        full. See VideoRecorder for the options.
+        """
         super().__init__()
-        self.cap = cv2.VideoCapture(cam_id)
+        if hasattr(cam_id, "read"):
+            self.cap = cam_id
+        else:
+            self.cap = cv2.VideoCapture(cam_id)
         self.running = True
         self.latest_frame = None
         self.show_screen = False
         self.window_name = "Camera View"
 
-        # Recording Video
-        self.writer = None
+        # Recording Video. Encoding happens on the recorders own thread.
+        self.recorder = None
         self.record_to = record_to
+        if record_to is not None:
+            self.recorder = VideoRecorder(record_to,
+                                          max_queue=record_queue,
+                                          drop_policy=record_drop_policy)
+
+        # Notifies read_next() callers whenever a new frame is cached
+        self._new_frame = Condition()
+        self.latest_seq = 0
 
         ret, frame = self.cap.read()
         if not ret: raise IOError("Unable to get frames from camera!")
         self.latest_frame = frame
         self.latest_tstamp = time()
+        self.latest_seq = 1
 
         # Start the main camera loop
         self.start()
@@ -31,30 +56,53 @@ class Camera(Thread):
     def run(self):
         """Constantly grab frames from the camera and cache them"""
         while self.running:
-            ret, frame = self.cap.read()
+            with metrics.timer("camera.capture"):
+                ret, frame = self.cap.read()
             if not ret:
                 print("Camera stopped returning frames! Ending camera thread.")
                 break
-            self.latest_tstamp = time()
-            self.latest_frame = frame
-
-            if self.record_to is not None:
-                if self.writer is None:
-                    h, w = frame.shape[:2]
-                    fourcc = cv2.VideoWriter_fourcc(*"MJPG")
-                    self.writer = cv2.VideoWriter(self.record_to, fourcc, 24,
-                                                  (w, h),
-                                                  True)
-                self.writer.write(frame)
+
+            with self._new_frame:
+                self.latest_tstamp = time()
+                self.latest_frame = frame
+                self.latest_seq += 1
+                self._new_frame.notify_all()
+            metrics.tick("camera.frames")
+
+            if self.recorder is not None:
+                self.recorder.record(frame)
 
             if self.show_screen:
                 cv2.imshow(self.window_name, frame)
 
+        # Wake up anyone waiting on a frame that will never come
+        with self._new_frame:
+            self.running = False
+            self._new_frame.notify_all()
+
     def read(self):
         """Return the latest frame and timestamp from the camera"""
         latest = self.latest_frame
         return self.latest_tstamp, latest.copy()
 
+    def read_next(self, after_seq, timeout=None):
+        """Block until a frame newer than after_seq is available.
+        :param after_seq: The sequence number of the last frame processed.
+        Pass the seq returned by the previous call, or 0 to get any frame.
+        :param timeout: Seconds to wait, or None to wait forever
+        :return: (seq, timestamp, frame), or None if the timeout ran out or
+        the camera stopped before a new frame arrived
+        """
+        with self._new_frame:
+            got_frame = self._new_frame.wait_for(
+                lambda: self.latest_seq > after_seq or not self.running,
+                timeout)
+            if not got_frame or self.latest_seq <= after_seq:
+                return None
+            seq, tstamp = self.latest_seq, self.latest_tstamp
+            frame = self.latest_frame
+        return seq, tstamp, frame.copy()
+
     def show(self):
         """Show the current camera view to screen """
         cv2.namedWindow(self.window_name)
@@ -67,8 +115,10 @@ class Camera(Thread):
 
     def close(self):
         """Stop the thread and close the camera capture"""
-        self.running = False
+        with self._new_frame:
+            self.running = False
+            self._new_frame.notify_all()
         self.join()
         self.cap.release()
-        if self.writer:
-            self.writer.release()
+        if self.recorder:
+            self.recorder.close()
@@ -0,0 +1,112 @@
+"""
+A binary, precompiled form of a calibration JSON file, so that a projector
+can start up without recomputing anything.
+
+Alongside the surfaces' homographies, the file holds everything derived from
+them that is expensive to build: each surface's polygon mask and the remap
+tables that warp camera frames to the projector, for every camera frame size
+that has been compiled so far. The file records a format version, a hash of
+the JSON it was compiled from, and the projector resolution, and is ignored
+if any of them no longer match.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from hardware.surface import Surface
+
+VERSION = 1
+
+
+def config_hash(filename):
+    """ :return: A hash of a calibration JSON file's contents """
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def default_path(config_filename):
+    """ Where the compiled form of a calibration JSON file is kept """
+    return os.path.splitext(config_filename)[0] + ".compiled.npz"
+
+
+def _size_key(size):
+    return "{}x{}".format(*size)
+
+
+def _parse_size_key(key):
+    return tuple(int(v) for v in key.split("x"))
+
+
+def save(filename, hash_, resolution, surfaces, remap_tables):
+    """
+    Write a compiled calibration. The file is written atomically, so a
+    projector starting up never reads a half-written one.
+    :param hash_: The config_hash() of the JSON the surfaces came from
+    :param resolution: The (width, height) of the projector
+    :param surfaces: The list of Surfaces
+    :param remap_tables: {(cam_height, cam_width): (map1, map2)}
+    """
+    arrays = {"version": np.int64(VERSION),
+              "config_hash": np.array(hash_),
+              "resolution": np.int64(resolution),
+              "surface_count": np.int64(len(surfaces))}
+
+    for i, surface in enumerate(surfaces):
+        prefix = "surface{}_".format(i)
+        arrays[prefix + "cam_points"] = surface.cam_points
+        arrays[prefix + "prj_points"] = surface.prj_points
+        arrays[prefix + "to_camera"] = surface._to_camera_mat
+        arrays[prefix + "to_projector"] = surface._to_projector_mat
+        for size, mask in surface._cam_masks.items():
+            arrays[prefix + "mask_" + _size_key(size)] = mask
+
+    for size, (map1, map2) in remap_tables.items():
+        arrays["remap_{}_map1".format(_size_key(size))] = map1
+        arrays["remap_{}_map2".format(_size_key(size))] = map2
+
+    # Uncompressed, since decompressing would cost more than reading
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_name, filename)
+
+
+def load(filename, hash_, resolution):
+    """
+    Read a compiled calibration, if it's still valid.
+    :param hash_: The config_hash() of the JSON file it should match
+    :param resolution: The (width, height) of the projector it should match
+    :return: (surfaces, remap_tables), or None if the file is missing or
+    was compiled from a different JSON, resolution or format version
+    """
+    if not os.path.exists(filename):
+        return None
+
+    with np.load(filename) as data:
+        if int(data["version"]) != VERSION or \
+                str(data["config_hash"]) != hash_ or \
+                tuple(data["resolution"]) != tuple(resolution):
+            return None
+
+        surfaces = []
+        for i in range(int(data["surface_count"])):
+            prefix = "surface{}_".format(i)
+            surface = Surface(data[prefix + "cam_points"],
+                              data[prefix + "prj_points"],
+                              to_camera_mat=data[prefix + "to_camera"],
+                              to_projector_mat=data[prefix + "to_projector"])
+            for name in data.files:
+                if name.startswith(prefix + "mask_"):
+                    size = _parse_size_key(name[len(prefix + "mask_"):])
+                    surface._cam_masks[size] = data[name]
+            surfaces.append(surface)
+
+        remap_tables = {}
+        for name in data.files:
+            if name.startswith("remap_") and name.endswith("_map1"):
+                key = name[len("remap_"):-len("_map1")]
+                remap_tables[_parse_size_key(key)] = (
+                    data[name], data["remap_{}_map2".format(key)])
+
+    return surfaces, remap_tables
@@ -0,0 +1,118 @@
+from threading import Lock, Thread
+from time import perf_counter, sleep
+
+from utils.metrics import metrics
+
+
+class Presenter:
+    """ Paces frames out to a display at a fixed refresh rate. Frames can be
+    submitted at any time, but are only presented on refresh deadlines, and
+    only the newest one is shown: a frame that gets replaced before its
+    deadline is dropped instead of being shown late.
+
+    It can be driven from an existing loop with present_if_due(), blocking
+    with wait_and_present(), or from its own thread with start(). """
+
+    def __init__(self, sink, fps=60, clock=perf_counter, sleeper=sleep):
+        """
+        :param sink: A function that displays a frame, such as
+        lambda frame: projector.render(frame, wait=False)
+        :param fps: The target refresh rate
+        :param clock: A function returning the current time in seconds.
+        Tests can pass a fake clock, along with a matching sleeper.
+        :param sleeper: A function that sleeps for some seconds
+        """
+        self.sink = sink
+        self.period = 1 / fps
+        self.clock = clock
+        self.sleeper = sleeper
+
+        self._lock = Lock()
+        self._pending = None  # (frame, time submitted)
+        self._deadline = None
+        self._thread = None
+        self._running = False
+
+        # Statistics
+        self.presented = 0  # Frames shown
+        self.dropped = 0  # Frames replaced by a newer one before being shown
+        self.missed = 0  # Deadlines that passed without presenting
+        self.repeats = 0  # Deadlines with no new frame, so the old one stays
+
+    def submit(self, frame):
+        """ Queue a frame for the next deadline, replacing any frame that
+        hasn't been presented yet. Never blocks. """
+        with self._lock:
+            if self._pending is not None:
+                self.dropped += 1
+                metrics.increment("presenter.dropped")
+            self._pending = (frame, self.clock())
+
+    def time_until_due(self):
+        """ :return: Seconds until the next deadline, or 0 if it's passed """
+        if self._deadline is None:
+            return 0
+        return max(self._deadline - self.clock(), 0)
+
+    def present_if_due(self):
+        """ Present the newest frame if its deadline has come.
+        :return: True if a deadline was handled """
+        now = self.clock()
+        if self._deadline is None:
+            self._deadline = now
+        if now < self._deadline:
+            return False
+
+        # If presenting is running late, skip the slots that were missed
+        # rather than rushing through them
+        late = now - self._deadline
+        metrics.observe("presenter.lateness", late)
+        if late >= self.period:
+            skipped = int(late // self.period)
+            self.missed += skipped
+            metrics.increment("presenter.missed", skipped)
+            self._deadline += skipped * self.period
+        self._deadline += self.period
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None:
+            self.repeats += 1
+            return True
+
+        frame, submitted = pending
+        self.sink(frame)
+        self.presented += 1
+        metrics.observe("presenter.wait", now - submitted)
+        metrics.tick("presenter.frames")
+        return True
+
+    def wait_and_present(self):
+        """ Sleep until the next deadline, then present """
+        wait = self.time_until_due()
+        if wait > 0:
+            self.sleeper(wait)
+        self.present_if_due()
+
+    @property
+    def stats(self):
+        return {"presented": self.presented,
+                "dropped": self.dropped,
+                "missed": self.missed,
+                "repeats": self.repeats}
+
+    def start(self):
+        """ Present from a background thread. Only use this with sinks that
+        are safe to call off of the main thread. """
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            self.wait_and_present()
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
@@ -1,75 +1,302 @@
 import json
+from collections import namedtuple
 from random import shuffle
 
 import cv2
 import numpy as np
 import screeninfo
 
+from hardware import compiled_calibration
 from hardware.surface import Surface
+from utils.metrics import metrics
+
+# Stands in for a screeninfo monitor when there is no real screen
+HeadlessMonitor = namedtuple("HeadlessMonitor", ["x", "y", "width", "height"])
+
+
+def weighted_count(mask, weights):
+    """ Sum the weights of every nonzero pixel of a uint8 mask """
+    total = cv2.countNonZero(mask)
+    if total == 0:
+        return 0.0
+    # mean(weights over the masked pixels) * count = sum of the weights
+    return cv2.mean(weights, mask=mask)[0] * total
 
 
 class Projector:
-    # Shift the window so that the borders are not projected.
-    # TODO (Alex): Find something that can render fullscreen-borderless
+    # Shift the window so that the borders are not projected, when not
+    # running fullscreen
     WINDOW_Y_SHIFT = -35
 
-    def __init__(self, screen_id, surfaces=None):
+    def __init__(self, screen_id, surfaces=None, reuse_buffers=False,
+                 fullscreen=False, window_name="Projector_Window"):
         """
         :param screen_id: An integer number representing which monitor you
         want to project to.
         :param surfaces: A list of Surface objects representing what areas
         are projectable. These can be gotten using the configure_projector.py
         script.
+        :param reuse_buffers: If True, get_warped_frame writes into a
+        persistent buffer per (shape, dtype) instead of allocating a new
+        frame each call. The returned frame is then only valid until the next
+        call, so callers that keep frames around should copy them. It's off
+        by default because code that holds on to rendered frames, such as
+        HeadlessProjector.last_frame and SimulatedCapture's display delay,
+        would see them change underneath it.
+        :param fullscreen: If True, the window is made borderless and
+        fullscreen on the monitor, instead of shifted to hide its borders
+        :param window_name: The name of the cv2 window, which has to be
+        different for every Projector that's open at once
         """
 
-        self.monitor = screeninfo.get_monitors()[screen_id]
-        self.window_name = "Projector_Window"
+        self.monitor = self._get_monitor(screen_id)
+        self.window_name = window_name
+        self.fullscreen = fullscreen
+
+        # Compiled remap tables, keyed by the (height, width) of input frames
+        self._remap_cache = {}
+
+        # Area weights of all surfaces together, keyed by (size, stretch)
+        self._union_weights = {}
+
+        # Where newly compiled tables get saved, and the hash of the JSON they
+        # belong to. Only set while the surfaces match a loaded configuration.
+        self._compiled_path = None
+        self._config_hash = None
+
+        # Bumped whenever the surfaces change, so that anything built from
+        # them (here or in a ProjectorGroup) knows to rebuild
+        self.surfaces_version = 0
         self.surfaces = [] if surfaces is None else surfaces
 
+        # Persistent output frames, keyed by (shape, dtype). With one buffer,
+        # every warp overwrites the frame returned by the one before it.
+        self.reuse_buffers = reuse_buffers
+        self.buffers = 1
+        self._buffers = {}
+        self._empty_frame = None
+
+        self._open_window()
+
+    def _get_monitor(self, screen_id):
+        return screeninfo.get_monitors()[screen_id]
+
+    def _open_window(self):
+        if self.fullscreen:
+            cv2.namedWindow(self.window_name, cv2.WINDOW_NORMAL)
+            cv2.moveWindow(self.window_name, self.monitor.x, self.monitor.y)
+            cv2.setWindowProperty(self.window_name, cv2.WND_PROP_FULLSCREEN,
+                                  cv2.WINDOW_FULLSCREEN)
+            self.render(self.empty_frame)
+            return
+
         # Render a single frame to create the projector window
         self.render(self.empty_frame)
         cv2.moveWindow(self.window_name, self.monitor.x,
                        self.monitor.y + self.WINDOW_Y_SHIFT)
 
     def render(self, frame, wait=True):
-        cv2.imshow(self.window_name, frame)
-        if wait:
-            cv2.waitKey(1)
+        with metrics.timer("projector.render"):
+            cv2.imshow(self.window_name, frame)
+            if wait:
+                cv2.waitKey(1)
+        metrics.tick("projector.frames")
 
     def render_to_camera(self, frame, wait=True):
         """Draws a frame such that from the cameras perspective it's unwarped
         :param frame: A cv2 BGR frame
         :param wait: If true, it will render with cv2.waitKey(1) """
-        draw_frame = self.get_warped_frame(frame)
+        with metrics.timer("projector.warp"):
+            draw_frame = self.get_warped_frame(frame)
         self.render(draw_frame, wait=wait)
 
     def get_warped_frame(self, frame):
-        # Create an empty frame to draw all the warped surfaces onto
-        dims = (self.monitor.width, self.monitor.height)
+        """Warp a camera-space frame onto every surface in a single pass.
+        :param frame: A cv2 BGR or grayscale frame in camera coordinates
+        :return: A frame the size of the projector window """
+        if self.reuse_buffers:
+            out = self.get_buffer(self.output_shape(frame), frame.dtype)
+            return self.warp_into(frame, out)
 
-        # Chose the correct input type if frame is grayscale
-        if len(frame.shape) == 2:
-            draw_frame = np.zeros(dims[::-1], dtype=np.uint8)
-        else:
-            draw_frame = self.empty_frame
+        map1, map2 = self.compile_surfaces(frame.shape)
+        return cv2.remap(frame, map1, map2, cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def warp_into(self, frame, out):
+        """Same as get_warped_frame, but writes into a caller-supplied frame
+        :param frame: A cv2 BGR or grayscale frame in camera coordinates
+        :param out: A frame of shape output_shape(frame) and the same dtype
+        :return: out """
+        if out.shape != self.output_shape(frame) or out.dtype != frame.dtype:
+            raise ValueError("Output buffer must have shape {} and dtype {}"
+                             .format(self.output_shape(frame), frame.dtype))
+
+        map1, map2 = self.compile_surfaces(frame.shape)
+        cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, dst=out,
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return out
+
+    def output_shape(self, frame):
+        """ The shape of the projector frame that frame would be warped to """
+        return (self.monitor.height, self.monitor.width) + frame.shape[2:]
+
+    def count_surface_pixels(self, mask, correct_stretch=True):
+        """Count the pixels of a camera-space mask that fall on each surface,
+        without warping anything to the projector.
+        :param mask: A single channel uint8 mask in camera coordinates, where
+        any nonzero pixel is counted
+        :param correct_stretch: If True, pixels are weighted by how many
+        projector pixels they cover, so counts are in projector pixels
+        :return: A list with one count per surface """
+        return [weighted_count(mask, s.get_area_weights(mask.shape,
+                                                        correct_stretch))
+                for s in self.surfaces]
+
+    def count_union_pixels(self, mask, correct_stretch=True):
+        """Count the pixels of a camera-space mask that fall on any surface.
+        Unlike summing count_surface_pixels, pixels where surfaces overlap
+        are only counted once.
+        :param mask: A single channel uint8 mask in camera coordinates
+        :param correct_stretch: If True, the count is in projector pixels
+        :return: The count """
+        return weighted_count(mask, self.get_union_weights(mask.shape,
+                                                           correct_stretch))
+
+    def get_union_weights(self, frame_size, correct_stretch=True):
+        """Return the area weights of every surface combined into one map.
+        Where surfaces overlap, the surface later in the list wins, the same
+        as in the remap tables.
+        :param frame_size: (height, width) of the camera frame """
+        key = (tuple(frame_size[:2]), correct_stretch)
+        if key not in self._union_weights:
+            weights = np.zeros(key[0], dtype=np.float32)
+            for surface in self.surfaces:
+                inside = surface.get_mask(key[0]) > 0
+                weights[inside] = surface.get_area_weights(
+                    key[0], correct_stretch)[inside]
+            self._union_weights[key] = weights
+        return self._union_weights[key]
+
+    @property
+    def surfaces(self):
+        return self._surfaces
+
+    @surfaces.setter
+    def surfaces(self, surfaces):
+        self._surfaces = surfaces
+        self.invalidate_surfaces()
+
+    def invalidate_surfaces(self):
+        """Drop the remap tables and weights built from the surfaces. Setting
+        surfaces does this already, so only call it after changing the list
+        of surfaces in place, such as by appending to it."""
+        self._remap_cache.clear()
+        self._union_weights.clear()
+        self._compiled_path = None
+        self.surfaces_version += 1
+
+    def get_buffer(self, shape, dtype=np.uint8):
+        """ Return a persistent frame of this shape and dtype. The same array
+        is handed out every time, so its contents are not cleared. """
+        key = (tuple(shape), np.dtype(dtype))
+        if key not in self._buffers:
+            self._buffers[key] = np.zeros(shape, dtype=dtype)
+        return self._buffers[key]
+
+    def compile_surfaces(self, frame_shape):
+        """Build (or fetch from cache) the combined lookup map that takes a
+        camera frame of frame_shape to the projector window. Every surface,
+        including its polygon mask, is baked into one pair of remap tables.
+
+        :param frame_shape: The shape of the camera frames that will be warped
+        :return: (map1, map2) in the fixed-point format used by cv2.remap
+        """
+        key = tuple(frame_shape[:2])
+        if key not in self._remap_cache:
+            self._remap_cache[key] = self._build_remap(key)
+            if self._compiled_path is not None:
+                self._save_compiled()
+        return self._remap_cache[key]
+
+    def _build_remap(self, frame_size):
+        """Compute, for each projector pixel, which camera pixel it samples.
+        Projector pixels that fall outside of every surface sample from
+        outside of the camera frame, and so remap them to black. Where
+        surfaces overlap, the surface later in the list wins."""
+        cam_h, cam_w = frame_size
+        prj_w, prj_h = self.monitor.width, self.monitor.height
+
+        map_x = np.full((prj_h, prj_w), -1, dtype=np.float32)
+        map_y = np.full((prj_h, prj_w), -1, dtype=np.float32)
+
+        xs, ys = np.meshgrid(np.arange(prj_w, dtype=np.float32),
+                             np.arange(prj_h, dtype=np.float32))
+        prj_pts = np.dstack((xs, ys)).reshape(-1, 1, 2)
+        del xs, ys
 
-        # Warp each surface, and paste them to the draw_frame
         for surface in self.surfaces:
-            warped = surface.warp_to_camera(frame, dims)
-            draw_frame = cv2.bitwise_or(draw_frame, warped)
-        return draw_frame
+            # Which projector pixels land inside this surfaces polygon
+            cam_mask = surface.get_mask((cam_h, cam_w))
+            inside = cv2.warpPerspective(cam_mask,
+                                         surface._to_projector_mat,
+                                         (prj_w, prj_h),
+                                         flags=cv2.INTER_NEAREST) > 0
+
+            # Where each of those projector pixels comes from in the camera
+            cam_pts = cv2.perspectiveTransform(prj_pts,
+                                               surface._to_camera_mat)
+            cam_pts = cam_pts.reshape(prj_h, prj_w, 2)
+            map_x[inside] = cam_pts[..., 0][inside]
+            map_y[inside] = cam_pts[..., 1][inside]
+
+        # Fixed-point maps are considerably faster for cv2.remap
+        return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
 
     @property
     def empty_frame(self):
-        """ Return an empty black frame of the same size of the window """
-        return np.zeros((self.monitor.height, self.monitor.width, 3),
-                        dtype=np.uint8)
+        """ Return an empty black frame of the same size of the window. The
+        same frame is cleared and handed out every time, so draw on it and
+        render it before asking for another. """
+        if self._empty_frame is None:
+            self._empty_frame = np.zeros(
+                (self.monitor.height, self.monitor.width, 3), dtype=np.uint8)
+        else:
+            self._empty_frame.fill(0)
+        return self._empty_frame
+
+    def load_configuration(self, filename, compiled=True):
+        """ Loads surface configurations from a filename
+        :param compiled: If True, load the surfaces and their remap tables
+        from the precompiled file next to the JSON if it's still valid, and
+        keep that file up to date as new tables are built. """
+        self._compiled_path = None
+        if compiled:
+            self._config_hash = compiled_calibration.config_hash(filename)
+            resolution = (self.monitor.width, self.monitor.height)
+            path = compiled_calibration.default_path(filename)
+            loaded = compiled_calibration.load(path, self._config_hash,
+                                               resolution)
+            if loaded is not None:
+                self.surfaces, self._remap_cache = loaded
+                self._compiled_path = path
+                return
 
-    def load_configuration(self, filename):
-        """ Loads surface configurations from a filename """
         config = json.load(open(filename, "r"))
         self.surfaces = [Surface(s["cam_points"], s["prj_points"])
                          for s in config]
+        if compiled:
+            self._compiled_path = compiled_calibration.default_path(filename)
+            self._save_compiled()
+
+    def _save_compiled(self):
+        try:
+            compiled_calibration.save(
+                self._compiled_path, self._config_hash,
+                (self.monitor.width, self.monitor.height),
+                self.surfaces, self._remap_cache)
+        except OSError as e:
+            print("Projector| Unable to save compiled calibration:", e)
+            self._compiled_path = None
 
     def save_configuration(self, filename):
         """ Saves surface configurations to a filename """
@@ -80,3 +307,32 @@ class Projector:
 
     def close(self):
         cv2.destroyWindow(self.window_name)
+
+
+class HeadlessProjector(Projector):
+    """ A Projector that doesn't need a monitor. Rendered frames are kept in
+    last_frame instead of being shown, which is useful for tests and
+    benchmarks. """
+
+    def __init__(self, width, height, surfaces=None, reuse_buffers=False):
+        """
+        :param width: The width of the pretend projector, in pixels
+        :param height: The height of the pretend projector, in pixels
+        """
+        self._size = (width, height)
+        self.last_frame = None
+        self.frames_rendered = 0
+        super().__init__(None, surfaces=surfaces, reuse_buffers=reuse_buffers)
+
+    def _get_monitor(self, screen_id):
+        return HeadlessMonitor(0, 0, *self._size)
+
+    def _open_window(self):
+        pass
+
+    def render(self, frame, wait=True):
+        self.last_frame = frame
+        self.frames_rendered += 1
+
+    def close(self):
+        pass
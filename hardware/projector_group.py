@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from hardware.projector import Projector, weighted_count
+from utils.metrics import metrics
+
+
+class ProjectorGroup:
+    """ Drives several projectors from the same camera frames, so they can
+    cover more area together. Every projector has its own surfaces and
+    warp, and the warps run in parallel on a thread pool, since cv2 releases
+    the GIL. The input frame is shared between them, never copied.
+
+    It can stand in for a single Projector in the Demo: warped frames are
+    lists with one frame per projector, and surfaces is every projector's
+    surfaces together. """
+
+    def __init__(self, projectors, workers=None, buffers=2):
+        """
+        :param projectors: A list of Projectors, each with its own window_name
+        :param workers: How many warps to run at once. Defaults to one per
+        projector.
+        :param buffers: How many persistent output frames each projector
+        takes turns warping into. A list from get_warped_frame stays intact
+        until this many more calls have been made.
+        """
+        self.projectors = list(projectors)
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers or len(self.projectors),
+            thread_name_prefix="projector_warp")
+
+        # Persistent output frames, {(projector index, shape, dtype): frames}
+        self.reuse_buffers = True
+        self.buffers = buffers
+        self._buffers = {}
+        self._turn = 0
+
+        # Union area weights across projectors, keyed by (size, stretch), and
+        # the surfaces_version of each projector they were built from
+        self._union_weights = {}
+        self._union_versions = None
+
+    @classmethod
+    def from_screens(cls, screen_ids, calibration_paths, **kwargs):
+        """
+        Open a Projector on each screen, with a window of its own.
+        :param screen_ids: The monitor of each projector
+        :param calibration_paths: The calibration file of each projector
+        :param kwargs: Passed on to every Projector
+        """
+        projectors = []
+        for screen_id, path in zip(screen_ids, calibration_paths):
+            projector = Projector(screen_id,
+                                  window_name="Projector_Window_{}"
+                                  .format(screen_id), **kwargs)
+            projector.load_configuration(path)
+            projectors.append(projector)
+        return cls(projectors)
+
+    @property
+    def surfaces(self):
+        return [s for projector in self.projectors for s in projector.surfaces]
+
+    def get_warped_frame(self, frame):
+        """Warp a camera-space frame for every projector, in parallel
+        :return: A list with one projector frame per projector. The frames
+        are persistent buffers, overwritten after `buffers` more calls. """
+        outs = [self._get_buffer(i, projector, frame)
+                for i, projector in enumerate(self.projectors)]
+        self._turn = (self._turn + 1) % self.buffers
+        return list(self._pool.map(self._warp, self.projectors,
+                                   [frame] * len(self.projectors), outs))
+
+    def _get_buffer(self, index, projector, frame):
+        shape = projector.output_shape(frame)
+        key = (index, shape, frame.dtype)
+        if key not in self._buffers:
+            self._buffers[key] = [np.zeros(shape, dtype=frame.dtype)
+                                  for _ in range(self.buffers)]
+        return self._buffers[key][self._turn]
+
+    @staticmethod
+    def _warp(projector, frame, out):
+        return projector.warp_into(frame, out)
+
+    def render(self, frames, wait=True):
+        """Show one frame on each projector. This stays on the calling
+        thread, since cv2's GUI functions aren't thread safe. """
+        last = len(self.projectors) - 1
+        for i, (projector, frame) in enumerate(zip(self.projectors, frames)):
+            # One waitKey refreshes every window, so only the last one waits
+            projector.render(frame, wait=wait and i == last)
+
+    def render_to_camera(self, frame, wait=True):
+        """Draw a camera-space frame on every projector at once"""
+        with metrics.timer("projector.warp"):
+            frames = self.get_warped_frame(frame)
+        self.render(frames, wait=wait)
+
+    def count_union_pixels(self, mask, correct_stretch=True):
+        """Count the pixels of a camera-space mask that fall on any surface of
+        any projector, counting overlaps between them only once"""
+        return weighted_count(mask, self.get_union_weights(mask.shape,
+                                                           correct_stretch))
+
+    def get_union_weights(self, frame_size, correct_stretch=True):
+        """Every projector's union weights combined, where the projector
+        later in the list wins where they overlap"""
+        versions = [projector.surfaces_version
+                    for projector in self.projectors]
+        if self._union_versions != versions:
+            self._union_weights.clear()
+            self._union_versions = versions
+
+        key = (tuple(frame_size[:2]), correct_stretch)
+        if key not in self._union_weights:
+            weights = np.zeros(key[0], dtype=np.float32)
+            for projector in self.projectors:
+                projector_weights = projector.get_union_weights(
+                    key[0], correct_stretch)
+                np.copyto(weights, projector_weights,
+                          where=projector_weights > 0)
+            self._union_weights[key] = weights
+        return self._union_weights[key]
+
+    def count_surface_pixels(self, mask, correct_stretch=True):
+        """The counts of every projector's surfaces, one after the other"""
+        return [count for projector in self.projectors
+                for count in projector.count_surface_pixels(mask,
+                                                            correct_stretch)]
+
+    def close(self):
+        self._pool.shutdown()
+        for projector in self.projectors:
+            projector.close()
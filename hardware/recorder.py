@@ -0,0 +1,93 @@
+from queue import Empty, Full, Queue
+from threading import Thread
+
+import cv2
+
+
+class VideoRecorder(Thread):
+    """ A threaded video writer. Frames are handed over with record() and
+    encoded on this thread, so that encoding never stalls whoever is
+    producing the frames (usually the Camera capture loop). """
+
+    DROP_OLDEST = "drop_oldest"
+    BLOCK = "block"
+
+    def __init__(self, filename, fps=24, fourcc="MJPG", max_queue=32,
+                 drop_policy=DROP_OLDEST):
+        """
+        :param filename: The path of the video file to write
+        :param fps: The framerate to write into the video file
+        :param fourcc: The four character code of the codec to encode with
+        :param max_queue: How many frames can wait to be encoded
+        :param drop_policy: What to do when the queue is full.
+            VideoRecorder.DROP_OLDEST: Throw away the oldest waiting frame
+            VideoRecorder.BLOCK: Wait in record() until there is room
+        """
+        super().__init__(daemon=True)
+        if drop_policy not in (self.DROP_OLDEST, self.BLOCK):
+            raise ValueError("Unknown drop policy: " + str(drop_policy))
+
+        self.filename = filename
+        self.fps = fps
+        self.fourcc = fourcc
+        self.drop_policy = drop_policy
+
+        self.frames_encoded = 0
+        self.frames_dropped = 0
+
+        self._queue = Queue(maxsize=max_queue)
+        self._writer = None
+        self._closed = False
+
+        self.start()
+
+    def record(self, frame):
+        """ Queue a frame to be written to the video file """
+        if self._closed:
+            raise IOError("Cannot record to a closed VideoRecorder!")
+
+        if self.drop_policy == self.BLOCK:
+            self._queue.put(frame)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(frame)
+                return
+            except Full:
+                pass
+
+            # Make room by throwing away the oldest waiting frame
+            try:
+                self._queue.get_nowait()
+                self.frames_dropped += 1
+            except Empty:
+                pass
+
+    def run(self):
+        """ Encode frames until close() is called and the queue is empty """
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+
+            if self._writer is None:
+                h, w = frame.shape[:2]
+                fourcc = cv2.VideoWriter_fourcc(*self.fourcc)
+                self._writer = cv2.VideoWriter(self.filename, fourcc,
+                                               self.fps, (w, h), True)
+            self._writer.write(frame)
+            self.frames_encoded += 1
+
+        if self._writer is not None:
+            self._writer.release()
+
+    def close(self):
+        """ Encode every frame still waiting in the queue, then close the
+        video file """
+        if self._closed: return
+        self._closed = True
+
+        # The sentinel always waits for room, so no queued frame is lost
+        self._queue.put(None)
+        self.join()
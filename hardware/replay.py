@@ -0,0 +1,83 @@
+from time import sleep, time
+
+import cv2
+
+from hardware.camera import Camera
+
+
+class ReplayCapture:
+    """ A stand-in for cv2.VideoCapture that replays a video file or a list
+    of frames, optionally paced to a framerate. """
+
+    def __init__(self, source, fps=None, loop=False):
+        """
+        :param source: A path to a video file, or a list of cv2 frames
+        :param fps: If set, read() waits so frames come out at this rate.
+        Otherwise frames are returned as fast as they are asked for.
+        :param loop: If True, start over from the first frame at the end
+        """
+        self.fps = fps
+        self.loop = loop
+
+        self._video = None
+        self._frames = None
+        if isinstance(source, str):
+            self._video = cv2.VideoCapture(source)
+            if not self._video.isOpened():
+                raise IOError("Unable to open video file " + source)
+        else:
+            self._frames = list(source)
+            if not len(self._frames):
+                raise ValueError("Cannot replay an empty list of frames!")
+
+        self._index = 0
+        self._next_time = None
+
+    def read(self):
+        """ :return: (ret, frame), the same as cv2.VideoCapture.read() """
+        self._wait_for_next_frame()
+
+        if self._video is not None:
+            ret, frame = self._video.read()
+            if not ret and self.loop:
+                self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, frame = self._video.read()
+            return ret, frame
+
+        if self._index >= len(self._frames):
+            if not self.loop:
+                return False, None
+            self._index = 0
+        frame = self._frames[self._index]
+        self._index += 1
+        return True, frame
+
+    def _wait_for_next_frame(self):
+        if self.fps is None: return
+
+        now = time()
+        if self._next_time is None or self._next_time < now:
+            self._next_time = now
+        else:
+            sleep(self._next_time - now)
+        self._next_time += 1 / self.fps
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+
+
+class ReplayCamera(Camera):
+    """ A Camera that replays a video file or a list of frames instead of
+    reading from a webcam, so that anything built on Camera can run
+    headless. """
+
+    def __init__(self, source, fps=None, loop=False, **kwargs):
+        """
+        :param source: A path to a video file, or a list of cv2 frames
+        :param fps: The rate to serve frames at. None means as fast as
+        possible.
+        :param loop: If True, the replay starts over when it runs out
+        :param kwargs: Passed on to Camera
+        """
+        super().__init__(ReplayCapture(source, fps=fps, loop=loop), **kwargs)
@@ -0,0 +1,103 @@
+from time import time
+
+import cv2
+
+from utils.shared_frames import SharedFrameRing, _SPAWN
+
+
+def _capture_loop(cam_id, ring):
+    """ The body of the capture process. Frames are read straight into the
+    shared ring whenever cv2 can, so they're never copied or pickled. """
+    cap = cv2.VideoCapture(cam_id)
+    while not ring.closed:
+        try:
+            slot, view = ring.begin_write(timeout=0.1)
+        except RuntimeError:
+            # Readers are holding onto every slot, so drop this frame
+            cap.grab()
+            continue
+        ret, frame = cap.read(view)
+        if not ret:
+            print("Camera stopped returning frames! Ending capture process.")
+            break
+
+        # cv2 allocates a new frame if the camera's resolution changed
+        if frame is not view and frame.shape != view.shape:
+            cv2.resize(frame, view.shape[1::-1], dst=view)
+        elif frame is not view:
+            view[:] = frame
+        ring.end_write(slot, time())
+    cap.release()
+    ring.close()
+
+
+class SharedMemoryCamera:
+    """ A Camera that captures in a separate process and hands frames over
+    through shared memory, so the capture loop never competes with the rest
+    of the program for the GIL. It has the same read() and read_next()
+    interface as Camera, except that frames are read-only views into shared
+    memory rather than copies. """
+
+    def __init__(self, cam_id, frame_shape=None, slots=4):
+        """
+        :param cam_id: The cv2.VideoCapture ID or path to open
+        :param frame_shape: The shape of the cameras frames. If None, the
+        camera is opened once here to find out.
+        :param slots: How many frames the shared ring holds
+        """
+        self.window_name = "Camera View"
+        if frame_shape is None:
+            cap = cv2.VideoCapture(cam_id)
+            ret, frame = cap.read()
+            cap.release()
+            if not ret: raise IOError("Unable to get frames from camera!")
+            frame_shape = frame.shape
+        self.frame_shape = tuple(frame_shape)
+
+        self.ring = SharedFrameRing(self.frame_shape, slots=slots)
+        self.process = _SPAWN.Process(target=_capture_loop,
+                                      args=(cam_id, self.ring), daemon=True)
+        self.process.start()
+
+        if self.read_next(0, timeout=10) is None:
+            self.close()
+            raise IOError("Unable to get frames from camera!")
+
+    @property
+    def running(self):
+        return not self.ring.closed
+
+    @property
+    def latest_seq(self):
+        return self.ring.latest_seq
+
+    def read(self):
+        """Return the latest frame and timestamp from the camera, or
+        (None, None) if the camera has stopped"""
+        new_frame = self.read_next(self.ring.latest_seq - 1)
+        if new_frame is None:
+            return None, None
+        _, tstamp, frame = new_frame
+        return tstamp, frame
+
+    def read_next(self, after_seq, timeout=None):
+        """Block until a frame newer than after_seq is available.
+        :return: (seq, timestamp, frame), or None on a timeout or if the
+        camera stopped. The frame is a read-only view of shared memory, and
+        its slot can't be overwritten until the frame (and every view of it)
+        is gone. Holding more frames than the ring has slots stalls capture.
+        """
+        return self.ring.lease_next(after_seq, timeout)
+
+    def show(self):
+        """The capture process has no GUI, so the camera view isn't shown"""
+        pass
+
+    def hide(self):
+        pass
+
+    def close(self):
+        """Stop the capture process and free the shared memory"""
+        self.ring.close()
+        self.process.join()
+        self.ring.unlink()
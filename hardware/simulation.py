@@ -0,0 +1,111 @@
+from collections import deque
+from time import sleep, time
+
+import cv2
+import numpy as np
+
+
+class SimulatedCapture:
+    """ A stand-in for cv2.VideoCapture that films a HeadlessProjector. The
+    scene is a set of flat surfaces, each a Surface whose homographies are
+    the ground truth mapping between camera and projector pixels. Whatever
+    the projector last rendered lands on each surface, on top of some ambient
+    light and sensor noise. Pass it to Camera to get a camera/projector rig
+    that works without any hardware. """
+
+    NOISE_FRAMES = 4  # How many distinct frames of sensor noise to cycle
+
+    def __init__(self, projector, surfaces, resolution=(1280, 720), fps=60,
+                 ambient=20, albedo=0.8, noise=2.0, blur=3, delay=0):
+        """
+        :param projector: The HeadlessProjector being filmed
+        :param surfaces: The list of Surfaces in the scene
+        :param resolution: The (width, height) of the camera frames
+        :param fps: How many frames per second read() returns at most
+        :param ambient: The brightness of the scene with the projector off
+        :param albedo: How much of the projected light the surfaces reflect
+        :param noise: The standard deviation of the sensor noise
+        :param blur: The size of the blur kernel standing in for the optics,
+        or 0 for perfectly sharp frames
+        :param delay: Seconds between the projector rendering a frame and it
+        lighting up the scene, standing in for display latency. Renders are
+        noticed when a frame is read, so this is only as precise as the fps.
+        """
+        self.projector = projector
+        self.surfaces = surfaces
+        self.resolution = tuple(resolution)
+        self.fps = fps
+        self.ambient = ambient
+        self.albedo = albedo
+        self.noise = noise
+        self.blur = blur
+        self.delay = delay
+
+        self._next_time = None
+        self._shown = deque()  # (time rendered, frame) waiting to be displayed
+        self._noise = []
+        self._noise_index = 0
+
+    def read(self):
+        """ :return: (ret, frame), the same as cv2.VideoCapture.read() """
+        self._wait_for_next_frame()
+        return True, self.render(self._displayed_frame())
+
+    def _displayed_frame(self):
+        """ The projector frame lighting up the scene right now """
+        now = time()
+        latest = self.projector.last_frame
+        if not self._shown or self._shown[-1][1] is not latest:
+            self._shown.append((now, latest))
+
+        # Forget frames that have been replaced by one that's showing already
+        while len(self._shown) > 1 and self._shown[1][0] <= now - self.delay:
+            self._shown.popleft()
+        rendered_at, frame = self._shown[0]
+        return frame if rendered_at <= now - self.delay else None
+
+    def render(self, prj_frame):
+        """ What the camera would see while the projector shows prj_frame """
+        width, height = self.resolution
+        light = np.zeros((height, width, 3), dtype=np.uint8)
+        if prj_frame is not None:
+            if prj_frame.ndim == 2:
+                prj_frame = cv2.cvtColor(prj_frame, cv2.COLOR_GRAY2BGR)
+            for surface in self.surfaces:
+                warped = cv2.warpPerspective(prj_frame,
+                                             surface._to_camera_mat,
+                                             (width, height))
+                cv2.copyTo(warped, surface.get_mask((height, width)), light)
+
+        if self.blur:
+            light = cv2.GaussianBlur(light, (self.blur, self.blur), 0)
+        frame = cv2.convertScaleAbs(light, alpha=self.albedo, beta=self.ambient)
+        if self.noise:
+            frame = cv2.add(frame, self._next_noise(frame.shape),
+                            dtype=cv2.CV_8U)
+        return frame
+
+    def _next_noise(self, shape):
+        """ Cycle through a few precomputed noise frames, since generating
+        fresh noise every frame would slow the simulation down a lot """
+        if not self._noise or self._noise[0].shape != shape:
+            self._noise = []
+            for _ in range(self.NOISE_FRAMES):
+                noise = np.zeros(shape, dtype=np.int16)
+                cv2.randn(noise, 0, self.noise)
+                self._noise.append(noise)
+        self._noise_index = (self._noise_index + 1) % len(self._noise)
+        return self._noise[self._noise_index]
+
+    def _wait_for_next_frame(self):
+        if self.fps is None: return
+
+        now = time()
+        if self._next_time is None or self._next_time < now:
+            self._next_time = now
+        else:
+            sleep(self._next_time - now)
+        self._next_time += 1 / self.fps
+
+    def release(self):
+        pass
@@ -0,0 +1,222 @@
+"""
+Automatic projector calibration with structured light.
+
+Instead of clicking on points, a sequence of Gray code stripe patterns is
+projected and filmed. Each stripe pattern, along with its inverse, gives one
+bit of the projector column (or row) that lit each camera pixel, so after
+about 20 pairs of frames every camera pixel knows which projector pixel it
+sees. Flat surfaces are then found in that correspondence map by fitting
+homographies to it with RANSAC, one surface at a time.
+"""
+from time import time
+
+import cv2
+import numpy as np
+
+from hardware.surface import Surface
+
+
+def gray_code_bits(size, stripe=1):
+    """ :return: How many Gray code bits it takes to tell apart every
+    stripe-wide band of a size pixel wide axis """
+    return max(1, int(np.ceil(np.log2(np.ceil(size / stripe)))))
+
+
+def gray_code_pattern(width, height, bit, vertical=True, stripe=1):
+    """
+    Build one Gray code pattern, where a pixel is white if the given bit of
+    the Gray code of its column (or row) is set.
+    :param bit: Which bit, where 0 is the most significant
+    :param vertical: If True, stripes are vertical and encode columns.
+    Otherwise they're horizontal and encode rows.
+    :param stripe: How many pixels wide the narrowest stripe is
+    :return: A single channel uint8 frame of (height, width)
+    """
+    size = width if vertical else height
+    n_bits = gray_code_bits(size, stripe)
+    index = np.arange(size) // stripe
+    gray = index ^ (index >> 1)
+    line = (((gray >> (n_bits - 1 - bit)) & 1) * 255).astype(np.uint8)
+
+    if vertical:
+        return np.repeat(line[np.newaxis, :], height, axis=0)
+    return np.repeat(line[:, np.newaxis], width, axis=1)
+
+
+class StructuredLightCalibrator:
+    """ Finds the surfaces in view of a camera by projecting Gray code
+    patterns onto them. Works with any Projector and any Camera-like object
+    with read_next(), including a Camera around a SimulatedCapture. """
+
+    def __init__(self, cam, prj, stripe=2, settle_time=0.1,
+                 contrast_thresh=15):
+        """
+        :param cam: A Camera (or anything with read_next and latest_seq)
+        :param prj: The Projector to calibrate
+        :param stripe: How many projector pixels wide the narrowest stripes
+        are. Stripes that are too thin blur together on the camera.
+        :param settle_time: Seconds to wait after rendering a pattern before
+        a camera frame counts as showing it
+        :param contrast_thresh: How much brighter a pixel has to be under a
+        pattern than under its inverse for the bit to be trusted
+        """
+        self.cam = cam
+        self.prj = prj
+        self.stripe = stripe
+        self.settle_time = settle_time
+        self.contrast_thresh = contrast_thresh
+
+    def calibrate(self, max_surfaces=8, min_area=0.01, ransac_thresh=None):
+        """ Project the patterns, and fit surfaces to what the camera saw.
+        :return: A list of Surfaces """
+        prj_x, prj_y = self.decode()
+        return self.fit_surfaces(prj_x, prj_y, max_surfaces=max_surfaces,
+                                 min_area=min_area,
+                                 ransac_thresh=ransac_thresh)
+
+    def decode(self):
+        """
+        Project every pattern, and decode which projector pixel each camera
+        pixel sees.
+        :return: (prj_x, prj_y), two float32 maps the size of a camera frame,
+        which are -1 wherever a pixel couldn't be decoded
+        """
+        width, height = self.prj.monitor.width, self.prj.monitor.height
+
+        # Pixels that the projector can't light up are thrown out up front
+        black = self._capture(np.zeros((height, width), np.uint8))
+        white = self._capture(np.full((height, width), 255, np.uint8))
+        valid = cv2.subtract(white, black) > self.contrast_thresh
+
+        prj_x, valid_x = self._decode_axis(width, height, True)
+        prj_y, valid_y = self._decode_axis(width, height, False)
+        valid &= valid_x & valid_y
+
+        prj_x[~valid] = -1
+        prj_y[~valid] = -1
+        self.prj.render(self.prj.empty_frame)
+        return prj_x, prj_y
+
+    def _decode_axis(self, width, height, vertical):
+        """ Decode the projector column (or row) of every camera pixel """
+        size = width if vertical else height
+        value = None
+        valid = None
+        binary_bit = None
+
+        for bit in range(gray_code_bits(size, self.stripe)):
+            pattern = gray_code_pattern(width, height, bit, vertical,
+                                        self.stripe)
+            lit = self._capture(pattern)
+            unlit = self._capture(cv2.bitwise_not(pattern))
+
+            gray_bit = lit > unlit
+            if value is None:
+                value = np.zeros(lit.shape, dtype=np.int32)
+                valid = np.ones(lit.shape, dtype=bool)
+                binary_bit = np.zeros(lit.shape, dtype=bool)
+            valid &= cv2.absdiff(lit, unlit) > self.contrast_thresh
+
+            # Gray to binary: each binary bit is the XOR of the gray bits so far
+            binary_bit ^= gray_bit
+            value = (value << 1) | binary_bit
+
+        # The center of the stripe, in projector pixels
+        coords = value.astype(np.float32) * self.stripe + (self.stripe - 1) / 2
+        valid &= coords < size
+        return coords, valid
+
+    def _capture(self, pattern):
+        """ Render a pattern and return a grayscale camera frame of it """
+        self.prj.render(cv2.cvtColor(pattern, cv2.COLOR_GRAY2BGR))
+        shown_at = time()
+
+        # The frame being captured during the render may not show the pattern
+        seq = self.cam.latest_seq
+        skipped = False
+        while True:
+            new_frame = self.cam.read_next(seq, timeout=5)
+            if new_frame is None: break
+            seq, tstamp, frame = new_frame
+            if skipped and tstamp >= shown_at + self.settle_time:
+                return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            skipped = True
+        raise IOError("Camera stopped returning frames during calibration!")
+
+    def fit_surfaces(self, prj_x, prj_y, max_surfaces=8, min_area=0.01,
+                     ransac_thresh=None, step=4):
+        """
+        Find flat surfaces in a correspondence map, largest first. Each
+        round fits a homography to the remaining decoded pixels with RANSAC,
+        turns the largest connected patch of its inliers into a Surface, and
+        removes those inliers before the next round.
+
+        :param prj_x: The projector column seen by each camera pixel, or -1
+        :param prj_y: The projector row seen by each camera pixel, or -1
+        :param max_surfaces: The most surfaces to look for
+        :param min_area: The smallest surface to keep, as a fraction of the
+        camera frame
+        :param ransac_thresh: How far (in projector pixels) a pixel can be
+        from a surface and still be on it. Defaults to a couple of stripes.
+        :param step: Only every step-th pixel in each direction is used to fit
+        :return: A list of Surfaces
+        """
+        if ransac_thresh is None:
+            ransac_thresh = 2 * self.stripe
+
+        # Work on a sparse grid of pixels, which is plenty for a homography
+        grid_x = prj_x[::step, ::step]
+        grid_y = prj_y[::step, ::step]
+        remaining = grid_x >= 0
+        min_points = min_area * grid_x.size
+
+        surfaces = []
+        while len(surfaces) < max_surfaces:
+            ys, xs = np.nonzero(remaining)
+            if len(xs) < max(min_points, 4): break
+
+            cam_pts = np.float32(np.column_stack((xs, ys)) * step)
+            prj_pts = np.float32(np.column_stack((grid_x[ys, xs],
+                                                  grid_y[ys, xs])))
+            homography, inliers = cv2.findHomography(cam_pts, prj_pts,
+                                                     cv2.RANSAC, ransac_thresh)
+            if homography is None: break
+            inliers = inliers.ravel().astype(bool)
+
+            # The inliers may be spread over several coplanar patches
+            inlier_mask = np.zeros(remaining.shape, dtype=np.uint8)
+            inlier_mask[ys[inliers], xs[inliers]] = 255
+            patch = self._largest_patch(inlier_mask)
+            remaining[inlier_mask > 0] = False
+            if cv2.countNonZero(patch) < min_points: continue
+
+            corners = np.int32(np.round(self._fit_quad(patch) * step))
+            prj_corners = cv2.perspectiveTransform(
+                np.float32(corners).reshape(-1, 1, 2), homography)
+            prj_corners = np.int32(np.round(prj_corners.reshape(-1, 2)))
+            surfaces.append(Surface(corners.tolist(), prj_corners.tolist()))
+        return surfaces
+
+    @staticmethod
+    def _largest_patch(mask):
+        """ The largest connected region of a mask, with small holes filled """
+        kernel = np.ones((3, 3), np.uint8)
+        closed = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(closed)
+        if count < 2:
+            return np.zeros_like(mask)
+        largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+        return np.uint8(labels == largest) * 255
+
+    @staticmethod
+    def _fit_quad(patch):
+        """ Four corners that outline a patch, since Surfaces are quads """
+        contours = cv2.findContours(patch, cv2.RETR_EXTERNAL,
+                                    cv2.CHAIN_APPROX_SIMPLE)[-2]
+        hull = cv2.convexHull(max(contours, key=cv2.contourArea))
+        perimeter = cv2.arcLength(hull, True)
+        for tolerance in (0.01, 0.02, 0.04, 0.08):
+            quad = cv2.approxPolyDP(hull, tolerance * perimeter, True)
+            if len(quad) == 4:
+                return quad.reshape(4, 2).astype(np.float32)
+        return cv2.boxPoints(cv2.minAreaRect(hull)).astype(np.float32)
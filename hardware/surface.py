@@ -6,17 +6,29 @@ from utils.draw_utils import draw_cross, draw_polygon
 
 
 class Surface:
-    def __init__(self, cam_points, prj_points):
+    def __init__(self, cam_points, prj_points, to_camera_mat=None,
+                 to_projector_mat=None):
         """
         :param cam_points: A list of points in the camera coordinate grid
         :param prj_points: A corresponding list of points in the projector grid
+        :param to_camera_mat: Optionally, a precomputed homography from
+        projector to camera coordinates, instead of computing it from points
+        :param to_projector_mat: Likewise, from camera to projector coordinates
         """
         self.cam_points = np.array(cam_points)
         self.prj_points = np.array(prj_points)
-        self._to_camera_mat = self._get_affine_warp(prj_points,
-                                                    cam_points)
-        self._to_projector_mat = self._get_affine_warp(cam_points,
-                                                       prj_points)
+        if to_camera_mat is None:
+            to_camera_mat = self._get_affine_warp(prj_points, cam_points)
+        if to_projector_mat is None:
+            to_projector_mat = self._get_affine_warp(cam_points, prj_points)
+        self._to_camera_mat = np.array(to_camera_mat)
+        self._to_projector_mat = np.array(to_projector_mat)
+
+        # Polygon masks for mask_frame, keyed by (shape, dtype)
+        self._masks = {}
+        # Single channel masks and area weights, keyed by frame size
+        self._cam_masks = {}
+        self._area_weights = {}
 
     def warp_to_camera(self, projector_frame, new_dimensions):
         """Warps a projector frame such that if projected, it would appear on
@@ -29,11 +41,51 @@ class Surface:
 
         return warped
 
-    def mask_frame(self, projector_frame):
-        empty = np.zeros_like(projector_frame)
-        mask = cv2.fillPoly(empty, [self.cam_points], (255, 255, 255))
-        masked = cv2.bitwise_and(projector_frame, mask)
-        return masked
+    def mask_frame(self, projector_frame, out=None):
+        """Black out everything outside of the cam_points polygon
+        :param projector_frame: The frame to mask
+        :param out: Optionally, a frame of the same shape and dtype to write
+        the result into, instead of allocating a new one """
+        key = (projector_frame.shape, projector_frame.dtype)
+        if key not in self._masks:
+            empty = np.zeros_like(projector_frame)
+            self._masks[key] = cv2.fillPoly(empty, [self.cam_points],
+                                            (255, 255, 255))
+        return cv2.bitwise_and(projector_frame, self._masks[key], dst=out)
+
+    def get_mask(self, frame_size):
+        """Return a single channel uint8 mask of the cam_points polygon
+        :param frame_size: (height, width) of the camera frame """
+        key = tuple(frame_size[:2])
+        if key not in self._cam_masks:
+            mask = np.zeros(key, dtype=np.uint8)
+            cv2.fillPoly(mask, [np.int32(self.cam_points)], 255)
+            self._cam_masks[key] = mask
+        return self._cam_masks[key]
+
+    def get_area_weights(self, frame_size, correct_stretch=True):
+        """Return a float32 map of how many projector pixels each camera pixel
+        inside the cam_points polygon covers. Pixels outside are 0.
+        :param frame_size: (height, width) of the camera frame
+        :param correct_stretch: If False, every pixel inside weighs 1 """
+        key = (tuple(frame_size[:2]), correct_stretch)
+        if key in self._area_weights:
+            return self._area_weights[key]
+
+        inside = self.get_mask(frame_size) > 0
+        weights = np.zeros(key[0], dtype=np.float32)
+        if correct_stretch:
+            # The jacobian determinant of a homography H at (x, y) is
+            # det(H) / w^3, where w is the homogeneous coordinate of H(x, y)
+            h = self._to_projector_mat
+            ys, xs = np.nonzero(inside)
+            w = h[2, 0] * xs + h[2, 1] * ys + h[2, 2]
+            weights[ys, xs] = np.abs(np.linalg.det(h) / w ** 3)
+        else:
+            weights[inside] = 1
+
+        self._area_weights[key] = weights
+        return weights
 
     @staticmethod
     def _get_affine_warp(from_pts, to_pts):
@@ -0,0 +1,322 @@
+"""
+A local inference service that several Demo processes can share, so that
+each model is only loaded into memory once.
+
+Demos connect over a Unix domain socket. Frames from every connected rig are
+collected into batches of up to --max-batch frames, waiting at most
+--max-wait seconds for a batch to fill. The object detector runs each batch
+in one call. The segmenter only takes one image at a time, so it runs the
+frames of a batch one after another; sharing it saves memory, not time.
+
+Start the service:
+    python inference_service.py -s model.pb -m label_map.json --socket /tmp/inference.sock
+
+Then point each demo at it with --inference-socket /tmp/inference.sock
+
+Every message on the socket is a 4 byte big endian header length, a JSON
+header, and then header["nbytes"] bytes of raw array data (if any).
+"""
+import json
+import os
+import socket
+import stat
+import struct
+from argparse import ArgumentParser
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import time
+from types import SimpleNamespace
+
+import numpy as np
+
+SEGMENTER = "segmenter"
+DETECTOR = "detector"
+
+_LENGTH = struct.Struct(">I")
+
+
+def _recv_exact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Inference socket closed")
+        received += count
+    return data
+
+
+def send_message(sock, header, array=None):
+    """ Send a header dict, and optionally a numpy array after it """
+    payload = b""
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header = dict(header, shape=list(array.shape), dtype=str(array.dtype))
+        payload = memoryview(array).cast("B")
+    header = dict(header, nbytes=len(payload))
+
+    encoded = json.dumps(header).encode("utf-8")
+    sock.sendall(_LENGTH.pack(len(encoded)) + encoded)
+    if len(payload):
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """ :return: (header, array), where array is None if nothing was sent """
+    length, = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    header = json.loads(_recv_exact(sock, length).decode("utf-8"))
+
+    array = None
+    if header["nbytes"]:
+        data = _recv_exact(sock, header["nbytes"])
+        array = np.frombuffer(data, dtype=header["dtype"])
+        array = array.reshape(header["shape"])
+    return header, array
+
+
+def _remove_stale_socket(path):
+    """ Remove a socket file left behind by a server that is no longer
+    running. Anything else at the path, including a live server's socket, is
+    left alone and makes bind() fail instead. """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+    else:
+        raise OSError("An inference service is already listening on " + path)
+    finally:
+        probe.close()
+
+
+class _Request:
+    def __init__(self, frame, connection):
+        self.frame = frame
+        self.connection = connection
+
+
+class _Connection(Thread):
+    """ Reads requests from one Demo and queues them up for batching """
+
+    def __init__(self, server, sock):
+        super().__init__(daemon=True)
+        self.server = server
+        self.sock = sock
+        self.send_lock = Lock()
+        self.start()
+
+    def run(self):
+        try:
+            while True:
+                header, frame = recv_message(self.sock)
+                model = header.get("model")
+                if model not in self.server.queues:
+                    self.reply({"error": "Unknown model: " + str(model)})
+                    continue
+                self.server.queues[model].put(_Request(frame, self))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.sock.close()
+
+    def reply(self, header, array=None):
+        with self.send_lock:
+            try:
+                send_message(self.sock, header, array)
+            except OSError:
+                pass
+
+
+class InferenceServer:
+    """ Serves models over a Unix domain socket, dynamically batching frames
+    from every connected client """
+
+    def __init__(self, socket_path, models, batched=(), max_batch=8,
+                 max_wait=0.01):
+        """
+        :param socket_path: Where to create the Unix domain socket
+        :param models: {SEGMENTER or DETECTOR: loaded model}
+        :param batched: The names of models whose predict() accepts a list of
+        frames. Other models are called once per frame in each batch.
+        :param max_batch: The most frames to run through a model at once
+        :param max_wait: Seconds to wait for a batch to fill up
+        """
+        self.socket_path = socket_path
+        self.models = models
+        self.batched = set(batched)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queues = {name: Queue() for name in models}
+        self.running = False
+
+        _remove_stale_socket(socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(socket_path)
+        self._sock.listen()
+
+    def serve_forever(self):
+        self.running = True
+        for name in self.models:
+            Thread(target=self._batch_loop, args=(name,), daemon=True).start()
+
+        print("Serving", list(self.models), "on", self.socket_path)
+        try:
+            while self.running:
+                conn, _ = self._sock.accept()
+                _Connection(self, conn)
+        except OSError:
+            if self.running: raise
+
+    def close(self):
+        self.running = False
+        self._sock.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _next_batch(self, name):
+        """ Wait for one request, then collect more until the batch is full
+        or max_wait runs out """
+        queue = self.queues[name]
+        batch = [queue.get()]
+        deadline = time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time()
+            if remaining <= 0: break
+            try:
+                batch.append(queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _batch_loop(self, name):
+        model = self.models[name]
+        while self.running:
+            batch = self._next_batch(name)
+            frames = [request.frame for request in batch]
+            try:
+                if name in self.batched:
+                    results = model.predict(frames)
+                else:
+                    results = [model.predict(frame) for frame in frames]
+            except Exception as e:
+                for request in batch:
+                    request.connection.reply({"error": repr(e)})
+                continue
+
+            if len(results) != len(batch):
+                print("InferenceService| ERROR", name, "returned",
+                      len(results), "results for", len(batch), "frames")
+            # Requests without a matching result still get a reply
+            for request in batch[len(results):]:
+                request.connection.reply({"error": "No result for frame"})
+
+            for request, result in zip(batch, results):
+                if name == SEGMENTER:
+                    request.connection.reply({}, result.colored)
+                else:
+                    request.connection.reply({"detections": [
+                        {"name": pred.name,
+                         "rect": [float(v) for v in pred.rect],
+                         "confidence": float(getattr(pred, "confidence", 1))}
+                        for pred in result]})
+
+
+class InferenceClient:
+    """ A connection to an InferenceServer. Thread safe, but requests from
+    the same client are sent one at a time. """
+
+    def __init__(self, socket_path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._lock = Lock()
+
+    def request(self, model, frame):
+        with self._lock:
+            send_message(self._sock, {"model": model}, frame)
+            header, array = recv_message(self._sock)
+        if "error" in header:
+            raise RuntimeError("Inference service error: " + header["error"])
+        return header, array
+
+    def close(self):
+        self._sock.close()
+
+
+class RemoteSegmenter:
+    """ Drop-in for a DeeplabImageSegmenter that runs on the service """
+
+    def __init__(self, client):
+        self.client = client
+
+    def predict(self, frame):
+        _, colored = self.client.request(SEGMENTER, frame)
+        return SimpleNamespace(colored=colored)
+
+
+class RemoteDetector:
+    """ Drop-in for an ObjectDetector that runs on the service """
+
+    def __init__(self, client):
+        self.client = client
+
+    def predict(self, frames):
+        results = []
+        for frame in frames:
+            header, _ = self.client.request(DETECTOR, frame)
+            results.append([SimpleNamespace(**pred)
+                            for pred in header["detections"]])
+        return results
+
+
+def main(args):
+    from easyinference.models import DeeplabImageSegmenter, ObjectDetector
+
+    models = {}
+    if args.segment_path:
+        models[SEGMENTER] = DeeplabImageSegmenter.from_path(args.segment_path,
+                                                            args.segment_map)
+    if args.detector_path:
+        models[DETECTOR] = ObjectDetector.from_path(args.detector_path,
+                                                    args.detector_labels)
+
+    # DeeplabImageSegmenter.predict takes a single image, and the frames it
+    # gets are crops of differing sizes that couldn't be stacked anyway, so
+    # only the detector is batched
+    server = InferenceServer(args.socket, models,
+                             batched=[DETECTOR],
+                             max_batch=args.max_batch,
+                             max_wait=args.max_wait)
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Load models once and serve them to several demos over a "
+                    "Unix domain socket, batching detector frames between "
+                    "them.")
+    parser.add_argument("-s", "--segment-path", type=str, default=None,
+                        help="The path to the Image Segmentation model to serve")
+    parser.add_argument("-m", "--segment-map", type=str, default=None,
+                        help="The path to the label_map.json for the image segmentation model")
+    parser.add_argument("-o", "--detector-path", type=str, default=None,
+                        help="The path to the Object Detection model to serve")
+    parser.add_argument("-l", "--detector-labels", type=str, default=None,
+                        help="The path to the labels.json for the Detection model")
+    parser.add_argument("--socket", type=str, default="/tmp/projector_inference.sock",
+                        help="The path of the Unix domain socket to serve on")
+    parser.add_argument("--max-batch", type=int, default=8,
+                        help="The most frames to run through a model at once")
+    parser.add_argument("--max-wait", type=float, default=0.01,
+                        help="Seconds to wait for a batch to fill up")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,86 @@
+import gc
+from threading import Event
+from time import sleep, time
+from types import SimpleNamespace
+
+import numpy as np
+
+from utils.async_detector import AsyncDetector
+from utils.metrics import metrics
+from utils.shared_frames import SharedFrameRing
+
+
+class FlakyDetector:
+    """ Raises on the first call, then finds one person """
+
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, frames):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError("Out of memory")
+        return [[SimpleNamespace(name="person", rect=(0, 0, 10, 10))]
+                for _ in frames]
+
+
+class SlowDetector:
+    """ Waits to be told to finish each prediction """
+
+    def __init__(self):
+        self.started = Event()
+        self.finish = Event()
+
+    def predict(self, frames):
+        self.started.set()
+        self.finish.wait(timeout=5)
+        return [[] for _ in frames]
+
+
+def wait_until(condition, timeout=2):
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline
+        sleep(0.01)
+
+
+def test_errors_dont_stop_the_detector():
+    metrics.reset()
+    metrics.enable()
+    detector = FlakyDetector()
+    worker = AsyncDetector(detector, rate=100)
+    try:
+        worker.submit("first frame", tstamp=1)
+        wait_until(lambda: detector.calls == 1)
+        assert worker.is_alive()
+
+        worker.submit("second frame", tstamp=2)
+        wait_until(lambda: worker.runs == 1)
+        preds = worker.latest()
+        assert [pred.name for pred in preds] == ["person"]
+        assert preds[0].tstamp == 2
+        assert metrics.snapshot()["counters"]["detector.errors"] == 1
+    finally:
+        worker.close()
+        metrics.disable()
+        metrics.reset()
+
+
+def test_leased_frames_are_not_held_while_detecting():
+    ring = SharedFrameRing((4, 6, 3), slots=2)
+    detector = SlowDetector()
+    worker = AsyncDetector(detector, rate=100)
+    try:
+        _, _, frame = ring.lease_seq(ring.write(np.zeros((4, 6, 3),
+                                                         np.uint8)))
+        worker.submit(frame)
+        del frame
+        assert detector.started.wait(timeout=2)
+        gc.collect()
+        assert sum(ring._pins) == 0
+    finally:
+        detector.finish.set()
+        worker.close()
+        ring.close()
+        gc.collect()
+        ring.unlink()
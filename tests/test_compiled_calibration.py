@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from hardware import compiled_calibration
+from hardware.projector import HeadlessProjector
+from hardware.surface import Surface
+
+PRJ_SIZE = (200, 100)
+FRAME_SHAPE = (100, 200, 3)
+
+
+def make_surfaces():
+    return [Surface([[0, 0], [90, 5], [95, 95], [5, 90]],
+                    [[0, 0], [100, 0], [100, 100], [0, 100]]),
+            Surface([[100, 0], [199, 0], [199, 99], [100, 99]],
+                    [[110, 10], [190, 0], [199, 99], [100, 90]])]
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    HeadlessProjector(*PRJ_SIZE, surfaces=make_surfaces()) \
+        .save_configuration(path)
+    return path
+
+
+def test_round_trip(tmp_path):
+    prj = HeadlessProjector(*PRJ_SIZE, surfaces=make_surfaces())
+    prj.compile_surfaces(FRAME_SHAPE)
+    path = str(tmp_path / "compiled.npz")
+    compiled_calibration.save(path, "abc", PRJ_SIZE, prj.surfaces,
+                              prj._remap_cache)
+
+    surfaces, tables = compiled_calibration.load(path, "abc", PRJ_SIZE)
+    assert len(surfaces) == len(prj.surfaces)
+    for loaded, original in zip(surfaces, prj.surfaces):
+        assert np.array_equal(loaded.cam_points, original.cam_points)
+        assert np.array_equal(loaded.prj_points, original.prj_points)
+        assert np.array_equal(loaded._to_camera_mat, original._to_camera_mat)
+        assert loaded._cam_masks.keys() == original._cam_masks.keys()
+        for size, mask in original._cam_masks.items():
+            assert np.array_equal(loaded._cam_masks[size], mask)
+
+    assert tables.keys() == prj._remap_cache.keys()
+    for size, maps in prj._remap_cache.items():
+        for loaded, original in zip(tables[size], maps):
+            assert np.array_equal(loaded, original)
+
+
+def test_stale_files_are_ignored(tmp_path, monkeypatch):
+    path = str(tmp_path / "compiled.npz")
+    assert compiled_calibration.load(path, "abc", PRJ_SIZE) is None
+
+    compiled_calibration.save(path, "abc", PRJ_SIZE, make_surfaces(), {})
+    assert compiled_calibration.load(path, "abc", PRJ_SIZE) is not None
+    assert compiled_calibration.load(path, "def", PRJ_SIZE) is None
+    assert compiled_calibration.load(path, "abc", (100, 100)) is None
+
+    monkeypatch.setattr(compiled_calibration, "VERSION",
+                        compiled_calibration.VERSION + 1)
+    assert compiled_calibration.load(path, "abc", PRJ_SIZE) is None
+
+
+def test_projector_keeps_compiled_file_up_to_date(config, monkeypatch):
+    prj = HeadlessProjector(*PRJ_SIZE)
+    prj.load_configuration(config)
+    expected = prj.get_warped_frame(np.full(FRAME_SHAPE, 99, np.uint8))
+
+    # A new projector gets the tables built above without rebuilding them
+    def rebuild(*args):
+        raise AssertionError("The remap tables were rebuilt")
+
+    monkeypatch.setattr(HeadlessProjector, "_build_remap", rebuild)
+    loaded = HeadlessProjector(*PRJ_SIZE)
+    loaded.load_configuration(config)
+    assert np.array_equal(
+        loaded.get_warped_frame(np.full(FRAME_SHAPE, 99, np.uint8)), expected)
+
+
+def test_edited_config_is_recompiled(config):
+    HeadlessProjector(*PRJ_SIZE).load_configuration(config)
+
+    # Drop the first surface, without touching the compiled file
+    edited = HeadlessProjector(*PRJ_SIZE, surfaces=make_surfaces()[1:])
+    edited.save_configuration(config)
+
+    prj = HeadlessProjector(*PRJ_SIZE)
+    prj.load_configuration(config)
+    assert len(prj.surfaces) == 1
+    assert compiled_calibration.load(
+        compiled_calibration.default_path(config),
+        compiled_calibration.config_hash(config), PRJ_SIZE) is not None
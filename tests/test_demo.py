@@ -0,0 +1,211 @@
+import gc
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from demo import Demo
+from hardware.projector import HeadlessProjector
+from hardware.replay import ReplayCamera
+from hardware.surface import Surface
+from utils.shared_frames import SharedFrameRing
+
+CAM_SIZE = (200, 160)
+PRJ_SIZE = (200, 160)
+
+
+class ThresholdSegmenter:
+    """ Marks bright pixels as people, and remembers what it was given """
+
+    def __init__(self):
+        self.crops = []
+
+    def predict(self, frame):
+        self.crops.append(frame.shape[:2])
+        colored = np.where(frame > 100, 255, 0).astype(np.uint8)
+        return SimpleNamespace(colored=colored)
+
+
+class FakeSegmenter:
+    """ Marks the whole frame as a person while person is True """
+
+    def __init__(self):
+        self.person = False
+        self.calls = 0
+
+    def predict(self, frame):
+        self.calls += 1
+        colored = np.full_like(frame, 255 if self.person else 0)
+        return SimpleNamespace(colored=colored)
+
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size]]
+
+
+def noise():
+    return np.random.RandomState(0).randint(0, 255, CAM_SIZE[::-1] + (3,),
+                                            np.uint8)
+
+
+def gray(value):
+    return np.full(CAM_SIZE[::-1] + (3,), value, np.uint8)
+
+
+def full_surface():
+    w, h = CAM_SIZE
+    corners = [[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]]
+    return Surface(corners, corners)
+
+
+@pytest.fixture
+def make_demo():
+    cameras = []
+
+    def make(segmenter=None, surfaces=None, **kwargs):
+        surfaces = [full_surface()] if surfaces is None else surfaces
+        cameras.append(ReplayCamera([gray(50)], loop=True))
+        return Demo(camera=cameras[-1],
+                    projector=HeadlessProjector(*PRJ_SIZE, surfaces=surfaces),
+                    segmentation_brain=segmenter or FakeSegmenter(),
+                    detector_brain=None,
+                    device=None,
+                    **kwargs)
+
+    yield make
+    for camera in cameras:
+        camera.close()
+
+
+def test_background_learns_while_person_present(make_demo):
+    segmenter = FakeSegmenter()
+    demo = make_demo(segmenter)
+    demo.run_person_segmentation(gray(50))
+
+    # Someone walks in, and the lights change while they're there
+    segmenter.person = True
+    demo.run_person_segmentation(gray(150))
+    assert demo.is_person
+    for _ in range(60):
+        demo.run_person_segmentation(gray(150))
+
+    # Once they leave, the new lighting is background, not motion
+    segmenter.person = False
+    demo.run_person_segmentation(gray(150))
+    assert not demo.is_person
+    calls = segmenter.calls
+    assert not demo.motion_detected(gray(150))
+    demo.run_person_segmentation(gray(150))
+    assert segmenter.calls == calls
+
+
+def test_unknown_crop_mode(make_demo):
+    with pytest.raises(ValueError):
+        make_demo(crop_mode="everything")
+
+
+@pytest.mark.parametrize("crop_mode, rois", [
+    (Demo.CROP_NONE, [(0, 0, 200, 160)]),
+    (Demo.CROP_UNION, [(0, 0, 137, 87)]),
+    (Demo.CROP_SURFACES, [(0, 0, 57, 57), (74, 24, 137, 87)]),
+])
+def test_crop_modes(make_demo, crop_mode, rois):
+    segmenter = ThresholdSegmenter()
+    surfaces = [Surface(square(10, 10, 30), square(10, 10, 30)),
+                Surface(square(90, 40, 30), square(90, 40, 30))]
+    demo = make_demo(segmenter, surfaces, crop_mode=crop_mode)
+    frame = noise()
+
+    canvas = demo.segment(frame)
+    assert segmenter.crops == [(y2 - y1, x2 - x1) for x1, y1, x2, y2 in rois]
+
+    # Inside the crops the labels are the same as segmenting the whole
+    # frame, and outside of them nothing is labelled
+    expected = ThresholdSegmenter().predict(frame).colored
+    inside = np.zeros(frame.shape[:2], bool)
+    for x1, y1, x2, y2 in rois:
+        inside[y1:y2, x1:x2] = True
+    assert np.array_equal(canvas[inside], expected[inside])
+    assert not canvas[~inside].any()
+
+
+def run_frames(demo, count):
+    """ Run frames of someone standing still, returning which were
+    segmented rather than propagated """
+    segmented = []
+    for _ in range(count):
+        calls = demo.segmenter.calls
+        demo.run_person_segmentation(gray(150))
+        segmented.append(demo.segmenter.calls > calls)
+    return segmented
+
+
+def test_keyframe_interval(make_demo):
+    segmenter = FakeSegmenter()
+    segmenter.person = True
+    demo = make_demo(segmenter, keyframe_interval=3)
+
+    assert demo.keyframe_due()
+    assert run_frames(demo, 7) == [True, False, False, True, False, False,
+                                   True]
+    assert (demo.frames_inferred, demo.frames_propagated,
+            demo.frames_skipped) == (3, 4, 0)
+
+
+def test_keyframe_period(make_demo):
+    segmenter = FakeSegmenter()
+    segmenter.person = True
+    demo = make_demo(segmenter, keyframe_interval=100, keyframe_period=60)
+
+    assert run_frames(demo, 3) == [True, False, False]
+    # Pretend the last keyframe was a minute ago
+    demo._last_keyframe_time -= 60
+    assert demo.keyframe_due()
+    assert run_frames(demo, 2) == [True, False]
+
+
+def test_still_frames_are_skipped(make_demo):
+    demo = make_demo()
+    demo.run_person_segmentation(gray(50))
+    assert (demo.frames_inferred, demo.frames_propagated,
+            demo.frames_skipped) == (0, 0, 1)
+    assert not demo.propagator.has_keyframe
+
+
+class LeasingSegmenter:
+    """ Hands back results leased from a ring, like a ProcessSegmenter """
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def predict(self, frame):
+        seq = self.ring.write(np.full_like(frame, 255))
+        return SimpleNamespace(colored=self.ring.lease_seq(seq)[2])
+
+
+def test_leased_results_are_copied(make_demo):
+    ring = SharedFrameRing(CAM_SIZE[::-1] + (3,), slots=2)
+    try:
+        demo = make_demo(LeasingSegmenter(ring))
+        canvas = demo.segment(gray(50))
+        assert canvas.flags.writeable
+        gc.collect()
+        assert sum(ring._pins) == 0
+    finally:
+        ring.close()
+        gc.collect()
+        ring.unlink()
+
+
+def test_camera_needs_more_slots_than_frames_held(make_demo):
+    # Without a detector, there's no frame waiting for it
+    demo = make_demo()
+    demo.cam.ring = SimpleNamespace(
+        slots=Demo.frames_held(async_detection=False))
+    with pytest.raises(ValueError):
+        demo.check_camera_slots()
+
+    demo.cam.ring.slots += 1
+    demo.check_camera_slots()
+    with pytest.raises(ValueError):
+        demo.check_camera_slots(pipelined=True)
@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+import pytest
+
+from utils import draw_utils
+
+SHAPES = {"gray": (48, 64), "bgr": (48, 64, 3), "bgra": (48, 64, 4)}
+
+
+def reference_grid(shape, rows, cols, color):
+    """ The grid drawn one cv2.line at a time """
+    img = np.zeros(shape, np.uint8)
+    width, height = int(shape[1] / cols), int(shape[0] / rows)
+    for col in range(cols):
+        cv2.line(img, (width * col, 0), (width * col, shape[0]), color)
+    for row in range(rows):
+        cv2.line(img, (0, height * row), (shape[1], height * row), color)
+    return img
+
+
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_draw_grid(shape):
+    color = (255, 128, 64)
+    img = draw_utils.draw_grid(np.zeros(shape, np.uint8), 5, 7, color)
+    assert np.array_equal(img, reference_grid(shape, 5, 7, color))
+
+
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_apply_grid_overlay(shape):
+    img = np.zeros(shape, np.uint8)
+    img[10:20, 10:20] = 90
+
+    out = draw_utils.apply_grid_overlay(img, 4, 4)
+    grid = reference_grid(shape, 4, 4, (255, 255, 255))
+    assert np.array_equal(out[10:20, 10:20], img[10:20, 10:20])
+    assert np.array_equal(out[30:], grid[30:])
+
+
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_compositor(shape):
+    compositor = draw_utils.Compositor()
+    compositor.add_static(
+        "grid", lambda layer: draw_utils.draw_grid(layer, 3, 3))
+
+    labels = np.zeros(shape, np.uint8)
+    labels[5:15, 5:15] = 200
+    out = compositor.compose(labels)
+
+    expected = reference_grid(shape, 3, 3, (255, 255, 255))
+    expected[5:15, 5:15] = 200
+    assert np.array_equal(out, expected)
@@ -0,0 +1,85 @@
+import os
+import socket
+from threading import Thread
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from inference_service import (DETECTOR, SEGMENTER, InferenceClient,
+                               InferenceServer, RemoteDetector,
+                               RemoteSegmenter)
+
+
+class FakeSegmenter:
+    def predict(self, frame):
+        return SimpleNamespace(colored=frame[..., ::-1].copy())
+
+
+class ShortDetector:
+    """ A batched detector that drops the last frame of every batch """
+
+    def predict(self, frames):
+        return [[SimpleNamespace(name="person", rect=(0, 0, 1, 1))]
+                for _ in frames[:-1]]
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / "inference.sock")
+
+
+def serve(socket_path, models, **kwargs):
+    server = InferenceServer(socket_path, models, **kwargs)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_segmenter_round_trip(socket_path):
+    server = serve(socket_path, {SEGMENTER: FakeSegmenter()})
+    client = InferenceClient(socket_path)
+    try:
+        frame = np.random.randint(0, 255, (12, 16, 3), dtype=np.uint8)
+        colored = RemoteSegmenter(client).predict(frame).colored
+        assert np.array_equal(colored, frame[..., ::-1])
+    finally:
+        client.close()
+        server.close()
+
+
+def test_missing_results_are_errors(socket_path):
+    server = serve(socket_path, {DETECTOR: ShortDetector()},
+                   batched=[DETECTOR], max_wait=0)
+    client = InferenceClient(socket_path)
+    try:
+        with pytest.raises(RuntimeError):
+            RemoteDetector(client).predict([np.zeros((4, 4, 3), np.uint8)])
+    finally:
+        client.close()
+        server.close()
+
+
+def test_stale_socket_is_replaced(socket_path):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+
+    InferenceServer(socket_path, {}).close()
+    assert not os.path.exists(socket_path)
+
+
+def test_live_socket_is_kept(socket_path):
+    server = serve(socket_path, {SEGMENTER: FakeSegmenter()})
+    try:
+        with pytest.raises(OSError):
+            InferenceServer(socket_path, {})
+        assert os.path.exists(socket_path)
+    finally:
+        server.close()
+
+
+def test_other_files_are_kept(socket_path):
+    open(socket_path, "w").close()
+    with pytest.raises(OSError):
+        InferenceServer(socket_path, {})
+    assert os.path.isfile(socket_path)
@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from hardware.camera import Camera
+from hardware.projector import HeadlessProjector
+from hardware.replay import ReplayCamera
+from hardware.simulation import SimulatedCapture
+from hardware.surface import Surface
+from utils.latency import FrameTrace, LatencyProbe
+
+SURFACE = Surface([[50, 40], [350, 60], [340, 280], [60, 300]],
+                  [[25, 20], [600, 15], [615, 350], [10, 345]])
+
+
+class StillCamera:
+    """ Just enough of a Camera to lay out a probe """
+
+    def read(self):
+        return 0, np.zeros((360, 640, 3), np.uint8)
+
+
+def make_probe():
+    prj = SimpleNamespace(surfaces=[SURFACE])
+    return LatencyProbe(StillCamera(), prj)
+
+
+def test_probe_decodes_every_value():
+    probe = make_probe()
+    for value in range(2 ** probe.bits):
+        frame = probe.draw(value)
+        assert probe.read(frame) == value
+
+
+def test_probe_rejects_low_contrast():
+    probe = make_probe()
+    frame = probe.draw(0b10110101)
+
+    # Halfway between two values, every cell is the same gray
+    mixed = cv2.addWeighted(frame, 0.5, 255 - frame, 0.5, 0)
+    assert probe.read(mixed) is None
+
+
+def test_frame_trace_durations():
+    trace = FrameTrace(1, 10.0)
+    trace.marks = [("wait", 10.5), ("label", 10.75)]
+    assert trace.durations() == [("wait", 0.5), ("label", 0.25)]
+    assert trace.total == 0.75
+
+
+def test_simulated_display_latency():
+    delay = 0.05
+    prj = HeadlessProjector(640, 360, surfaces=[SURFACE])
+    cam = Camera(SimulatedCapture(prj, [SURFACE], resolution=(640, 360),
+                                  fps=120, delay=delay))
+    try:
+        report = LatencyProbe(cam, prj).run(samples=5)
+    finally:
+        cam.close()
+
+    assert report["display"]["count"] == 5
+    assert report["display"]["p50_ms"] >= delay * 1000
+
+
+def test_probe_gives_up_when_never_seen():
+    # The camera is pointed somewhere else, and only ever sees black
+    prj = HeadlessProjector(640, 360, surfaces=[SURFACE])
+    cam = ReplayCamera([np.zeros((360, 640, 3), np.uint8)], fps=100,
+                       loop=True)
+    try:
+        with pytest.raises(TimeoutError):
+            LatencyProbe(cam, prj).run(samples=5, timeout=0.05, max_missed=3)
+    finally:
+        cam.close()
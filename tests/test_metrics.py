@@ -0,0 +1,35 @@
+from threading import Thread
+
+from utils.metrics import Metrics
+
+
+def test_concurrent_hooks():
+    metrics = Metrics(enabled=True)
+
+    def record():
+        for _ in range(5000):
+            metrics.increment("count")
+            metrics.observe("latency", 0.001)
+            metrics.tick("rate")
+            metrics.set_gauge("gauge", 1)
+
+    threads = [Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        metrics.snapshot()
+    for thread in threads:
+        thread.join()
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["count"] == 20000
+    assert snapshot["latency"]["latency"]["count"] == metrics.window
+
+
+def test_disabled_records_nothing():
+    metrics = Metrics()
+    metrics.increment("count")
+    with metrics.timer("latency"):
+        pass
+    assert metrics.snapshot() == {"latency": {}, "fps": {}, "counters": {},
+                                  "gauges": {}}
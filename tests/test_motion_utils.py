@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+
+from utils.motion_utils import MaskPropagator, MotionDetector
+
+
+def textured(shift=0):
+    """ A smooth random texture, moved shift pixels to the right """
+    rng = np.random.RandomState(0)
+    frame = cv2.GaussianBlur(rng.randint(0, 255, (240, 320, 3), np.uint8),
+                             (0, 0), 4)
+    frame = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX)
+    return np.roll(frame, shift, axis=1)
+
+
+def person(shift=0):
+    canvas = np.zeros((240, 320, 3), np.uint8)
+    canvas[80:160, 100 + shift:180 + shift] = 255
+    return canvas
+
+
+def test_propagate_needs_keyframe():
+    propagator = MaskPropagator()
+    assert not propagator.has_keyframe
+    assert propagator.propagate(textured()) is None
+
+    propagator.set_keyframe(textured(), person())
+    assert propagator.has_keyframe
+    propagator.reset()
+    assert propagator.propagate(textured()) is None
+
+
+def test_propagate_follows_motion():
+    propagator = MaskPropagator()
+    propagator.set_keyframe(textured(), person())
+
+    canvas = propagator.propagate(textured(shift=8))
+    assert canvas is not None
+    assert propagator.last_error <= propagator.max_error
+    # The person moved along with the frame
+    wrong = np.count_nonzero(canvas[..., 0] != person(shift=8)[..., 0])
+    assert wrong < 0.05 * np.count_nonzero(person()[..., 0])
+
+
+def test_propagate_gives_up_on_unexplained_change():
+    propagator = MaskPropagator()
+    propagator.set_keyframe(textured(), person())
+
+    assert propagator.propagate(255 - textured()) is None
+    assert propagator.last_error > propagator.max_error
+    # Frames of another size can't be compared to the keyframe
+    assert propagator.propagate(textured()[:120]) is None
+
+
+def test_keyframe_is_kept_when_canvas_changes():
+    propagator = MaskPropagator()
+    canvas = person()
+    propagator.set_keyframe(textured(), canvas)
+    canvas[:] = 0
+    assert propagator.propagate(textured()).any()
+
+
+def test_motion_detector_counts_moved_pixels():
+    detector = MotionDetector(scale=0.5)
+    frame = np.zeros((100, 200), np.uint8)
+    assert detector.update(frame) == 0
+
+    moved = frame.copy()
+    moved[20:60, 40:80] = 255
+    assert abs(detector.update(moved) - 40 * 40) < 400
@@ -0,0 +1,72 @@
+from hardware.presenter import Presenter
+
+
+class FakeClock:
+    """ A clock that only moves when slept on """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_presenter():
+    clock = FakeClock()
+    shown = []
+    # A period of 1/4 second adds up without rounding error
+    presenter = Presenter(shown.append, fps=4, clock=clock,
+                          sleeper=clock.sleep)
+    return presenter, clock, shown
+
+
+def test_presents_once_per_deadline():
+    presenter, clock, shown = make_presenter()
+    presenter.submit("a")
+    assert presenter.present_if_due()
+    presenter.submit("b")
+    assert not presenter.present_if_due()
+    assert presenter.time_until_due() == 0.25
+
+    presenter.wait_and_present()
+    assert clock.now == 0.25
+    assert shown == ["a", "b"]
+
+
+def test_replaced_frames_are_dropped():
+    presenter, clock, shown = make_presenter()
+    presenter.present_if_due()
+    for frame in "abc":
+        presenter.submit(frame)
+    presenter.wait_and_present()
+
+    assert shown == ["c"]
+    assert presenter.stats == {"presented": 1, "dropped": 2, "missed": 0,
+                               "repeats": 1}
+
+
+def test_late_deadlines_are_missed():
+    presenter, clock, shown = make_presenter()
+    presenter.submit("a")
+    presenter.present_if_due()
+
+    # Stall for two and a half periods past the next deadline
+    clock.sleep(0.25 + 0.625)
+    presenter.submit("b")
+    assert presenter.present_if_due()
+    assert shown == ["a", "b"]
+    assert presenter.missed == 2
+
+    # The schedule stays on the original grid of deadlines
+    assert presenter.time_until_due() == 0.125
+
+
+def test_deadlines_without_frames_repeat():
+    presenter, clock, shown = make_presenter()
+    for _ in range(3):
+        presenter.wait_and_present()
+    assert shown == []
+    assert presenter.stats["repeats"] == 3
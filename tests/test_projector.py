@@ -0,0 +1,133 @@
+import cv2
+import numpy as np
+
+from hardware.projector import HeadlessProjector
+from hardware.surface import Surface
+
+CAM_SIZE = (200, 100)
+PRJ_SIZE = (200, 100)
+
+
+def square(x, y, size=100):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size]]
+
+
+def halves():
+    """ A camera frame that's 50 on the left and 200 on the right """
+    frame = np.full(CAM_SIZE[::-1] + (3,), 50, np.uint8)
+    frame[:, CAM_SIZE[0] // 2:] = 200
+    return frame
+
+
+def test_later_surfaces_win_overlaps():
+    # Both halves of the camera land on the middle of the projector
+    left = Surface(square(0, 0), square(0, 0))
+    right = Surface(square(100, 0), square(50, 0))
+    prj = HeadlessProjector(*PRJ_SIZE, surfaces=[left, right])
+
+    warped = prj.get_warped_frame(halves())
+    assert (warped[50, 25] == 50).all()
+    # Where they overlap, the right surface replaces the left one rather than
+    # being OR'd with it (50 | 200 would be 250)
+    assert (warped[50, 75] == 200).all()
+
+    prj.surfaces = [right, left]
+    assert (prj.get_warped_frame(halves())[50, 75] == 50).all()
+
+
+def test_changing_surfaces_rebuilds_tables():
+    prj = HeadlessProjector(*PRJ_SIZE,
+                            surfaces=[Surface(square(0, 0), square(0, 0))])
+    assert not prj.get_warped_frame(halves())[50, 150].any()
+
+    prj.surfaces.append(Surface(square(100, 0), square(100, 0)))
+    prj.invalidate_surfaces()
+    assert (prj.get_warped_frame(halves())[50, 150] == 200).all()
+
+
+def old_warp(prj, frame):
+    """ How get_warped_frame used to work: one masked warpPerspective per
+    surface, OR'd together """
+    out = np.zeros((prj.monitor.height, prj.monitor.width) + frame.shape[2:],
+                   np.uint8)
+    for surface in prj.surfaces:
+        out |= surface.warp_to_camera(frame, (prj.monitor.width,
+                                              prj.monitor.height))
+    return out
+
+
+def test_remap_matches_per_surface_warps():
+    surfaces = [Surface([[10, 10], [300, 30], [280, 220], [20, 200]],
+                        [[0, 0], [320, 10], [330, 230], [5, 240]]),
+                Surface([[350, 40], [620, 20], [630, 300], [340, 330]],
+                        [[360, 0], [640, 0], [630, 360], [350, 340]])]
+    prj = HeadlessProjector(640, 360, surfaces=surfaces)
+
+    rng = np.random.RandomState(0)
+    frame = cv2.GaussianBlur(rng.randint(0, 255, (360, 640, 3), np.uint8),
+                             (0, 0), 3)
+    expected = old_warp(prj, frame)
+    warped = prj.get_warped_frame(frame)
+
+    # Away from the polygon edges, where the two round differently, the
+    # images are the same up to interpolation error
+    covered = np.zeros((360, 640), np.uint8)
+    for surface in surfaces:
+        cv2.fillPoly(covered, [np.int32(surface.prj_points)], 255)
+    kernel = np.ones((5, 5), np.uint8)
+    inside = cv2.erode(covered, kernel, borderType=cv2.BORDER_CONSTANT,
+                       borderValue=0) > 0
+    outside = cv2.dilate(covered, kernel) == 0
+
+    diff = np.abs(warped.astype(int) - expected.astype(int))
+    assert diff[inside].max() <= 2
+    assert not warped[outside].any()
+
+
+def test_reused_buffers_match():
+    prj = HeadlessProjector(*PRJ_SIZE, reuse_buffers=True,
+                            surfaces=[Surface(square(0, 0), square(0, 0))])
+    first = prj.get_warped_frame(halves())
+    second = prj.get_warped_frame(halves())
+    assert first is second
+    assert np.array_equal(second, HeadlessProjector(
+        *PRJ_SIZE, surfaces=prj.surfaces).get_warped_frame(halves()))
+
+
+def test_empty_frame_is_cleared_and_reused():
+    prj = HeadlessProjector(*PRJ_SIZE)
+    frame = prj.empty_frame
+    frame[:] = 255
+    assert prj.empty_frame is frame
+    assert not frame.any()
+    assert frame.shape == PRJ_SIZE[::-1] + (3,)
+
+
+def test_union_pixels_count_overlaps_once():
+    left = Surface(square(0, 0), square(0, 0))
+    right = Surface(square(50, 0), square(100, 0))
+    prj = HeadlessProjector(*PRJ_SIZE, surfaces=[left, right])
+    mask = np.zeros(CAM_SIZE[::-1], np.uint8)
+    mask[20:40, 40:70] = 255
+
+    assert prj.count_union_pixels(mask, correct_stretch=False) == 20 * 30
+    assert sum(prj.count_surface_pixels(mask, correct_stretch=False)) > \
+        20 * 30
+    # With no stretch, every camera pixel covers one projector pixel
+    assert np.isclose(prj.count_union_pixels(mask), 20 * 30, rtol=0.01)
+
+
+def test_union_pixels_correct_stretch():
+    # The camera square is shown at twice the size on the projector
+    surface = Surface(square(0, 0, 50), square(0, 0, 100))
+    prj = HeadlessProjector(*PRJ_SIZE, surfaces=[surface])
+    mask = np.zeros(CAM_SIZE[::-1], np.uint8)
+    mask[10:30, 10:30] = 255
+
+    assert np.isclose(prj.count_union_pixels(mask), 4 * 20 * 20, rtol=0.01)
+    assert np.isclose(prj.count_union_pixels(mask),
+                      prj.count_surface_pixels(mask)[0])
+    # Pixels off of the surface aren't counted
+    mask[:] = 0
+    mask[10:30, 150:170] = 255
+    assert prj.count_union_pixels(mask) == 0
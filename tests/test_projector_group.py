@@ -0,0 +1,60 @@
+import numpy as np
+
+from hardware.projector import HeadlessProjector
+from hardware.projector_group import ProjectorGroup
+from hardware.surface import Surface
+
+CAM_SIZE = (160, 120)
+PRJ_SIZE = (200, 100)
+
+LEFT = Surface([[0, 0], [100, 0], [100, 100], [0, 100]],
+               [[0, 0], [100, 0], [100, 100], [0, 100]])
+RIGHT = Surface([[50, 0], [150, 0], [150, 100], [50, 100]],
+                [[100, 0], [200, 0], [200, 100], [100, 100]])
+
+
+def make_group(**kwargs):
+    return ProjectorGroup([HeadlessProjector(*PRJ_SIZE, surfaces=[LEFT]),
+                           HeadlessProjector(*PRJ_SIZE, surfaces=[RIGHT])],
+                          **kwargs)
+
+
+def test_warps_match_each_projector():
+    group = make_group()
+    try:
+        frame = np.random.randint(0, 255, CAM_SIZE[::-1] + (3,), np.uint8)
+        warped = group.get_warped_frame(frame)
+        for projector, out in zip(group.projectors, warped):
+            assert np.array_equal(out, projector.get_warped_frame(frame))
+    finally:
+        group.close()
+
+
+def test_frames_survive_the_next_warp():
+    group = make_group(buffers=2)
+    try:
+        frames = [np.full(CAM_SIZE[::-1] + (3,), value, np.uint8)
+                  for value in (10, 20, 30)]
+        first = group.get_warped_frame(frames[0])
+        second = group.get_warped_frame(frames[1])
+        assert first[0][50, 50, 0] == 10
+        assert second[0][50, 50, 0] == 20
+
+        # The third warp reuses the first one's buffers
+        third = group.get_warped_frame(frames[2])
+        assert third[0] is first[0]
+        assert second[0][50, 50, 0] == 20
+    finally:
+        group.close()
+
+
+def test_union_counts_overlap_once():
+    group = make_group()
+    try:
+        mask = np.full(CAM_SIZE[::-1], 255, np.uint8)
+        per_surface = group.count_surface_pixels(mask, correct_stretch=False)
+        union = group.count_union_pixels(mask, correct_stretch=False)
+        assert np.allclose(per_surface, [101 * 101] * 2)
+        assert np.isclose(union, 151 * 101)
+    finally:
+        group.close()
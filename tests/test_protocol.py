@@ -0,0 +1,104 @@
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from time import sleep, time
+
+import pytest
+
+from hanover_resources import protocol as wire
+from hanover_resources.communication import Device
+
+
+def ack(seq, value):
+    return wire.encode_frame(seq, wire.CMD_ACK,
+                             wire.encode_signal(wire.SIGNALS["person"], value))
+
+
+def test_signal_round_trip():
+    payload = wire.parse_ascii_command("person:1")
+    frame = wire.encode_frame(7, wire.CMD_SET_SIGNAL, payload)
+
+    frames = wire.FrameParser().feed(frame)
+    assert len(frames) == 1
+    seq, cmd, payload = frames[0]
+    assert (seq, cmd) == (7, wire.CMD_SET_SIGNAL)
+    assert wire.decode_signal(payload) == (wire.SIGNALS["person"], 1.0)
+
+
+def test_decode_rejects_wrong_size():
+    with pytest.raises(ValueError):
+        wire.decode_signal(b"\x00\x01")
+
+
+def test_parser_split_frames():
+    stream = ack(1, 1) + ack(2, 0)
+    parser = wire.FrameParser()
+
+    frames = []
+    for i in range(len(stream)):
+        frames += parser.feed(stream[i:i + 1])
+    assert [seq for seq, _, _ in frames] == [1, 2]
+    assert parser.corrupt_frames == 0
+
+
+def test_parser_skips_corrupt_frames():
+    bad = bytearray(ack(1, 1))
+    bad[-1] ^= 0xFF
+    parser = wire.FrameParser()
+
+    frames = parser.feed(b"\x00\x13" + bytes(bad) + ack(2, 0))
+    assert [seq for seq, _, _ in frames] == [2]
+    assert parser.corrupt_frames == 1
+
+
+def test_parser_skips_oversized_length():
+    parser = wire.FrameParser()
+    frames = parser.feed(bytes([wire.START, 0, wire.CMD_ACK, 255]) + ack(3, 1))
+    assert [seq for seq, _, _ in frames] == [3]
+    assert parser.corrupt_frames == 1
+
+
+def wait_for_pending(device, timeout=1):
+    deadline = time() + timeout
+    while not device._pending:
+        assert time() < deadline, "The command was never sent"
+        sleep(0.01)
+
+
+def test_device_loopback_ack():
+    device = Device("loop://", protocol=Device.PROTOCOL_V2, reset_delay=0)
+    try:
+        future = device.send_command("person:1")
+        wait_for_pending(device)
+
+        # loop:// reads back whatever is written, so this acts as the robot
+        device._serial.write(ack(0, 1))
+        assert future.result(timeout=1) == "OK:1.00"
+
+        # The echo of our own SET_SIGNAL command was not taken as the ack
+        assert device.bad_frames == 1
+    finally:
+        device.close()
+
+
+def test_device_ignores_echoed_command():
+    device = Device("loop://", protocol=Device.PROTOCOL_V2, reset_delay=0)
+    try:
+        future = device.send_command("person:1")
+        with pytest.raises((TimeoutError, FutureTimeoutError)):
+            future.result(timeout=Device.RESPONSE_TIMEOUT + 1)
+        assert device.bad_frames == 1
+        assert device._read_thread.is_alive()
+    finally:
+        device.close()
+
+
+def test_device_survives_bad_payload():
+    device = Device("loop://", protocol=Device.PROTOCOL_V2, reset_delay=0)
+    try:
+        future = device.send_command("person:0")
+        wait_for_pending(device)
+        device._serial.write(wire.encode_frame(0, wire.CMD_ACK, b"\x00"))
+        device._serial.write(ack(0, 0))
+        assert future.result(timeout=1) == "OK:0.00"
+        assert device.bad_frames == 2
+    finally:
+        device.close()
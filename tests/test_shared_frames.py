@@ -0,0 +1,113 @@
+import functools
+import gc
+from threading import Thread
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from utils.shared_frames import ProcessSegmenter, SharedFrameRing
+
+
+class Inverter:
+    def predict(self, frame):
+        return SimpleNamespace(colored=255 - frame)
+
+
+class Broken:
+    def predict(self, frame):
+        raise ValueError("Bad frame")
+
+
+def load_model(model):
+    return model()
+
+
+@pytest.fixture
+def ring():
+    ring = SharedFrameRing((4, 6, 3), slots=2)
+    yield ring
+    ring.close()
+    gc.collect()
+    ring.unlink()
+
+
+def test_lease_pins_slot(ring):
+    frame = np.full((4, 6, 3), 7, np.uint8)
+    seq = ring.write(frame)
+    _, _, leased = ring.lease_seq(seq)
+
+    assert np.array_equal(leased, frame)
+    assert not leased.flags.writeable
+    with pytest.raises(ValueError):
+        leased[0, 0] = 0
+
+    # A view of the frame keeps the slot pinned after the frame is gone
+    row = leased[1]
+    del leased
+    assert sum(ring._pins) == 1
+
+    # With every slot pinned, writers have nowhere to go
+    _, _, other = ring.lease_seq(ring.write(frame))
+    with pytest.raises(RuntimeError):
+        ring.begin_write(timeout=0)
+
+    del row, other
+    assert sum(ring._pins) == 0
+    ring.begin_write(timeout=0)
+
+
+def test_lease_next_is_zero_copy(ring):
+    ring.write(np.zeros((4, 6, 3), np.uint8))
+    _, _, first = ring.lease_next(0)
+    _, _, second = ring.lease_next(0)
+    assert np.shares_memory(first, second)
+
+
+def test_writer_progresses_while_leases_are_held():
+    held = 3
+    ring = SharedFrameRing((4, 6), slots=held + 1)
+    try:
+        leases = [ring.lease_seq(ring.write(np.full((4, 6), i, np.uint8)))[2]
+                  for i in range(held)]
+
+        # The writer keeps going through the one slot nobody is holding
+        writer = Thread(target=lambda: [
+            ring.write(np.full((4, 6), 100 + i, np.uint8), timeout=1)
+            for i in range(20)])
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+        assert ring.latest_seq == held + 20
+        _, _, latest = ring.lease_next(ring.latest_seq - 1)
+        assert (latest == 119).all()
+        assert [int(lease[0, 0]) for lease in leases] == list(range(held))
+    finally:
+        del leases, latest
+        ring.close()
+        gc.collect()
+        ring.unlink()
+
+
+def test_process_segmenter():
+    segmenter = ProcessSegmenter(functools.partial(load_model, Inverter),
+                                 (8, 8, 3))
+    try:
+        frame = np.random.randint(0, 255, (5, 8, 3), dtype=np.uint8)
+        colored = segmenter.predict(frame).colored
+        assert np.array_equal(colored, 255 - frame)
+        assert not colored.flags.writeable
+    finally:
+        del colored
+        segmenter.close()
+
+
+def test_process_segmenter_errors():
+    segmenter = ProcessSegmenter(functools.partial(load_model, Broken),
+                                 (8, 8, 3))
+    try:
+        for _ in range(2):
+            with pytest.raises(ValueError, match="Bad frame"):
+                segmenter.predict(np.zeros((8, 8, 3), np.uint8))
+    finally:
+        segmenter.close()
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+import pytest
+
+from hardware.camera import Camera
+from hardware.projector import HeadlessProjector
+from hardware.simulation import SimulatedCapture
+from hardware.structured_light import (StructuredLightCalibrator,
+                                       gray_code_bits, gray_code_pattern)
+from hardware.surface import Surface
+
+CAM_SIZE = (640, 360)
+PRJ_SIZE = (640, 360)
+
+
+def test_gray_code_patterns_decode():
+    width, stripe = 100, 2
+    n_bits = gray_code_bits(width, stripe)
+    bits = [gray_code_pattern(width, 1, bit, stripe=stripe)[0] > 0
+            for bit in range(n_bits)]
+
+    # Convert the Gray code back to binary, one bit at a time
+    value = np.zeros(width, dtype=int)
+    binary = np.zeros(width, dtype=bool)
+    for bit in bits:
+        binary ^= bit
+        value = value << 1 | binary
+    assert np.array_equal(value, np.arange(width) // stripe)
+
+
+@pytest.fixture
+def truth():
+    return [Surface([[50, 40], [350, 60], [340, 280], [60, 300]],
+                    [[25, 20], [600, 15], [615, 350], [10, 345]]),
+            Surface([[400, 50], [600, 75], [590, 250], [410, 225]],
+                    [[350, 50], [550, 40], [560, 200], [340, 210]])]
+
+
+def test_simulated_calibration(truth):
+    prj = HeadlessProjector(*PRJ_SIZE)
+    cam = Camera(SimulatedCapture(prj, truth, resolution=CAM_SIZE, fps=120))
+    try:
+        calibrator = StructuredLightCalibrator(cam, prj, settle_time=0)
+        prj_x, prj_y = calibrator.decode()
+        surfaces = calibrator.fit_surfaces(prj_x, prj_y)
+    finally:
+        cam.close()
+
+    # Decoded projector coordinates are within a pixel of the truth
+    for surface in truth:
+        ys, xs = np.nonzero(surface.get_mask(CAM_SIZE[::-1]))
+        expected = cv2.perspectiveTransform(
+            np.float32(np.column_stack((xs, ys))).reshape(-1, 1, 2),
+            surface._to_projector_mat).reshape(-1, 2)
+        decoded = np.column_stack((prj_x[ys, xs], prj_y[ys, xs]))
+        valid = decoded[:, 0] >= 0
+        assert valid.mean() > 0.75
+        assert np.median(np.abs(decoded[valid] - expected[valid])) < 1
+
+    # Each fitted surface maps its inner points where the true one does
+    assert len(surfaces) == len(truth)
+    for surface in surfaces:
+        center = np.float32(surface.cam_points).mean(axis=0)
+        match = [s for s in truth if cv2.pointPolygonTest(
+            np.float32(s.cam_points), tuple(map(float, center)), False) > 0]
+        assert len(match) == 1
+
+        points = np.float32(surface.cam_points * 0.8 + center * 0.2)
+        points = points.reshape(-1, 1, 2)
+        error = np.abs(
+            cv2.perspectiveTransform(points, surface._to_projector_mat) -
+            cv2.perspectiveTransform(points, match[0]._to_projector_mat))
+        assert error.max() < 1
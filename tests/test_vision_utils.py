@@ -0,0 +1,194 @@
+import cv2
+import numpy as np
+
+from utils.vision_utils import (ColorClassifier, ColorTracker, _hsv_mask,
+                                _largest_blob, find_squares, get_polygon_rois)
+
+FRAME_SHAPE = (100, 200, 3)
+
+
+def test_polygon_rois_merged():
+    polygons = [[[10, 10], [30, 10], [30, 30]],
+                [[100, 50], [150, 50], [150, 80]]]
+    assert get_polygon_rois(polygons, FRAME_SHAPE) == [(10, 10, 151, 81)]
+
+
+def test_polygon_rois_per_polygon():
+    polygons = [[[10, 10], [30, 10], [30, 30]],
+                [[100, 50], [150, 50], [150, 80]]]
+    assert get_polygon_rois(polygons, FRAME_SHAPE, merge=False) == \
+        [(10, 10, 31, 31), (100, 50, 151, 81)]
+
+
+def test_polygon_rois_overlaps_are_merged():
+    # The third box only overlaps the first once the first two are merged
+    polygons = [[[0, 0], [40, 40]], [[30, 30], [60, 60]],
+                [[55, 0], [70, 35]], [[150, 50], [160, 60]]]
+    assert get_polygon_rois(polygons, FRAME_SHAPE, merge=False) == \
+        [(0, 0, 71, 61), (150, 50, 161, 61)]
+
+
+def test_polygon_rois_padding_is_clipped():
+    polygons = [[[5, 5], [20, 20]], [[180, 80], [199, 99]]]
+    assert get_polygon_rois(polygons, FRAME_SHAPE, padding=10,
+                            merge=False) == [(0, 0, 31, 31), (170, 70, 200, 100)]
+    assert get_polygon_rois([], FRAME_SHAPE) == []
+
+
+def original_find_squares(img):
+    """ find_squares as it was before it had any options, for comparison """
+    def angle_cos(p0, p1, p2):
+        d1, d2 = (p0 - p1).astype('float'), (p2 - p1).astype('float')
+        return abs(np.dot(d1, d2) / np.sqrt(np.dot(d1, d1) * np.dot(d2, d2)))
+
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+    squares = []
+    for gray in cv2.split(img):
+        for thrs in range(0, 255, 26):
+            if thrs == 0:
+                binary = cv2.Canny(gray, 0, 50, apertureSize=5)
+                binary = cv2.dilate(binary, None)
+            else:
+                _retval, binary = cv2.threshold(gray, thrs, 255,
+                                                cv2.THRESH_BINARY)
+            contours = cv2.findContours(binary, cv2.RETR_LIST,
+                                        cv2.CHAIN_APPROX_SIMPLE)[-2]
+            for cnt in contours:
+                cnt_len = cv2.arcLength(cnt, True)
+                cnt = cv2.approxPolyDP(cnt, 0.02 * cnt_len, True)
+                if len(cnt) == 4 and cv2.contourArea(cnt) > 1000 and \
+                        cv2.isContourConvex(cnt):
+                    cnt = cnt.reshape(-1, 2)
+                    max_cos = np.max([angle_cos(cnt[i], cnt[(i + 1) % 4],
+                                                cnt[(i + 2) % 4])
+                                      for i in range(4)])
+                    if max_cos < 0.1:
+                        squares.append(cnt)
+    return squares
+
+
+def squares_frame():
+    """ Three gray squares of different sizes on black, one of them tilted,
+    plus a little noise """
+    frame = np.zeros((360, 640, 3), np.uint8)
+    cv2.rectangle(frame, (40, 40), (240, 240), (200, 200, 200), -1)
+    cv2.rectangle(frame, (300, 60), (400, 160), (120, 180, 90), -1)
+    tilted = cv2.boxPoints(((520, 220), (120, 120), 20))
+    cv2.fillPoly(frame, [np.int32(np.round(tilted))], (90, 90, 250))
+    noise = np.random.RandomState(0).randint(0, 10, frame.shape, np.uint8)
+    return cv2.add(frame, noise)
+
+
+def test_find_squares_defaults_match_original():
+    frame = squares_frame()
+    expected = original_find_squares(frame)
+    found = find_squares(frame)
+    assert len(found) == len(expected) > 3
+    for square, original in zip(found, expected):
+        assert square.dtype == np.int32
+        assert np.array_equal(square, original)
+
+
+def test_find_squares_fast_path():
+    squares = find_squares(squares_frame(), levels=1, overlap=0.8)
+    # Each square once, after the edge of the frame itself
+    assert len(squares) == 4
+    areas = [cv2.contourArea(square) for square in squares]
+    assert areas == sorted(areas, reverse=True)
+
+    # Scaling back up from half resolution costs a pixel or two
+    expected = np.float32([[40, 40], [240, 40], [240, 240], [40, 240]])
+    for corner in expected:
+        assert np.abs(squares[1] - corner).sum(axis=1).min() <= 4
+
+
+TARGETS = {"red": ((170, 120, 120), (10, 255, 255)),  # Wraps around
+           "green": ((50, 120, 120), (70, 255, 255)),
+           "blue": ((110, 120, 120), (130, 255, 255))}
+
+
+def markers_frame(offset=0):
+    """ A red, a green and a blue disc on gray """
+    frame = np.full((240, 320, 3), 90, np.uint8)
+    cv2.circle(frame, (60 + offset, 60), 15, (0, 0, 230), -1)
+    cv2.circle(frame, (160 + offset, 120), 15, (0, 230, 0), -1)
+    cv2.circle(frame, (260 + offset, 180), 15, (230, 0, 0), -1)
+    return frame
+
+
+def test_color_tracker_finds_every_target():
+    tracker = ColorTracker(TARGETS)
+    points = tracker.update(markers_frame())
+    assert points == {"red": (60, 60), "green": (160, 120),
+                      "blue": (260, 180)}
+
+    # Each target is only searched for near where it was
+    assert tracker._search_window("red", 320, 240) == (13, 13, 108, 108)
+    assert tracker.update(markers_frame(offset=10)) == \
+        {"red": (70, 60), "green": (170, 120), "blue": (270, 180)}
+
+
+def test_color_tracker_finds_lost_targets_again():
+    tracker = ColorTracker(TARGETS)
+    tracker.update(markers_frame())
+
+    # The markers jump out of their windows, then are found again
+    jumped = np.roll(markers_frame(), 100, axis=1)
+    assert set(tracker.update(jumped).values()) == {None}
+    assert tracker.update(jumped) == {"red": (160, 60), "green": (260, 120),
+                                      "blue": (40, 180)}
+
+
+def test_color_tracker_matches_hsv_masks():
+    rng = np.random.RandomState(0)
+    frame = cv2.GaussianBlur(rng.randint(0, 255, (120, 160, 3), np.uint8),
+                             (0, 0), 5)
+    frame = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX)
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+
+    points = ColorTracker(TARGETS, area_thresh=10, bins=256).update(frame)
+    for name, (lowerHSV, higherHSV) in TARGETS.items():
+        blob = _largest_blob(_hsv_mask(hsv, lowerHSV, higherHSV), 10)
+        expected = None if blob is None else \
+            (int(blob[0][0]), int(blob[0][1]))
+        assert points[name] == expected
+
+
+def test_color_tracker_more_targets_than_bits():
+    targets = {"green{}".format(i): TARGETS["green"] for i in range(10)}
+    points = ColorTracker(targets).update(markers_frame())
+    assert set(points.values()) == {(160, 120)}
+
+
+def in_range(hsv, lowerHSV, higherHSV):
+    """ cv2.inRange, split in two where the hue wraps around """
+    if lowerHSV[0] <= higherHSV[0]:
+        return cv2.inRange(hsv, lowerHSV, higherHSV)
+    return cv2.bitwise_or(
+        cv2.inRange(hsv, lowerHSV, (180,) + higherHSV[1:]),
+        cv2.inRange(hsv, (0,) + lowerHSV[1:], higherHSV))
+
+
+def test_color_classifier_matches_in_range():
+    img = np.random.RandomState(0).randint(0, 256, (120, 160, 3), np.uint8)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+    classifier = ColorClassifier(TARGETS, bins=256)
+    masks = classifier.masks(img)
+    for name, (lowerHSV, higherHSV) in TARGETS.items():
+        expected = in_range(hsv, lowerHSV, higherHSV)
+        assert expected.any()
+        assert np.array_equal(masks[name], expected)
+        assert np.array_equal(classifier.mask(img, name), expected)
+
+    # A single range is classified straight into a mask
+    red = ColorClassifier({"red": TARGETS["red"]}, bins=256)
+    assert np.array_equal(red.classify(img), in_range(hsv, *TARGETS["red"]))
+
+
+def test_color_classifier_bins_only_differ_at_edges():
+    img = np.random.RandomState(1).randint(0, 256, (120, 160, 3), np.uint8)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    mask = ColorClassifier(TARGETS, bins=64).mask(img, "red")
+    wrong = np.count_nonzero(mask != in_range(hsv, *TARGETS["red"]))
+    assert wrong < 0.02 * mask.size
@@ -0,0 +1,137 @@
+from threading import Condition, Thread
+from time import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from utils.metrics import metrics
+
+
+class AsyncDetector(Thread):
+    """ Runs an object detector on a background thread at its own rate, so the
+    render loop can overlay the most recent detections without waiting for
+    them. Frames are handed over with submit(), and only the newest one is
+    kept. Detections can optionally be extrapolated to the current time using
+    how far each object moved between the last two detection runs. """
+
+    MAX_EXTRAPOLATION = 0.5  # Seconds, past which boxes stop moving
+
+    def __init__(self, detector, rate=2, extrapolate=True):
+        """
+        :param detector: An ObjectDetector, or anything whose predict() takes
+        a list of frames and returns a list of predictions for each
+        :param rate: The most times per second to run the detector
+        :param extrapolate: If True, latest() moves boxes along their
+        estimated velocity to where they should be now
+        """
+        super().__init__(daemon=True)
+        self.detector = detector
+        self.rate = rate
+        self.extrapolate = extrapolate
+        self.runs = 0
+
+        self._cond = Condition()
+        self._frame = None
+        self._frame_tstamp = None
+        self._running = True
+
+        # The newest detections, the time of the frame they came from, and a
+        # velocity (pixels per second) for each of them
+        self._preds = []
+        self._preds_tstamp = None
+        self._velocities = []
+
+        self.start()
+
+    def submit(self, frame, tstamp=None):
+        """ Offer a frame to the detector. Never blocks. """
+        with self._cond:
+            self._frame = frame
+            self._frame_tstamp = time() if tstamp is None else tstamp
+            self._cond.notify()
+
+    def latest(self, now=None):
+        """
+        :param now: The time to extrapolate the detections to
+        :return: A list of predictions with .name and .rect, and the
+        timestamp of the frame they were detected on as .tstamp
+        """
+        with self._cond:
+            preds, tstamp = self._preds, self._preds_tstamp
+            velocities = self._velocities
+        if not preds:
+            return []
+
+        elapsed = 0
+        if self.extrapolate:
+            now = time() if now is None else now
+            elapsed = min(max(now - tstamp, 0), self.MAX_EXTRAPOLATION)
+
+        return [SimpleNamespace(name=pred.name,
+                                rect=np.add(pred.rect, np.tile(v, 2) * elapsed),
+                                tstamp=tstamp)
+                for pred, v in zip(preds, velocities)]
+
+    def run(self):
+        last_run = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._frame is not None or not self._running)
+                if not self._running: break
+
+                # Don't run more often than the requested rate
+                wait = last_run + 1 / self.rate - time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                # Copy the frame, so that a frame leased from shared memory
+                # isn't pinned for as long as the detector runs
+                frame, tstamp = np.array(self._frame), self._frame_tstamp
+                self._frame = None
+
+            last_run = time()
+            try:
+                with metrics.timer("detector.predict"):
+                    preds = self.detector.predict([frame])[0]
+            except Exception as e:
+                # Keep the last good detections, and try again on the next
+                # frame
+                metrics.increment("detector.errors")
+                print("AsyncDetector| ERROR while detecting:", repr(e))
+                continue
+            velocities = self._estimate_velocities(preds, tstamp)
+            self.runs += 1
+
+            with self._cond:
+                self._preds = preds
+                self._preds_tstamp = tstamp
+                self._velocities = velocities
+
+    def _estimate_velocities(self, preds, tstamp):
+        """ Match each prediction to the nearest previous one of the same
+        class, and return how fast its center moved """
+        velocities = [np.zeros(2) for _ in preds]
+        if not self._preds or tstamp <= self._preds_tstamp:
+            return velocities
+        elapsed = tstamp - self._preds_tstamp
+
+        def center(rect):
+            return np.array([(rect[0] + rect[2]) / 2, (rect[1] + rect[3]) / 2])
+
+        for i, pred in enumerate(preds):
+            previous = [center(p.rect) for p in self._preds
+                        if p.name == pred.name]
+            if not previous: continue
+            distances = [np.linalg.norm(center(pred.rect) - c)
+                         for c in previous]
+            nearest = previous[int(np.argmin(distances))]
+            velocities[i] = (center(pred.rect) - nearest) / elapsed
+        return velocities
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self.join()
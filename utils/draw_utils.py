@@ -1,27 +1,119 @@
 import cv2
 import numpy as np
 
+# Rasterized grids for apply_grid_overlay, keyed by everything they depend on
+_grid_cache = {}
+
 
 def apply_grid_overlay(img, rows, cols, color=(255, 255, 255)):
-    """Draw a grid on all black parts of an image, while ignoring colors"""
-    grid = np.zeros_like(img)
-    draw_grid(grid, rows, cols, color)
-    labeled_pixels = img != [0, 0, 0]
-    grid[labeled_pixels] = 0
-    grid[labeled_pixels] = img[labeled_pixels]
+    """Draw a grid on all black parts of an image, while ignoring colors
+    :return: A new image, with the grid behind everything that isn't black"""
+    key = (img.shape, img.dtype, rows, cols, tuple(np.atleast_1d(color)))
+    if key not in _grid_cache:
+        grid = np.zeros_like(img)
+        draw_grid(grid, rows, cols, color)
+        _grid_cache[key] = grid
+
+    out = _grid_cache[key].copy()
+    cv2.copyTo(img, opaque_mask(img), out)
+    return out
 
 
 def draw_grid(img, rows, cols, color=(255, 255, 255)):
-    # size = int((img.shape[0] * img.shape[1]) ** .5 / (rows * cols) ** .5)
+    """Draw a grid of rows x cols cells, with each line drawn only once"""
     width = int(img.shape[1] / cols)
     height = int(img.shape[0] / rows)
 
-    for row in range(0, rows):
-        for col in range(0, cols):
-            cv2.line(img, (width * row, height * col),
-                     (img.shape[1], height * (col)), color, 1, 1)
-            cv2.line(img, (width * row, height * col),
-                     (width * (row), img.shape[0]), color, 1, 1)
+    # Straight one pixel lines are just rows and columns of pixels
+    color = _pixel_color(img, color)
+    img[:, [width * col for col in range(cols)]] = color
+    img[[height * row for row in range(rows)], :] = color
+    return img
+
+
+def _pixel_color(img, color):
+    """ Fit a color to the channels of an image the way cv2 drawing functions
+    do, using the first channels of the color and 0 for any missing ones """
+    color = np.atleast_1d(color)
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    pixel = np.zeros(channels, dtype=img.dtype)
+    count = min(channels, len(color))
+    pixel[:count] = color[:count]
+    return pixel[0] if img.ndim == 2 else pixel
+
+
+def opaque_mask(img):
+    """ A uint8 mask of the pixels that aren't black, which is how layers
+    and canvases mark what's transparent """
+    if img.ndim == 2:
+        return cv2.compare(img, 0, cv2.CMP_GT)
+    # Summing the channels with saturation is nonzero if any channel is
+    return cv2.transform(img, np.ones((1, img.shape[2])))
+
+
+class Compositor:
+    """ Stacks layers into one frame. Static layers, like grids, borders and
+    calibration guides, are drawn once per frame size and cached, already
+    flattened together. Dynamic layers, like labels and masks, are frames
+    passed in on every call and copied on top. Black is transparent. """
+
+    def __init__(self):
+        self._static = []  # [(name, draw function)], bottom first
+        self._flattened = {}  # {(shape, dtype): (frame, mask)}
+
+    def add_static(self, name, draw):
+        """
+        Add a static layer on top of the existing ones.
+        :param name: A name to remove or redraw the layer with later
+        :param draw: A function that takes a black frame and draws the layer
+        onto it, in place
+        """
+        self._static.append((name, draw))
+        self.invalidate()
+
+    def remove_static(self, name):
+        self._static = [(n, draw) for n, draw in self._static if n != name]
+        self.invalidate()
+
+    def invalidate(self):
+        """ Redraw the static layers next time, if what they draw changed """
+        self._flattened = {}
+
+    def static_layers(self, shape, dtype=np.uint8):
+        """ :return: (frame, mask) of every static layer flattened together,
+        drawn at this shape on first use """
+        key = (tuple(shape), np.dtype(dtype))
+        if key not in self._flattened:
+            frame = np.zeros(shape, dtype=dtype)
+            for _, draw in self._static:
+                layer = np.zeros(shape, dtype=dtype)
+                draw(layer)
+                cv2.copyTo(layer, opaque_mask(layer), frame)
+            self._flattened[key] = (frame, opaque_mask(frame))
+        return self._flattened[key]
+
+    def compose(self, *layers, shape=None, out=None):
+        """
+        Stack the static layers, then each dynamic layer in order, on top.
+        :param layers: Dynamic layers, all of the same shape and dtype
+        :param shape: The shape of the result, if there are no dynamic layers
+        :param out: Optionally, a frame to write the result into
+        :return: The composited frame
+        """
+        if layers:
+            shape, dtype = layers[0].shape, layers[0].dtype
+        else:
+            dtype = np.uint8
+
+        static, _ = self.static_layers(shape, dtype)
+        if out is None:
+            out = static.copy()
+        else:
+            np.copyto(out, static)
+
+        for layer in layers:
+            cv2.copyTo(layer, opaque_mask(layer), out)
+        return out
 
 
 def draw_cross(img, center, color, size):
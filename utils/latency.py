@@ -0,0 +1,195 @@
+"""
+Measuring latency, both through the pipeline and out in the real world.
+
+FrameTrace follows one camera frame through the Demo, marking when each
+stage finished, so every frame records how long it spent in each stage.
+
+LatencyProbe measures the photon-to-photon latency of the whole rig: it
+projects a binary counter onto a surface, watches for it in the camera
+stream, and as soon as it sees a value, projects the next one. The time
+between the camera seeing one value and the next is a full trip from the
+camera, through the program and projector, and back into the camera.
+"""
+from time import time
+
+import cv2
+import numpy as np
+
+from utils.metrics import Metrics, metrics
+
+
+class FrameTrace:
+    """ The timeline of a single frame. Stages are marked as they finish, and
+    each stage's duration is measured from the previous mark, starting with
+    the time the camera grabbed the frame. """
+    __slots__ = ("seq", "tstamp", "marks")
+
+    def __init__(self, seq, tstamp):
+        """
+        :param seq: The camera sequence number of the frame
+        :param tstamp: The time.time() the camera grabbed the frame at
+        """
+        self.seq = seq
+        self.tstamp = tstamp
+        self.marks = []
+
+    def mark(self, stage):
+        """ Record that a stage just finished """
+        self.marks.append((stage, time()))
+        return self
+
+    def durations(self):
+        """ :return: A list of (stage, seconds it took) """
+        durations = []
+        previous = self.tstamp
+        for stage, tstamp in self.marks:
+            durations.append((stage, tstamp - previous))
+            previous = tstamp
+        return durations
+
+    @property
+    def total(self):
+        """ Seconds from the camera grabbing the frame to the last mark """
+        return self.marks[-1][1] - self.tstamp if self.marks else 0
+
+    def record(self, registry=metrics):
+        """ Observe every stage, and the total, as trace.* latencies """
+        for stage, seconds in self.durations():
+            registry.observe("trace." + stage, seconds)
+        registry.observe("trace.total", self.total)
+
+
+class LatencyProbe:
+    """ Projects a binary counter and times how long it takes to come back
+    through the camera. The counter is drawn as a row of cells for the bits
+    and a row of inverted cells below it, so bits can be read off without
+    knowing how bright the surface is. """
+
+    def __init__(self, cam, prj, region=None, bits=8, contrast_thresh=30):
+        """
+        :param cam: A Camera (or anything with read() and read_next())
+        :param prj: The Projector, with its surfaces configured
+        :param region: (x, y, width, height) of the counter in camera
+        coordinates. By default, the middle of the first surface.
+        :param bits: How many bits the counter has
+        :param contrast_thresh: How much brighter a lit cell has to look than
+        its inverse for the bit to be read
+        """
+        self.cam = cam
+        self.prj = prj
+        self.bits = bits
+        self.contrast_thresh = contrast_thresh
+
+        _, frame = cam.read()
+        self.frame_shape = frame.shape
+        if region is None:
+            x, y, w, h = cv2.boundingRect(np.int32(prj.surfaces[0].cam_points))
+            region = (x + w // 4, y + h // 4, w // 2, h // 2)
+        self.cells = self._layout_cells(region)
+
+    def _layout_cells(self, region):
+        """ :return: A list of (x, y, w, h) for the bit cells, followed by a
+        list of the same length for the inverted cells """
+        x, y, w, h = region
+        cell_w, cell_h = w // self.bits, h // 2
+        bit_cells = [(x + i * cell_w, y, cell_w, cell_h)
+                     for i in range(self.bits)]
+        inverse_cells = [(cx, cy + cell_h, cw, ch)
+                         for cx, cy, cw, ch in bit_cells]
+        return bit_cells, inverse_cells
+
+    def draw(self, value):
+        """ :return: A camera-space canvas showing the counter value """
+        canvas = np.zeros(self.frame_shape, dtype=np.uint8)
+        for i, (bit_cell, inverse_cell) in enumerate(zip(*self.cells)):
+            lit = bit_cell if (value >> i) & 1 else inverse_cell
+            x, y, w, h = lit
+            canvas[y:y + h, x:x + w] = 255
+        return canvas
+
+    def read(self, frame):
+        """ :return: The counter value shown in a camera frame, or None if it
+        can't be read, such as mid-way through changing """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        value = 0
+        for i, (bit_cell, inverse_cell) in enumerate(zip(*self.cells)):
+            lit, unlit = self._brightness(gray, bit_cell), \
+                         self._brightness(gray, inverse_cell)
+            if abs(lit - unlit) < self.contrast_thresh:
+                return None
+            if lit > unlit:
+                value |= 1 << i
+        return value
+
+    @staticmethod
+    def _brightness(gray, cell):
+        """ The mean of the middle of a cell, away from its blurry edges """
+        x, y, w, h = cell
+        return gray[y + h // 4:y + h - h // 4,
+                    x + w // 4:x + w - w // 4].mean()
+
+    def run(self, samples=100, timeout=1, process=None, max_missed=10):
+        """
+        Measure the latency of the rig.
+        :param samples: How many round trips to time
+        :param timeout: Seconds to wait to see a value before giving up on it
+        :param process: Optionally, a function called with each camera frame
+        before the next value is projected, such as Demo.label_frame, so the
+        loop includes the work the Demo does on every frame
+        :return: Latency stats in the same format as Metrics.snapshot(). "loop"
+        is camera to camera, through process() and the projector, and
+        "display" is from rendering a value to the camera seeing it.
+        :param max_missed: How many values in a row can go unseen before
+        giving up with a TimeoutError, such as when the camera can't see the
+        projector at all
+        """
+        results = Metrics(enabled=True, window=samples)
+        value = 0
+        seen = self._show_and_wait(value, timeout)
+        measured, missed, missed_in_a_row = 0, 0, 0
+
+        while measured < samples:
+            if seen is None:
+                missed += 1
+                missed_in_a_row += 1
+                if missed_in_a_row >= max_missed:
+                    raise TimeoutError(
+                        "The camera didn't see the latency probe {} times in "
+                        "a row!".format(missed_in_a_row))
+                # Start the chain over from a fresh sighting
+                seen = self._show_and_wait(value, timeout)
+                continue
+            missed_in_a_row = 0
+
+            if process is not None:
+                process(seen[2])
+
+            value = (value + 1) % 2 ** self.bits
+            sent = time()
+            new_seen = self._show_and_wait(value, timeout)
+            if new_seen is not None:
+                results.observe("loop", new_seen[1] - seen[1])
+                results.observe("display", new_seen[1] - sent)
+                metrics.observe("latency.loop", new_seen[1] - seen[1])
+                metrics.observe("latency.display", new_seen[1] - sent)
+                measured += 1
+            seen = new_seen
+
+        report = results.snapshot()["latency"]
+        report["missed"] = missed
+        return report
+
+    def _show_and_wait(self, value, timeout):
+        """ Project a value and wait for the camera to see it
+        :return: (seq, tstamp, frame) of the first frame showing it, or None
+        """
+        self.prj.render_to_camera(self.draw(value))
+        deadline = time() + timeout
+        seq = self.cam.latest_seq
+        while time() < deadline:
+            new_frame = self.cam.read_next(seq, timeout=deadline - time())
+            if new_frame is None: break
+            seq, tstamp, frame = new_frame
+            if self.read(frame) == value:
+                return new_frame
+        return None
@@ -0,0 +1,246 @@
+"""
+Lightweight timing and counting hooks for the hot path.
+
+Everything records into the module level `metrics` registry, which is
+disabled by default. While disabled, every hook returns immediately, so
+the hooks can stay in production code:
+
+    from utils.metrics import metrics
+
+    with metrics.timer("segmenter.predict"):
+        segmentation = segmenter.predict(frame)
+    metrics.tick("demo.frames")
+
+Call metrics.enable() to start recording, then read it with snapshot(),
+draw_overlay(), or export it periodically with a MetricsExporter.
+"""
+import json
+import os
+from collections import deque
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+class _Timer:
+    """ Times the body of a with statement """
+    __slots__ = ("_metrics", "_name", "_start")
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._name, perf_counter() - self._start)
+
+
+class _NullTimer:
+    """ What timer() hands out while metrics are disabled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """ A registry of rolling latency histograms, event rates, counters and
+    gauges. Only the last `window` samples of each are kept. Hooks can be
+    called from any thread. """
+
+    def __init__(self, enabled=False, window=300):
+        self.enabled = enabled
+        self.window = window
+        self._lock = Lock()
+        self._latencies = {}
+        self._ticks = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._latencies = {}
+            self._ticks = {}
+            self._counters = {}
+            self._gauges = {}
+
+    def timer(self, name):
+        """ A context manager that records how long its body took """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def observe(self, name, seconds):
+        """ Record a latency, in seconds """
+        if not self.enabled: return
+        with self._lock:
+            if name not in self._latencies:
+                self._latencies[name] = deque(maxlen=self.window)
+            self._latencies[name].append(seconds)
+
+    def tick(self, name):
+        """ Record that an event happened now, to measure its rate """
+        if not self.enabled: return
+        now = perf_counter()
+        with self._lock:
+            if name not in self._ticks:
+                self._ticks[name] = deque(maxlen=self.window)
+            self._ticks[name].append(now)
+
+    def increment(self, name, amount=1):
+        if not self.enabled: return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        if not self.enabled: return
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        """ :return: A JSON-friendly dict of everything recorded so far """
+        # Copy everything while locked, and do the math after
+        with self._lock:
+            latencies = {name: list(samples)
+                         for name, samples in self._latencies.items()}
+            all_ticks = {name: list(ticks)
+                         for name, ticks in self._ticks.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+
+        latency = {}
+        for name, samples in latencies.items():
+            samples = np.array(samples)
+            if not len(samples): continue
+            stats = {"count": len(samples),
+                     "mean_ms": float(samples.mean() * 1000)}
+            for p in PERCENTILES:
+                stats["p{}_ms".format(p)] = float(
+                    np.percentile(samples, p) * 1000)
+            latency[name] = stats
+
+        fps = {}
+        for name, ticks in all_ticks.items():
+            if len(ticks) < 2 or ticks[-1] == ticks[0]: continue
+            fps[name] = (len(ticks) - 1) / (ticks[-1] - ticks[0])
+
+        return {"latency": latency,
+                "fps": fps,
+                "counters": counters,
+                "gauges": gauges}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="projectorml"):
+        """ Format the snapshot in the Prometheus text exposition format """
+        def metric_name(name):
+            return prefix + "_" + name.replace(".", "_").replace("-", "_")
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, stats in snapshot["latency"].items():
+            name = metric_name(name) + "_seconds"
+            lines.append("# TYPE {} summary".format(name))
+            for p in PERCENTILES:
+                lines.append('{}{{quantile="{}"}} {}'.format(
+                    name, p / 100, stats["p{}_ms".format(p)] / 1000))
+            lines.append("{}_sum {}".format(
+                name, stats["mean_ms"] / 1000 * stats["count"]))
+            lines.append("{}_count {}".format(name, stats["count"]))
+        for name, value in snapshot["fps"].items():
+            name = metric_name(name) + "_fps"
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, value))
+        for name, value in snapshot["counters"].items():
+            name = metric_name(name) + "_total"
+            lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(name, value))
+        for name, value in snapshot["gauges"].items():
+            name = metric_name(name)
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, fmt="json"):
+        """ Atomically write the metrics to a file, so that readers (such as
+        the Prometheus node exporter) never see a half-written file
+        :param fmt: "json" or "prometheus" """
+        text = self.to_prometheus() if fmt == "prometheus" else self.to_json()
+        tmp_name = filename + ".tmp"
+        with open(tmp_name, "w") as f:
+            f.write(text)
+        os.replace(tmp_name, filename)
+
+    def draw_overlay(self, img, color=(0, 255, 0), origin=(10, 20)):
+        """ Draw the current FPS, latencies and counters onto an image """
+        snapshot = self.snapshot()
+        lines = ["{}: {:.1f} fps".format(name, value)
+                 for name, value in snapshot["fps"].items()]
+        lines += ["{}: {:.1f}ms (p99 {:.1f}ms)".format(
+                  name, stats["mean_ms"], stats["p99_ms"])
+                  for name, stats in snapshot["latency"].items()]
+        lines += ["{}: {}".format(name, value)
+                  for name, value in snapshot["counters"].items()]
+        lines += ["{}: {:.2f}".format(name, value)
+                  for name, value in snapshot["gauges"].items()]
+
+        x, y = origin
+        for line in lines:
+            cv2.putText(img, line, (x, y), cv2.FONT_HERSHEY_SIMPLEX, .45,
+                        color, 1)
+            y += 18
+        return img
+
+
+class MetricsExporter(Thread):
+    """ Periodically writes a Metrics registry to a file """
+
+    def __init__(self, registry, filename, fmt="json", interval=5):
+        """
+        :param registry: The Metrics object to export
+        :param filename: Where to write the metrics
+        :param fmt: "json", or "prometheus" for a node exporter textfile
+        :param interval: Seconds between writes
+        """
+        super().__init__(daemon=True)
+        if fmt not in ("json", "prometheus"):
+            raise ValueError("Unknown metrics format: " + str(fmt))
+        self.registry = registry
+        self.filename = filename
+        self.fmt = fmt
+        self.interval = interval
+        self._stopped = Event()
+        self.start()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.registry.write(self.filename, self.fmt)
+
+    def close(self):
+        self._stopped.set()
+        self.join()
+        self.registry.write(self.filename, self.fmt)
+
+
+# The registry that the rest of the project records into
+metrics = Metrics()
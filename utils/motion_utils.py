@@ -0,0 +1,167 @@
+import cv2
+import numpy as np
+
+
+class MotionDetector:
+    """ A cheap motion detector, meant to decide whether a frame is worth
+    running expensive inference on. Frames are shrunk and converted to
+    grayscale, then compared against a running average of the background.
+    Only pixels inside of the given polygons (usually Surface.cam_points)
+    are counted. """
+
+    def __init__(self, polygons=None, scale=0.25, learning_rate=0.05,
+                 pixel_thresh=25):
+        """
+        :param polygons: A list of polygons in full resolution camera
+        coordinates to look for motion in. If None, the whole frame is used.
+        :param scale: How much to shrink frames by before comparing them
+        :param learning_rate: How quickly the background absorbs changes
+        :param pixel_thresh: How much a grayscale pixel has to change by
+        before it counts as motion
+        """
+        self.polygons = polygons
+        self.scale = scale
+        self.learning_rate = learning_rate
+        self.pixel_thresh = pixel_thresh
+
+        self._background = None
+        self._mask = None
+
+        # Scratch frames, reused between calls
+        self._background_u8 = None
+        self._diff = None
+
+    def update(self, frame):
+        """ Compare the frame against the background, then fold it into the
+        background.
+        :param frame: A cv2 BGR or grayscale frame
+        :return: The approximate number of full resolution pixels that moved
+        """
+        gray = self._preprocess(frame)
+
+        if self._background is None or self._background.shape != gray.shape:
+            self._reset(gray)
+            return 0
+
+        cv2.convertScaleAbs(self._background, dst=self._background_u8)
+        cv2.absdiff(gray, self._background_u8, dst=self._diff)
+        cv2.threshold(self._diff, self.pixel_thresh, 255, cv2.THRESH_BINARY,
+                      dst=self._diff)
+        if self._mask is not None:
+            cv2.bitwise_and(self._diff, self._mask, dst=self._diff)
+        moved = cv2.countNonZero(self._diff)
+
+        cv2.accumulateWeighted(gray, self._background, self.learning_rate)
+        return int(moved / self.scale ** 2)
+
+    def _preprocess(self, frame):
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                           interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def _reset(self, gray):
+        """ Start a fresh background model for frames of this size """
+        self._background = gray.astype(np.float32)
+        self._background_u8 = np.zeros_like(gray)
+        self._diff = np.zeros_like(gray)
+
+        self._mask = None
+        if self.polygons is not None:
+            self._mask = np.zeros_like(gray)
+            polygons = [np.int32(np.round(np.float32(p) * self.scale))
+                        for p in self.polygons]
+            cv2.fillPoly(self._mask, polygons, 255)
+
+
+class MaskPropagator:
+    """ Carries a segmentation canvas from a keyframe forward to later frames,
+    so that the model doesn't need to run on every frame. Motion between the
+    keyframe and the current frame is estimated with dense optical flow on
+    shrunk grayscale frames, and the canvas is warped along it. """
+
+    def __init__(self, scale=0.25, max_error=0.05, pixel_thresh=25):
+        """
+        :param scale: How much to shrink frames by before estimating flow
+        :param max_error: The largest fraction of pixels that the flow can fail
+        to explain before the propagation is considered untrustworthy
+        :param pixel_thresh: How much a grayscale pixel of the keyframe, once
+        warped along the flow, can differ from the current frame and still
+        count as explained
+        """
+        self.scale = scale
+        self.max_error = max_error
+        self.pixel_thresh = pixel_thresh
+        self.last_error = None
+
+        self._key_gray = None
+        self._key_canvas = None
+        self._grids = {}  # {(height, width): (xs, ys)}
+
+    @property
+    def has_keyframe(self):
+        return self._key_canvas is not None
+
+    def set_keyframe(self, frame, canvas):
+        """ Remember a frame and its freshly computed segmentation canvas.
+        The canvas is copied, since it's kept until the next keyframe. """
+        self._key_gray = self._preprocess(frame)
+        self._key_canvas = canvas.copy()
+
+    def reset(self):
+        self._key_gray = None
+        self._key_canvas = None
+
+    def propagate(self, frame):
+        """
+        Estimate the segmentation canvas of frame from the keyframe.
+        :return: The warped canvas, or None if there is no keyframe or the
+        motion estimate isn't confident enough, meaning it's time for a
+        new keyframe
+        """
+        if not self.has_keyframe:
+            return None
+        gray = self._preprocess(frame)
+        if gray.shape != self._key_gray.shape:
+            return None
+
+        # For every pixel of the current frame, where it was in the keyframe
+        flow = cv2.calcOpticalFlowFarneback(gray, self._key_gray, None,
+                                            0.5, 2, 9, 2, 5, 1.1, 0)
+
+        # Check the flow explains the change between the two frames
+        small_x, small_y = self._grid(gray.shape)
+        warped_key = cv2.remap(self._key_gray, small_x + flow[..., 0],
+                               small_y + flow[..., 1], cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+        diff = cv2.absdiff(warped_key, gray)
+        unexplained = cv2.countNonZero(
+            cv2.threshold(diff, self.pixel_thresh, 255, cv2.THRESH_BINARY)[1])
+        self.last_error = unexplained / diff.size
+        if self.last_error > self.max_error:
+            return None
+
+        # Scale the flow up to full resolution and warp the canvas along it
+        h, w = self._key_canvas.shape[:2]
+        flow = cv2.resize(flow, (w, h), interpolation=cv2.INTER_LINEAR)
+        flow /= self.scale
+        full_x, full_y = self._grid((h, w))
+        return cv2.remap(self._key_canvas, full_x + flow[..., 0],
+                         full_y + flow[..., 1], cv2.INTER_NEAREST,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def _preprocess(self, frame):
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                           interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small
+
+    def _grid(self, size):
+        """ Pixel coordinate grids, cached per size """
+        size = tuple(size[:2])
+        if size not in self._grids:
+            ys, xs = np.indices(size, dtype=np.float32)
+            self._grids[size] = (xs, ys)
+        return self._grids[size]
@@ -0,0 +1,142 @@
+from collections import deque
+from threading import Condition, Thread
+
+
+class LatestValueQueue:
+    """ A small bounded queue that never blocks the producer. When it is
+    full, the oldest item is thrown away to make room for the newest. """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._items = deque()
+        self._cond = Condition()
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """ Return the oldest item, or None if the timeout ran out or the
+        queue was closed while waiting """
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self.closed, timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        """ Wake up everyone waiting on get() """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class Stage(Thread):
+    """ Runs one step of a Pipeline on its own thread. The function is called
+    with each item from the input queue, and whatever it returns is put on
+    the output queue. Returning None drops the item. A stage with no input
+    queue is a source, and its function is called with no arguments. """
+
+    POLL_TIMEOUT = 0.1
+
+    def __init__(self, name, func):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.input = None
+        self.output = None
+        self.running = False
+        self.error = None
+        self.processed = 0
+
+    def run(self):
+        while self.running:
+            if self.input is None:
+                args = ()
+            else:
+                item = self.input.get(timeout=self.POLL_TIMEOUT)
+                if item is None:
+                    if self.input.closed: break
+                    continue
+                args = (item,)
+
+            try:
+                result = self.func(*args)
+            except Exception as e:
+                print("Pipeline| Stage", self.name, "failed with", repr(e))
+                self.error = e
+                self.running = False
+                break
+
+            self.processed += 1
+            if result is not None:
+                self.output.put(result)
+            # Let go of the item while waiting for the next one, since it may
+            # be pinning a slot of a SharedFrameRing
+            item = args = result = None
+
+        # Let the next stage know nothing else is coming
+        self.running = False
+        self.output.close()
+
+    def stop(self):
+        self.running = False
+        if self.input is not None:
+            self.input.close()
+
+
+class Pipeline:
+    """ Chains Stages together with LatestValueQueues, so that every stage
+    works on its own thread and the slowest stage sets the framerate. If a
+    stage falls behind, the stage feeding it drops its oldest results rather
+    than piling up latency.
+
+    The output of the last stage is read with pipeline.get(), which is meant
+    to be called from the main (GUI) thread. """
+
+    def __init__(self, stages, queue_size=1):
+        """
+        :param stages: A list of Stage objects, the first being the source
+        :param queue_size: How many items can wait between two stages
+        """
+        self.stages = stages
+        self.queues = []
+
+        for i, stage in enumerate(stages):
+            stage.output = LatestValueQueue(queue_size)
+            self.queues.append(stage.output)
+            if i > 0:
+                stage.input = stages[i - 1].output
+
+    def start(self):
+        for stage in self.stages:
+            stage.running = True
+            stage.start()
+
+    def get(self, timeout=None):
+        """ Get the newest output of the last stage, or None on a timeout.
+        Raises the error of any stage that crashed. """
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+        return self.stages[-1].output.get(timeout)
+
+    @property
+    def running(self):
+        return all(stage.running for stage in self.stages)
+
+    @property
+    def dropped(self):
+        """ How many items each stage has had to throw away """
+        return {stage.name: stage.output.dropped for stage in self.stages}
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join()
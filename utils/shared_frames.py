@@ -0,0 +1,341 @@
+"""
+Moving frames between processes through shared memory, so that capture and
+inference don't have to share one GIL with the render loop.
+
+A SharedFrameRing is a fixed number of frame slots in a
+multiprocessing.shared_memory block. Writers fill a slot in place and
+publish it with a sequence number; readers get a numpy view straight into
+the slot. Nothing is pickled, and slots that a reader is still looking at
+are never overwritten.
+
+Readers can either pin a slot and release() it themselves, or lease it:
+lease_next() and lease_seq() return a read-only frame that keeps its slot
+pinned for as long as it, or any view of it, is alive.
+"""
+import multiprocessing as mp
+import pickle
+from multiprocessing import shared_memory
+from threading import Lock
+from time import time
+from types import SimpleNamespace
+
+import numpy as np
+
+# Processes are spawned rather than forked, since forking a process that is
+# already running cv2 and camera threads can deadlock
+_SPAWN = mp.get_context("spawn")
+
+
+class SharedFrameRing:
+    """ A ring of frame slots in shared memory. Pass it to a child process
+    through the Process arguments, and both sides can use it. """
+
+    def __init__(self, max_shape, dtype=np.uint8, slots=4, ctx=_SPAWN):
+        """
+        :param max_shape: The largest frame shape that will be written. Smaller
+        frames with the same number of dimensions fit too.
+        :param dtype: The dtype of every frame
+        :param slots: How many frames can be held at once
+        :param ctx: The multiprocessing context the processes will use
+        """
+        self.max_shape = tuple(max_shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.slot_bytes = int(np.prod(self.max_shape)) * self.dtype.itemsize
+
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self.slot_bytes * slots)
+        self._owner = True
+
+        # Per slot metadata. A seq of -1 means the slot holds nothing valid.
+        self._cond = ctx.Condition()
+        self._seqs = ctx.RawArray("q", [-1] * slots)
+        self._tstamps = ctx.RawArray("d", slots)
+        self._pins = ctx.RawArray("i", slots)
+        self._shapes = ctx.RawArray("i", slots * len(self.max_shape))
+        self._latest = ctx.RawValue("q", 0)
+        self._closed = ctx.RawValue("b", 0)
+
+        self._attach()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_buffer"]
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def _attach(self):
+        self._buffer = np.ndarray((self.slots, self.slot_bytes),
+                                  dtype=np.uint8, buffer=self._shm.buf)
+
+    @property
+    def closed(self):
+        return bool(self._closed.value)
+
+    @property
+    def latest_seq(self):
+        return self._latest.value
+
+    def _view(self, slot, shape):
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        return self._buffer[slot, :nbytes].view(self.dtype).reshape(shape)
+
+    def _slot_shape(self, slot):
+        ndim = len(self.max_shape)
+        return tuple(self._shapes[slot * ndim:(slot + 1) * ndim])
+
+    def begin_write(self, shape=None, timeout=None):
+        """
+        Claim a slot to write a frame into, in place.
+        :param shape: The shape of the frame, if smaller than max_shape
+        :param timeout: How long to wait for a reader to release a slot, if
+        every slot is pinned. None waits until the ring is closed.
+        :return: (slot, view), where view is the frame to fill in
+        """
+        shape = self.max_shape if shape is None else tuple(shape)
+        if len(shape) != len(self.max_shape) or \
+                any(s > m for s, m in zip(shape, self.max_shape)):
+            raise ValueError("Frame of shape {} doesn't fit in a ring of {}"
+                             .format(shape, self.max_shape))
+
+        with self._cond:
+            # Reuse the oldest slot that no reader is holding onto
+            self._cond.wait_for(lambda: self._free_slots() or self.closed,
+                                timeout)
+            free = self._free_slots()
+            if not free:
+                raise RuntimeError("Every slot of the ring is pinned!")
+            slot = min(free, key=lambda i: self._seqs[i])
+            self._seqs[slot] = -1
+            ndim = len(self.max_shape)
+            self._shapes[slot * ndim:(slot + 1) * ndim] = shape
+        return slot, self._view(slot, shape)
+
+    def _free_slots(self):
+        return [i for i in range(self.slots) if self._pins[i] == 0]
+
+    def end_write(self, slot, tstamp, seq=None):
+        """
+        Publish a slot filled in after begin_write()
+        :param seq: The sequence number to publish it under. By default, one
+        more than the last published frame.
+        :return: The sequence number of the frame
+        """
+        with self._cond:
+            if seq is None:
+                seq = self._latest.value + 1
+            self._seqs[slot] = seq
+            self._tstamps[slot] = tstamp
+            self._latest.value = max(self._latest.value, seq)
+            self._cond.notify_all()
+        return seq
+
+    def write(self, frame, tstamp=None, seq=None, timeout=None):
+        """ Copy a frame into the ring and publish it """
+        slot, view = self.begin_write(frame.shape, timeout)
+        np.copyto(view, frame)
+        return self.end_write(slot, time() if tstamp is None else tstamp, seq)
+
+    def acquire_next(self, after_seq, timeout=None):
+        """
+        Wait for a frame newer than after_seq, and pin it so it can't be
+        overwritten until release() is called with its slot.
+        :return: (seq, tstamp, slot, view), or None on a timeout or close
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._latest.value > after_seq or self.closed,
+                    timeout) or self._latest.value <= after_seq:
+                return None
+            return self._pin(self._find(self._latest.value))
+
+    def acquire_seq(self, seq, timeout=None):
+        """ Same as acquire_next, but for the frame with exactly this seq """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._find(seq) is not None or self.closed,
+                    timeout):
+                return None
+            return self._pin(self._find(seq))
+
+    def lease_next(self, after_seq, timeout=None):
+        """
+        Same as acquire_next, but the slot is released automatically once the
+        returned frame is no longer referenced.
+        :return: (seq, tstamp, frame), where frame is a read-only view into
+        the ring, or None on a timeout or close
+        """
+        return self._lease(self.acquire_next(after_seq, timeout))
+
+    def lease_seq(self, seq, timeout=None):
+        """ Same as lease_next, but for the frame with exactly this seq """
+        return self._lease(self.acquire_seq(seq, timeout))
+
+    def _lease(self, item):
+        if item is None:
+            return None
+        seq, tstamp, slot, view = item
+        return seq, tstamp, np.asarray(_Lease(self, slot, view))
+
+    def _find(self, seq):
+        for slot in range(self.slots):
+            if self._seqs[slot] == seq:
+                return slot
+        return None
+
+    def _pin(self, slot):
+        if slot is None:
+            return None
+        self._pins[slot] += 1
+        return (self._seqs[slot], self._tstamps[slot], slot,
+                self._view(slot, self._slot_shape(slot)))
+
+    def release(self, slot):
+        with self._cond:
+            self._pins[slot] -= 1
+            self._cond.notify_all()
+
+    def close(self):
+        """ Wake everyone waiting on the ring, and tell them to stop """
+        with self._cond:
+            self._closed.value = 1
+            self._cond.notify_all()
+
+    def unlink(self):
+        """ Free the shared memory. Only the creating process does this. """
+        self._buffer = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # Leased frames are still alive, so the mapping stays open until
+            # they're gone
+            pass
+        if self._owner:
+            self._shm.unlink()
+
+
+class _Lease:
+    """ Holds a ring slot pinned. Arrays made from it with np.asarray() keep
+    it alive, as do any views of those arrays, and the slot is released when
+    the last of them is garbage collected. """
+
+    def __init__(self, ring, slot, view):
+        self._ring = ring
+        self._slot = slot
+        self._view = view  # Keeps the shared memory mapped
+        interface = dict(view.__array_interface__)
+        interface["data"] = (interface["data"][0], True)  # Read-only
+        self.__array_interface__ = interface
+
+    def __del__(self):
+        try:
+            self._ring.release(self._slot)
+        except Exception:
+            pass  # The ring's process is shutting down
+
+
+def _picklable(error):
+    """ Exceptions are sent back to the parent, so make sure they can be """
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def _inference_loop(model_factory, requests, results, replies):
+    """ The body of an inference process. Every request is answered on the
+    replies pipe with (seq, None) once its result is in the results ring, or
+    (seq, exception) if it failed. """
+    try:
+        model, load_error = model_factory(), None
+    except Exception as e:
+        model, load_error = None, _picklable(e)
+
+    last_seq = 0
+    while not requests.closed:
+        request = requests.acquire_next(last_seq, timeout=0.1)
+        if request is None: continue
+        last_seq, tstamp, slot, frame = request
+
+        error = load_error
+        if error is None:
+            try:
+                colored = model.predict(frame).colored
+                results.write(colored, tstamp, seq=last_seq,
+                              timeout=ProcessSegmenter.TIMEOUT)
+            except Exception as e:
+                error = _picklable(e)
+        requests.release(slot)
+        replies.send((last_seq, error))
+
+
+class ProcessSegmenter:
+    """ Drop-in for a segmenter that runs the model in its own process.
+    Frames go to the process and canvases come back through SharedFrameRings,
+    so nothing is pickled. Each frame is copied once into the request ring,
+    and the result is handed back as a read-only view into the result ring
+    that stays valid for as long as it is referenced. Calls to predict() are
+    served one at a time. """
+
+    TIMEOUT = 10  # Seconds to wait for a result before giving up
+
+    def __init__(self, model_factory, max_shape, slots=3):
+        """
+        :param model_factory: A picklable callable that loads the model in the
+        child process, such as functools.partial(
+        DeeplabImageSegmenter.from_path, segment_path, segment_map)
+        :param max_shape: The largest frame shape that will be segmented
+        """
+        self.requests = SharedFrameRing(max_shape, slots=slots)
+        self.results = SharedFrameRing(max_shape, slots=slots)
+        self._replies, replies = _SPAWN.Pipe(duplex=False)
+        self.process = _SPAWN.Process(target=_inference_loop,
+                                      args=(model_factory, self.requests,
+                                            self.results, replies),
+                                      daemon=True)
+        self.process.start()
+        replies.close()
+        self._lock = Lock()
+
+    def predict(self, frame):
+        """
+        :return: A result with .colored, a read-only view into shared memory.
+        Copy it to keep a writable version.
+        """
+        with self._lock:
+            seq = self.requests.write(frame, timeout=self.TIMEOUT)
+            error = self._wait_for_reply(seq)
+            if error is not None:
+                raise error
+
+            result = self.results.lease_seq(seq, timeout=0)
+            if result is None:
+                raise RuntimeError("Result {} was overwritten!".format(seq))
+        return SimpleNamespace(colored=result[2])
+
+    def _wait_for_reply(self, seq):
+        """ :return: The exception the request raised in the process, or None
+        """
+        deadline = time() + self.TIMEOUT
+        while self._replies.poll(max(0, deadline - time())):
+            try:
+                reply_seq, error = self._replies.recv()
+            except EOFError:
+                raise RuntimeError("The inference process died!")
+            # Skip replies to earlier requests that timed out
+            if reply_seq == seq:
+                return error
+        raise TimeoutError("The inference process didn't respond!")
+
+    def close(self):
+        self.requests.close()
+        self.results.close()
+        self.process.join()
+        self._replies.close()
+        self.requests.unlink()
+        self.results.unlink()
@@ -1,13 +1,17 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
 
 def isolate_point(img, lowerHSV, higherHSV, area_thresh=100):
-    isolated = isolate_color(img.copy(), lowerHSV, higherHSV)
-    gray = cv2.cvtColor(isolated, cv2.COLOR_BGR2GRAY)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    mask = _hsv_mask(hsv, lowerHSV, higherHSV)
 
-    cnts = cv2.findContours(gray.copy(), cv2.RETR_EXTERNAL,
-                            cv2.CHAIN_APPROX_SIMPLE)[1]
+    # [-2] works with both the 2 and 3 return versions of findContours
+    cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL,
+                            cv2.CHAIN_APPROX_SIMPLE)[-2]
 
     cnts = sorted(cnts, key=lambda c: cv2.contourArea(c), reverse=True)
     if len(cnts) == 0:
@@ -23,6 +27,7 @@ def isolate_point(img, lowerHSV, higherHSV, area_thresh=100):
     M = cv2.moments(cnt)
     if M["m10"] == 0 or M["m00"] == 0 or M["m01"] == 0:
         print("Failed to get Moment of contour!")
+        return None
 
     cX = int(M["m10"] / M["m00"])
     cY = int(M["m01"] / M["m00"])
@@ -30,30 +35,222 @@ def isolate_point(img, lowerHSV, higherHSV, area_thresh=100):
     return cX, cY
 
 
-def find_squares(img):
-    def angle_cos(p0, p1, p2):
-        d1, d2 = (p0 - p1).astype('float'), (p2 - p1).astype('float')
-        return abs(np.dot(d1, d2) / np.sqrt(np.dot(d1, d1) * np.dot(d2, d2)))
-
-    img = cv2.GaussianBlur(img, (5, 5), 0)
-    squares = []
-    for gray in cv2.split(img):
-        for thrs in range(0, 255, 26):
-            if thrs == 0:
-                bin = cv2.Canny(gray, 0, 50, apertureSize=5)
-                bin = cv2.dilate(bin, None)
-            else:
-                _retval, bin = cv2.threshold(gray, thrs, 255, cv2.THRESH_BINARY)
-            bin, contours, _hierarchy = cv2.findContours(bin, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-            for cnt in contours:
-                cnt_len = cv2.arcLength(cnt, True)
-                cnt = cv2.approxPolyDP(cnt, 0.02*cnt_len, True)
-                if len(cnt) == 4 and cv2.contourArea(cnt) > 1000 and cv2.isContourConvex(cnt):
-                    cnt = cnt.reshape(-1, 2)
-                    max_cos = np.max([angle_cos( cnt[i], cnt[(i+1) % 4], cnt[(i+2) % 4] ) for i in range(4)])
-                    if max_cos < 0.1:
-                        squares.append(cnt)
-    return squares
+class ColorTracker:
+    """ Tracks several colored markers at once. Every target is classified in
+    a single pass over the frame with a ColorClassifier, and once a target
+    has been found, only a window around where it was last seen is searched.
+    Targets that get lost are searched for across the whole frame again. """
+
+    def __init__(self, targets, area_thresh=100, margin=1.0, min_window=32,
+                 bins=64):
+        """
+        :param targets: {name: (lowerHSV, higherHSV)}, in the same format as
+        isolate_color. Hues that wrap around (lower > higher) are fine.
+        :param area_thresh: The fewest pixels a target can be made of
+        :param margin: How far to search around a target's last bounding box,
+        as a multiple of its size on every side
+        :param min_window: The smallest search window, in pixels
+        :param bins: Passed on to ColorClassifier. 256 matches isolate_color
+        exactly.
+        """
+        self.targets = dict(targets)
+        self.area_thresh = area_thresh
+        self.margin = margin
+        self.min_window = min_window
+
+        # Each classifier labels up to MAX_RANGES targets, one bit each
+        names = list(self.targets)
+        size = ColorClassifier.MAX_RANGES
+        self._classifiers = [
+            ColorClassifier({name: self.targets[name]
+                             for name in names[i:i + size]}, bins)
+            for i in range(0, len(names), size)]
+        self._bits = {name: (i // size, 1 << (i % size))
+                      for i, name in enumerate(names)}
+
+        # The last bounding box (x1, y1, x2, y2) of every target being tracked
+        self._boxes = {}
+
+    def reset(self):
+        """ Forget where every target was, so the next update searches the
+        whole frame """
+        self._boxes = {}
+
+    def update(self, img):
+        """
+        Find every target in a frame.
+        :param img: A cv2 BGR frame
+        :return: {name: (cX, cY)}, or {name: None} for targets not found
+        """
+        h, w = img.shape[:2]
+        windows = {name: self._search_window(name, w, h) or (0, 0, w, h)
+                   for name in self.targets}
+        if not windows:
+            return {}
+
+        # Label only the part of the frame that any target is searched in
+        x1s, y1s, x2s, y2s = zip(*windows.values())
+        rx, ry = min(x1s), min(y1s)
+        region = np.ascontiguousarray(img[ry:max(y2s), rx:max(x2s)])
+        labels = [classifier.classify(region)
+                  for classifier in self._classifiers]
+
+        # Ranges can overlap, so one pixel can belong to several targets, and
+        # each target still needs its own connected components
+        points = {}
+        for name, (x1, y1, x2, y2) in windows.items():
+            group, bit = self._bits[name]
+            window = labels[group][y1 - ry:y2 - ry, x1 - rx:x2 - rx]
+            mask = cv2.compare(cv2.bitwise_and(window, bit), 0, cv2.CMP_GT)
+            blob = _largest_blob(mask, self.area_thresh)
+            if blob is None:
+                self._boxes.pop(name, None)
+                points[name] = None
+                continue
+
+            (cX, cY), (bx1, by1, bx2, by2) = blob
+            self._boxes[name] = (bx1 + x1, by1 + y1, bx2 + x1, by2 + y1)
+            points[name] = (int(cX + x1), int(cY + y1))
+        return points
+
+    def _search_window(self, name, w, h):
+        """ :return: The (x1, y1, x2, y2) to search for a target in, or None
+        to search the whole frame """
+        if name not in self._boxes:
+            return None
+        x1, y1, x2, y2 = self._boxes[name]
+        pad_x = max(int((x2 - x1) * self.margin), self.min_window)
+        pad_y = max(int((y2 - y1) * self.margin), self.min_window)
+        return (max(x1 - pad_x, 0), max(y1 - pad_y, 0),
+                min(x2 + pad_x, w), min(y2 + pad_y, h))
+
+
+def _largest_blob(mask, area_thresh):
+    """ :return: ((cX, cY), (x1, y1, x2, y2)) of the largest connected blob
+    of a mask, or None if it has fewer than area_thresh pixels """
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(mask)
+    if count < 2:
+        return None
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    x, y, w, h, area = (int(v) for v in stats[largest])
+    if area < area_thresh:
+        return None
+    return tuple(centroids[largest]), (x, y, x + w, y + h)
+
+
+def find_squares(img, levels=0, min_area=1000, max_cos=0.1,
+                 thresholds=range(0, 255, 26), overlap=None):
+    """
+    Find convex, roughly right-angled quadrilaterals in an image, such as
+    tables, screens and sheets of paper that could be projected onto.
+
+    Every channel is binarized at several thresholds (and with Canny, for a
+    threshold of 0), and the quadrilateral contours of each are collected.
+    The passes run in parallel, since cv2 releases the GIL. With the default
+    arguments, the same squares are found as always. levels=1 and overlap=0.8
+    are several times faster, and return each square once.
+
+    :param img: A cv2 BGR or grayscale image
+    :param levels: How many times to halve the image before searching. The
+    results are scaled back up to full resolution coordinates, so they lose
+    that many bits of precision.
+    :param min_area: The smallest square to keep, in full resolution pixels
+    :param max_cos: The largest cosine of any corner angle. 0.1 allows
+    corners between about 84 and 96 degrees.
+    :param thresholds: The thresholds to binarize each channel at
+    :param overlap: Squares that overlap a larger square by more than this
+    intersection over union are dropped as duplicates. None keeps them all.
+    :return: A list of (4, 2) int32 arrays of corners. When overlap is set,
+    they're sorted largest first, otherwise they're in the order found.
+    """
+    small = img
+    for _ in range(levels):
+        small = cv2.pyrDown(small)
+    if not levels:
+        # pyrDown smooths on its own, otherwise blur away sensor noise
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+    scale = 2 ** levels
+
+    channels = cv2.split(small) if small.ndim == 3 else [small]
+    jobs = [(gray, thrs, min_area / scale ** 2)
+            for gray in channels for thrs in thresholds]
+    candidates = [quad for quads in _get_pool().map(_find_quads, *zip(*jobs))
+                  for quad in quads]
+    if not candidates:
+        return []
+
+    # Test every corner of every candidate at once
+    quads = np.float64(candidates)
+    d1 = np.roll(quads, 1, axis=1) - quads
+    d2 = np.roll(quads, -1, axis=1) - quads
+    cos = np.abs((d1 * d2).sum(axis=2)) / np.sqrt(
+        (d1 ** 2).sum(axis=2) * (d2 ** 2).sum(axis=2) + 1e-12)
+    squares = np.float32(quads[cos.max(axis=1) < max_cos] * scale)
+
+    if overlap is not None:
+        squares = sorted(squares, key=cv2.contourArea, reverse=True)
+        squares = _drop_duplicates(squares, overlap)
+    return [np.int32(np.round(square)) for square in squares]
+
+
+def _find_quads(gray, thrs, min_area):
+    """ One binarization pass of find_squares """
+    if thrs == 0:
+        binary = cv2.Canny(gray, 0, 50, apertureSize=5)
+        binary = cv2.dilate(binary, None)
+    else:
+        _retval, binary = cv2.threshold(gray, thrs, 255, cv2.THRESH_BINARY)
+
+    # [-2] works with both the 2 and 3 return versions of findContours
+    contours = cv2.findContours(binary, cv2.RETR_LIST,
+                                cv2.CHAIN_APPROX_SIMPLE)[-2]
+    quads = []
+    for cnt in contours:
+        # The approximated polygon is a subset of the contour's points, so it
+        # can't be bigger than the contour's bounding box
+        _, _, w, h = cv2.boundingRect(cnt)
+        if len(cnt) < 4 or w * h <= min_area: continue
+        cnt = cv2.approxPolyDP(cnt, 0.02 * cv2.arcLength(cnt, True), True)
+        if len(cnt) == 4 and cv2.contourArea(cnt) > min_area and \
+                cv2.isContourConvex(cnt):
+            quads.append(cnt.reshape(4, 2))
+    return quads
+
+
+def _drop_duplicates(squares, overlap):
+    """ Keep each square unless it overlaps an already kept (larger) one """
+    kept = []
+    for square in squares:
+        area = cv2.contourArea(square)
+        duplicate = False
+        for other in kept:
+            shared, _ = cv2.intersectConvexConvex(square, other)
+            union = area + cv2.contourArea(other) - shared
+            if union > 0 and shared / union > overlap:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(square)
+    return kept
+
+
+_pool = None
+
+
+def _get_pool():
+    """ The thread pool find_squares runs its passes on, made on first use """
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(thread_name_prefix="find_squares")
+        atexit.register(_shutdown_pool)
+    return _pool
+
+
+def _shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
 
 
 def isolate_color(img, lowerHSV, higherHSV):
@@ -65,7 +262,15 @@ def isolate_color(img, lowerHSV, higherHSV):
     """
 
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    mask = _hsv_mask(hsv, lowerHSV, higherHSV)
+
+    final = cv2.bitwise_and(img, img, mask=mask)
+    return final
+
 
+def _hsv_mask(hsv, lowerHSV, higherHSV):
+    """ inRange for an HSV frame, where lowerHSV's hue can be above
+    higherHSV's to select hues that wrap around past 180 """
     if lowerHSV[0] > higherHSV[0]:
         # If the HSV values wrap around, then intelligently mask it
 
@@ -75,11 +280,122 @@ def isolate_color(img, lowerHSV, higherHSV):
         lower2 = [0, lowerHSV[1], lowerHSV[2]]
         mask2  = cv2.inRange(hsv, np.array(lower2), np.array(higherHSV))
 
-        mask = mask1 + mask2
+        return mask1 + mask2
 
-    else:
-        mask  = cv2.inRange(hsv, np.array(lowerHSV), np.array(higherHSV))
+    return cv2.inRange(hsv, np.array(lowerHSV), np.array(higherHSV))
 
 
-    final = cv2.bitwise_and(img, img, mask=mask)
-    return final
\ No newline at end of file
+class ColorClassifier:
+    """ Classifies pixels by HSV range without converting frames to HSV.
+    Which ranges every BGR color falls in is worked out once, up front, into
+    a 3D lookup table, which cv2.calcBackProject then applies to whole
+    frames. Up to 8 ranges are classified in that single pass, one bit each,
+    so adding ranges costs almost nothing. """
+
+    MAX_RANGES = 8  # One bit of the uint8 label per range
+
+    def __init__(self, ranges, bins=64):
+        """
+        :param ranges: {name: (lowerHSV, higherHSV)}, in the same format as
+        isolate_color. Hues that wrap around (lower > higher) are fine.
+        :param bins: How many levels of each of B, G and R the table tells
+        apart. 256 reproduces isolate_color exactly, while 64 is much faster
+        and only differs right at the edges of the ranges.
+        """
+        if len(ranges) > self.MAX_RANGES:
+            raise ValueError("A ColorClassifier can hold at most {} ranges"
+                             .format(self.MAX_RANGES))
+        self.names = list(ranges)
+        self.bins = bins
+
+        # The BGR color at the middle of every bin, converted to HSV
+        step = 256 // bins
+        grid = np.indices((bins, bins, bins)) * step + step // 2
+        bgr = np.uint8(np.moveaxis(grid, 0, -1).reshape(-1, 1, 3))
+        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+
+        # With a single range the table can hold the mask value itself
+        self._single = len(ranges) == 1
+        self._table = np.zeros((bins, bins, bins), dtype=np.float32)
+        for bit, (lowerHSV, higherHSV) in enumerate(ranges.values()):
+            inside = _hsv_mask(hsv, lowerHSV, higherHSV) > 0
+            inside = inside.reshape(self._table.shape)
+            self._table[inside] += 255 if self._single else 1 << bit
+
+        # Newer cv2 bindings read a 3D array as a 2D image with channels,
+        # unless it's explicitly wrapped as an n-dimensional Mat
+        if hasattr(cv2, "Mat"):
+            self._table = cv2.Mat(self._table, wrap_channels=False)
+
+    def classify(self, img):
+        """
+        :param img: A cv2 BGR frame
+        :return: A uint8 frame where bit i is set for pixels in the i'th range.
+        With a single range, pixels in it are 255 instead.
+        """
+        return cv2.calcBackProject([img], [0, 1, 2], self._table,
+                                   [0, 256, 0, 256, 0, 256], 1)
+
+    def masks(self, img):
+        """ :return: {name: uint8 mask that is 255 inside of that range} """
+        labels = self.classify(img)
+        if self._single:
+            return {self.names[0]: labels}
+        return {name: cv2.compare(cv2.bitwise_and(labels, 1 << bit), 0,
+                                  cv2.CMP_GT)
+                for bit, name in enumerate(self.names)}
+
+    def mask(self, img, name):
+        """ :return: A uint8 mask that is 255 inside of the named range """
+        labels = self.classify(img)
+        if self._single:
+            return labels
+        bit = 1 << self.names.index(name)
+        return cv2.compare(cv2.bitwise_and(labels, bit), 0, cv2.CMP_GT)
+
+    def isolate(self, img, name):
+        """ The same as isolate_color, for one of the classifier's ranges """
+        return cv2.bitwise_and(img, img, mask=self.mask(img, name))
+
+
+def get_polygon_rois(polygons, frame_shape, padding=0, merge=True):
+    """
+    Get bounding boxes that cover every polygon, clipped to the frame.
+    :param polygons: A list of polygons, each a list of [x, y] points
+    :param frame_shape: The shape of the frame the polygons are drawn on
+    :param padding: Pixels of context to add around each box
+    :param merge: If True, return a single box around all of the polygons.
+    Otherwise return one box per polygon, merging any that overlap.
+    :return: A list of (x1, y1, x2, y2) boxes, to be sliced as
+    frame[y1:y2, x1:x2]
+    """
+    h, w = frame_shape[:2]
+    boxes = []
+    for polygon in polygons:
+        x, y, box_w, box_h = cv2.boundingRect(np.int32(polygon))
+        boxes.append([max(x - padding, 0),
+                      max(y - padding, 0),
+                      min(x + box_w + padding, w),
+                      min(y + box_h + padding, h)])
+    if not boxes:
+        return []
+
+    if merge:
+        x1s, y1s, x2s, y2s = zip(*boxes)
+        return [(min(x1s), min(y1s), max(x2s), max(y2s))]
+
+    # Keep merging overlapping boxes until none overlap
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged: break
+    return [tuple(box) for box in boxes]